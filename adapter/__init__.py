@@ -1,20 +1,139 @@
-from adapter.api import app, set_service_loader
-from adapter.bot import ChatBot
-from adapter.chat_completion import ChatCompletion, ChatMessage, register_chat_completion_service, create_chat_completion_service
-from adapter.services.baichuan2_chat_completion import Baichuan2ChatCompletion
-from adapter.services.chatglm2_chat_completion import ChatGLM2ChatCompletion
-from adapter.services.qwen_chat_completion import QwenChatCompletion
+import importlib
+from typing import Any, Dict, List
+
+
+# attributes are imported from their modules on first access, so that e.g. `from adapter import ChatBot`
+# or the API schemas do not pay for importing torch and transformers
+_lazy_attrs: Dict[str, str] = {
+    "app": "adapter.api",
+    "set_service_loader": "adapter.api",
+    "set_model_registry": "adapter.api",
+    "set_inference_executor": "adapter.api",
+    "set_response_cache": "adapter.api",
+    "set_request_log": "adapter.api",
+    "set_context_window": "adapter.api",
+    "set_session_store": "adapter.api",
+    "set_stream_coalescing": "adapter.api",
+    "set_warm_up": "adapter.api",
+    "set_admission_controller": "adapter.api",
+    "AdmissionController": "adapter.admission",
+    "AdmissionRejected": "adapter.admission",
+    "ChatBot": "adapter.bot",
+    "CancelToken": "adapter.cancel",
+    "ContextWindow": "adapter.context",
+    "ContextTrim": "adapter.context",
+    "estimate_tokens": "adapter.context",
+    "cancellation_stats": "adapter.cancel",
+    "ChatCompletion": "adapter.chat_completion",
+    "ChatMessage": "adapter.chat_completion",
+    "GenerationParams": "adapter.chat_completion",
+    "CompletionChoice": "adapter.chat_completion",
+    "CompletionResult": "adapter.chat_completion",
+    "CompletionDelta": "adapter.chat_completion",
+    "CompletionUsage": "adapter.chat_completion",
+    "EmbeddingResult": "adapter.chat_completion",
+    "EmbeddingInputError": "adapter.chat_completion",
+    "GenerationParamsError": "adapter.chat_completion",
+    "register_chat_completion_service": "adapter.chat_completion",
+    "register_chat_completion_service_module": "adapter.chat_completion",
+    "create_chat_completion_service": "adapter.chat_completion",
+    "chat_completion_service_names": "adapter.chat_completion",
+    "InferenceExecutor": "adapter.executor",
+    "ExecutorFullError": "adapter.executor",
+    "ServiceLoad": "adapter.loading",
+    "load_stage": "adapter.loading",
+    "BatchingChatCompletion": "adapter.batching",
+    "BatchingEngine": "adapter.batching",
+    "BatchRunner": "adapter.batch_runner",
+    "BatchStats": "adapter.batch_runner",
+    "PrefixCache": "adapter.prefix_cache",
+    "EmbeddingBatcher": "adapter.embeddings",
+    "SpeculativeDecoding": "adapter.speculative",
+    "PromptBuilder": "adapter.prompt",
+    "PromptTemplate": "adapter.prompt",
+    "ModelRegistry": "adapter.registry",
+    "ModelInfo": "adapter.registry",
+    "ReplicaPool": "adapter.replicas",
+    "ReplicaError": "adapter.replicas",
+    "ResponseCache": "adapter.response_cache",
+    "RequestLog": "adapter.request_log",
+    "SessionStore": "adapter.sessions",
+    "SessionBusyError": "adapter.sessions",
+    "Baichuan2ChatCompletion": "adapter.services.baichuan2_chat_completion",
+    "ChatGLM2ChatCompletion": "adapter.services.chatglm2_chat_completion",
+    "QwenChatCompletion": "adapter.services.qwen_chat_completion",
+}
 
 
 __all__ = [
     "app",
-    "set_service_loader"
+    "set_service_loader",
+    "set_model_registry",
+    "set_inference_executor",
+    "set_response_cache",
+    "set_request_log",
+    "set_context_window",
+    "set_session_store",
+    "set_stream_coalescing",
+    "set_warm_up",
+    "set_admission_controller",
+    "AdmissionController",
+    "AdmissionRejected",
     "ChatBot",
+    "CancelToken",
+    "ContextWindow",
+    "ContextTrim",
+    "estimate_tokens",
+    "cancellation_stats",
     "ChatCompletion",
     "ChatMessage",
+    "GenerationParams",
+    "CompletionChoice",
+    "CompletionResult",
+    "CompletionDelta",
+    "CompletionUsage",
+    "EmbeddingResult",
+    "EmbeddingInputError",
+    "GenerationParamsError",
     "register_chat_completion_service",
+    "register_chat_completion_service_module",
     "create_chat_completion_service",
+    "chat_completion_service_names",
+    "InferenceExecutor",
+    "ExecutorFullError",
+    "ServiceLoad",
+    "load_stage",
+    "BatchingChatCompletion",
+    "BatchingEngine",
+    "BatchRunner",
+    "BatchStats",
+    "PrefixCache",
+    "EmbeddingBatcher",
+    "SpeculativeDecoding",
+    "PromptBuilder",
+    "PromptTemplate",
+    "ModelRegistry",
+    "ModelInfo",
+    "ReplicaPool",
+    "ReplicaError",
+    "ResponseCache",
+    "RequestLog",
+    "SessionStore",
+    "SessionBusyError",
     "Baichuan2ChatCompletion",
     "ChatGLM2ChatCompletion",
     "QwenChatCompletion",
 ]
+
+
+def __getattr__(name: str) -> Any:
+    module = _lazy_attrs.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> List[str]:
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,280 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Literal, Optional, Tuple
+
+
+Priority = Literal["high", "normal", "low"]
+PRIORITIES: Tuple[str, ...] = ("high", "normal", "low")
+
+
+class AdmissionRejected(Exception):
+    """a request turned away, retry_after is about the seconds until the queue has room for it"""
+    reason: str  # queue_full, deadline (would not start in time) or expired (did not start in time)
+    retry_after: int
+
+    def __init__(self, message: str, reason: str, retry_after: int) -> None:
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionTicket:
+    """the tokens of an admitted request, held until it is released"""
+    tenant: str
+    cost: int
+    _controller: "AdmissionController"
+    _released: bool
+
+    def __init__(self, controller: "AdmissionController", tenant: str, cost: int) -> None:
+        self._controller = controller
+        self.tenant = tenant
+        self.cost = cost
+        self._released = False
+
+    def release(self) -> None:
+        """returns the tokens, once; later calls do nothing"""
+        if not self._released:
+            self._released = True
+            self._controller._release(self)
+
+
+class _Waiter:
+    tenant: str
+    cost: int
+    future: "asyncio.Future[AdmissionTicket]"
+    removed: bool
+
+    def __init__(self, tenant: str, cost: int, future: "asyncio.Future[AdmissionTicket]") -> None:
+        self.tenant = tenant
+        self.cost = cost
+        self.future = future
+        self.removed = False
+
+
+class _FairQueue:
+    """
+    the waiters of one priority class in start-time fair queuing order: a request starts at the later
+    of the virtual time and the finish of its tenant's previous request, and finishes its cost later,
+    so that tenants take turns by tokens whatever they send
+    """
+    _heap: List[Tuple[float, int, _Waiter]]
+    _finish: Dict[str, float]  # tenant -> the finish tag of its last queued request
+    _vtime: float  # the start tag of the request admitted last
+    tokens: int
+    size: int
+
+    def __init__(self) -> None:
+        self._heap = []
+        self._finish = {}
+        self._vtime = 0.0
+        self.tokens = 0
+        self.size = 0
+
+    def push(self, waiter: _Waiter, seq: int) -> None:
+        start = max(self._vtime, self._finish.get(waiter.tenant, 0.0))
+        self._finish[waiter.tenant] = start + waiter.cost
+        heapq.heappush(self._heap, (start, seq, waiter))
+        self.tokens += waiter.cost
+        self.size += 1
+
+    def remove(self, waiter: _Waiter) -> None:
+        # left in the heap until it comes up
+        waiter.removed = True
+        self.tokens -= waiter.cost
+        self.size -= 1
+
+    def peek(self) -> Optional[_Waiter]:
+        while self._heap and self._heap[0][2].removed:
+            heapq.heappop(self._heap)
+        return self._heap[0][2] if self._heap else None
+
+    def pop(self) -> _Waiter:
+        start, _, waiter = heapq.heappop(self._heap)
+        self._vtime = start
+        self.tokens -= waiter.cost
+        self.size -= 1
+        if self.size == 0:
+            # a tenant whose finish is behind the virtual time starts at the virtual time anyway
+            self._finish = {tenant: finish for tenant,
+                            finish in self._finish.items() if finish > self._vtime}
+        return waiter
+
+
+class AdmissionController:
+    """
+    Admits requests by their estimated tokens, the prompt plus max_tokens of each choice, while the
+    admitted ones hold at most max_tokens; a request larger than that is admitted alone. The others
+    wait in a queue per priority class, high before normal before low, in which the tenants (the user
+    of a request) take turns by tokens (see _FairQueue), so that a tenant sending many or long requests
+    delays the others by no more than its share.
+
+    Overload is shed at once instead of by timeouts: a request is rejected when the tokens queued ahead
+    of it (of its class and the ones above) and its own would pass max_queue_tokens, or when the tokens
+    released in the last window_seconds tell that it would not be admitted within its deadline (the
+    default deadline unless the request sets one), and it is rejected when it still waits at its
+    deadline. Rejections tell from the same throughput when to retry. Used on the event loop only.
+
+    Prompts are counted by the tokenizer of the service, or by count_tokens when it is set, e.g.
+    estimate_tokens to spare the tokenizer.
+    """
+    _max_tokens: int
+    _max_queue_tokens: int
+    _deadline: float
+    _window_seconds: float
+    count_tokens: Optional[Callable[[str], int]]
+    _queues: List[_FairQueue]
+    _seq: "itertools.count[int]"
+    _in_flight: int
+    _running: int
+    _released: Deque[Tuple[float, int]]  # (time, tokens) of the releases in the window
+    _released_tokens: int
+    _admitted: int
+    _rejected: Dict[str, int]
+
+    def __init__(self, max_tokens: int, max_queue_tokens: Optional[int] = None, deadline: float = 30.0,
+                 window_seconds: float = 30.0, count_tokens: Optional[Callable[[str], int]] = None) -> None:
+        assert max_tokens > 0, f"invalid max_tokens: {max_tokens}"
+        assert max_queue_tokens is None or max_queue_tokens > 0, f"invalid max_queue_tokens: {max_queue_tokens}"
+        assert deadline > 0, f"invalid deadline: {deadline}"
+        assert window_seconds > 0, f"invalid window_seconds: {window_seconds}"
+        self._max_tokens = max_tokens
+        self._max_queue_tokens = max_queue_tokens if max_queue_tokens is not None else max_tokens * 4
+        self._deadline = deadline
+        self._window_seconds = window_seconds
+        self.count_tokens = count_tokens
+        self._queues = [_FairQueue() for _ in PRIORITIES]
+        self._seq = itertools.count()
+        self._in_flight = 0
+        self._running = 0
+        self._released = deque()
+        self._released_tokens = 0
+        self._admitted = 0
+        self._rejected = {"queue_full": 0, "deadline": 0, "expired": 0}
+
+    @property
+    def max_tokens(self) -> int:
+        return self._max_tokens
+
+    @property
+    def max_queue_tokens(self) -> int:
+        return self._max_queue_tokens
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        """the tokens released per second in the window, None before the first release"""
+        now = time.monotonic()
+        while self._released and self._released[0][0] < now - self._window_seconds:
+            self._released_tokens -= self._released.popleft()[1]
+        if not self._released:
+            return None
+        return self._released_tokens / max(now - self._released[0][0], 1.0)
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        stats: Dict[str, float] = {
+            "in_flight_tokens": self._in_flight,
+            "in_flight_requests": self._running,
+            "queued_tokens": sum(queue.tokens for queue in self._queues),
+            "queued_requests": sum(queue.size for queue in self._queues),
+            "admitted": self._admitted,
+            "tokens_per_second": self.tokens_per_second or 0.0,
+        }
+        for priority, queue in zip(PRIORITIES, self._queues):
+            stats[f"{priority}_queued_tokens"] = queue.tokens
+        for reason, count in self._rejected.items():
+            stats[f"rejected_{reason}"] = count
+        return stats
+
+    def _fits(self, cost: int) -> bool:
+        return self._in_flight == 0 or self._in_flight + cost <= self._max_tokens
+
+    def _wait_seconds(self, tokens: int) -> Optional[float]:
+        """about how long releasing tokens takes, None while the throughput is unknown"""
+        rate = self.tokens_per_second
+        if rate is None or rate <= 0:
+            return None
+        return tokens / rate
+
+    def _reject(self, reason: str, message: str, tokens: int) -> AdmissionRejected:
+        self._rejected[reason] += 1
+        wait = self._wait_seconds(tokens)
+        retry_after = min(max(math.ceil(wait), 1), 60) if wait is not None else 1
+        return AdmissionRejected(message, reason, retry_after)
+
+    def _admit(self, tenant: str, cost: int) -> AdmissionTicket:
+        self._in_flight += cost
+        self._running += 1
+        self._admitted += 1
+        return AdmissionTicket(self, tenant, cost)
+
+    def _dispatch(self) -> None:
+        for queue in self._queues:
+            while True:
+                waiter = queue.peek()
+                if waiter is None:
+                    break
+                # the head waits for room, nothing behind it or below its class goes first
+                if not self._fits(waiter.cost):
+                    return
+                queue.pop()
+                waiter.future.set_result(self._admit(waiter.tenant, waiter.cost))
+
+    def _release(self, ticket: AdmissionTicket) -> None:
+        self._in_flight -= ticket.cost
+        self._running -= 1
+        self._released.append((time.monotonic(), ticket.cost))
+        self._released_tokens += ticket.cost
+        self._dispatch()
+
+    async def acquire(self, tenant: str, cost: int, priority: Priority = "normal",
+                      deadline: Optional[float] = None) -> AdmissionTicket:
+        """
+        waits until cost tokens of tenant are admitted, for at most deadline seconds, or raises
+        AdmissionRejected; the returned ticket has to be released when the request ends
+        """
+        assert priority in PRIORITIES, f"invalid priority: {priority}"
+        assert cost > 0, f"invalid cost: {cost}"
+        assert deadline is None or deadline > 0, f"invalid deadline: {deadline}"
+        if deadline is None:
+            deadline = self._deadline
+        level = PRIORITIES.index(priority)
+        queues = self._queues[:level + 1]
+        if all(queue.size == 0 for queue in queues) and self._fits(cost):
+            return self._admit(tenant, cost)
+
+        ahead = sum(queue.tokens for queue in queues)
+        # the tokens to be released before this request fits
+        needed = ahead + max(self._in_flight + cost - self._max_tokens, 0)
+        if ahead > 0 and ahead + cost > self._max_queue_tokens:
+            raise self._reject("queue_full", f"admission queue is full ({ahead} tokens ahead)", needed)
+        wait = self._wait_seconds(needed)
+        if wait is not None and wait > deadline:
+            raise self._reject("deadline", f"request would not be admitted within {deadline:g}s "
+                               f"(about {wait:.1f}s for {needed} tokens ahead)", needed)
+
+        queue = self._queues[level]
+        waiter = _Waiter(tenant, cost, asyncio.get_running_loop().create_future())
+        queue.push(waiter, next(self._seq))
+        try:
+            return await asyncio.wait_for(asyncio.shield(waiter.future), deadline)
+        except asyncio.TimeoutError:
+            if waiter.future.done():
+                # admitted as the deadline passed
+                return waiter.future.result()
+            queue.remove(waiter)
+            # the head leaving may make room for the ones behind it
+            self._dispatch()
+            raise self._reject("expired", f"request was not admitted within {deadline:g}s",
+                               sum(queue.tokens for queue in queues) + cost) from None
+        except asyncio.CancelledError:
+            # the client went away
+            if waiter.future.done():
+                waiter.future.result().release()
+            else:
+                queue.remove(waiter)
+                self._dispatch()
+            raise
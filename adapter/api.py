@@ -1,143 +1,270 @@
+import array
+import asyncio
+import base64
+import math
+import sys
 import time
 from typing import List, Optional
-from typing import Any, Dict, List, Iterator, Optional, Union, Callable, Literal
-from pydantic import BaseModel
-import torch
+from typing import Any, AsyncIterator, Awaitable, Dict, Iterator, List, Optional, Sequence, Tuple, Union, Callable, Literal
 from contextlib import asynccontextmanager
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
 from sse_starlette.sse import EventSourceResponse
-from adapter.chat_completion import ChatCompletion, ChatMessage
-
-
-class ChatCompletionFunctionCall(BaseModel):
-    name: str
-    arguments: str  # Arguments in JSON format
-
-
-class ChatCompletionMessage(BaseModel):
-    role: Literal["system", "user", "assistant", "function"]
-    content: Optional[str] = None  # content can be a string or null
-    name: Optional[str] = None
-    function_call: Optional[ChatCompletionFunctionCall] = None
+from adapter.admission import PRIORITIES, AdmissionController, AdmissionRejected, AdmissionTicket
+from adapter.cancel import CancelToken, cancellation_stats
+from adapter.chat_completion import ChatCompletion, ChatMessage, CompletionDelta, CompletionResult, CompletionUsage, EmbeddingInput, EmbeddingInputError, GenerationParams, GenerationParamsError, Prompt
+from adapter.context import ContextTrim, ContextWindow
+from adapter.executor import InferenceExecutor, ExecutorFullError
+from adapter.loading import ServiceLoad
+from adapter.metrics import MetricsRegistry, exponential_buckets
+from adapter.protocol import (
+    build_chat_compl_context,
+    build_chat_compl_resp_from_result,
+    build_generation_params,
+    ChatCompletionFunctionCall,
+    ChatCompletionMessage,
+    ChatCompletionFunctionParam,
+    ChatCompletionFunction,
+    ChatCompletionStreamOptions,
+    ChatCompletionRequest,
+    ChatCompletionChoice,
+    ChatCompletionUsage,
+    ChatCompletionContext,
+    ChatCompletionResponse,
+    ChatCompletionMessageRoleOnly,
+    ChatCompletionMessageContentOnly,
+    ChatCompletionMessageEmpty,
+    ChatCompletionChoiceDelta,
+    ChatCompletionStreamingResponse,
+    ChatCompletionStreamingUsageResponse,
+    Model,
+    ModelsResponse,
+    EmbeddingRequest,
+    Embedding,
+    EmbeddingUsage,
+    EmbeddingResponse,
+    SessionCreateRequest,
+    SessionResponse,
+    SessionDeleteResponse,
+    TextCompletionRequest,
+    TextCompletionChoice,
+    TextCompletionResponse,
+    HealthResponse,
+)
+from adapter.registry import ModelRegistry
+from adapter.request_log import RequestLog
+from adapter.response_cache import ResponseCache, cache_key, replay_stream
+from adapter.sessions import Session, SessionBusyError, SessionStore
+from adapter.sse import ChunkEncoder, ClosingEventSourceResponse, TextChunkEncoder, coalesce
 
 
-class ChatCompletionFunctionParam(BaseModel):
-    type: str
-    properties: Dict[str, Any]
-    required: Optional[List[str]]
+_service_loader: Callable[[], ChatCompletion] = None
+_service_load: ServiceLoad = None
+_warm_up_prompt_tokens: List[int] = []
+_warm_up_max_tokens: int = 8
+_warm_up_concurrency: int = 1
+_registry: ModelRegistry = None
+_executor: InferenceExecutor = None
+_response_cache: ResponseCache = None
+_request_log: RequestLog = None
+_context_window: ContextWindow = None
+_session_store: SessionStore = None
+_admission: AdmissionController = None
+_stream_coalesce_tokens: int = 1
+_stream_coalesce_ms: float = 0
 
 
-class ChatCompletionFunction(BaseModel):
-    name: str
-    description: Optional[str]
-    parameters: Union[ChatCompletionFunctionParam, Any]  # JSON Schema object
+def _device_memory() -> Dict[Tuple[str, ...], float]:
+    torch = sys.modules.get("torch")
+    if torch is None or not torch.cuda.is_available():
+        return {}
+    return {(f"cuda:{i}",): torch.cuda.memory_allocated(i) for i in range(torch.cuda.device_count())}
 
 
-class ChatCompletionRequest(BaseModel):
-    """
-    see https://platform.openai.com/docs/api-reference/chat/create
-    """
-    model: str
-    messages: List[ChatCompletionMessage]
-    functions: Optional[List[ChatCompletionFunction]] = None
-    function_call: Optional[str] = None
-    temperature: Optional[float] = 1.0  # defaults to 1.0
-    top_p: Optional[float] = 1.0  # defaults to 1.0
-    n: Optional[int] = 1  # defaults to 1
-    stream: Optional[bool] = False  # defaults to False
-    stop: Optional[Union[str, list]] = None  # defaults to None
-    max_tokens: Optional[int] = 4096  # defaults to inf
-    presence_penalty: Optional[float] = 0  # defaults to 0
-    frequency_penalty: Optional[float] = 0  # defaults to 0
-    logit_bias: Optional[Dict[int, int]] = None  # defaults to None
-    user: Optional[str] = None
+def _response_cache_stat(name: str) -> Callable[[], float]:
+    return lambda: _response_cache.stats[name] if _response_cache is not None else 0
 
 
-class ChatCompletionChoice(BaseModel):
-    index: int
-    message: ChatCompletionMessage
-    finish_reason: str
+def _admission_stat(name: str) -> Callable[[], float]:
+    return lambda: _admission.stats[name] if _admission is not None else 0
 
 
-class ChatCompletionUsage(BaseModel):
-    prompt_tokens: int
-    completion_tokens: int
-    total_tokens: int
+metrics = MetricsRegistry()
+_requests_total = metrics.counter(
+    "adapter_requests_total", "chat and text completion requests", ["service", "stream"])
+_requests_in_flight = metrics.gauge(
+    "adapter_requests_in_flight", "chat and text completion requests being answered")
+_time_to_first_token = metrics.histogram(
+    "adapter_time_to_first_token_seconds", "time from the request to its first streamed text",
+    ["service"], exponential_buckets(0.01, 2, 14))
+_inter_token_latency = metrics.histogram(
+    "adapter_inter_token_latency_seconds", "time between streamed text deltas",
+    ["service"], exponential_buckets(0.001, 2, 14))
+_request_duration = metrics.histogram(
+    "adapter_request_duration_seconds", "time from the request to its last token",
+    ["service"], exponential_buckets(0.05, 2, 14))
+_prompt_tokens = metrics.histogram(
+    "adapter_prompt_tokens", "prompt tokens per request", ["service"], exponential_buckets(8, 2, 12))
+_completion_tokens = metrics.histogram(
+    "adapter_completion_tokens", "completion tokens per request", ["service"], exponential_buckets(1, 2, 13))
+_tokens_per_second = metrics.histogram(
+    "adapter_completion_tokens_per_second", "completion tokens per second of request duration",
+    ["service"], exponential_buckets(1, 2, 12))
+metrics.gauge("adapter_executor_queue_depth", "inference calls waiting for a worker",
+              function=lambda: _executor.queue_depth if _executor is not None else 0)
+metrics.gauge("adapter_executor_running", "inference calls running on a worker",
+              function=lambda: _executor.running if _executor is not None else 0)
+metrics.gauge("adapter_device_memory_bytes", "memory allocated by torch on each cuda device",
+              ["device"], function=_device_memory)
+metrics.counter("adapter_cancelled_generations_total", "generations cancelled before their end",
+                function=lambda: cancellation_stats()["cancelled_generations"])
+metrics.counter("adapter_avoided_tokens_total", "token budget left unused by cancelled generations",
+                function=lambda: cancellation_stats()["avoided_tokens"])
+metrics.gauge("adapter_ready", "1 once the service is loaded and warmed up",
+              function=lambda: 1 if _registry is not None or (_service_load is not None and _service_load.ready) else 0)
+metrics.gauge("adapter_load_stage_seconds", "seconds of each stage of loading the service", ["stage"],
+              function=lambda: {(name,): seconds for name, seconds in _service_load.stages.items()}
+              if _service_load is not None else {})
+metrics.gauge("adapter_admission_in_flight_tokens", "estimated tokens of the requests admitted",
+              function=_admission_stat("in_flight_tokens"))
+metrics.gauge("adapter_admission_queued_tokens", "estimated tokens of the requests waiting for admission",
+              ["priority"], function=lambda: {(priority,): _admission.stats[f"{priority}_queued_tokens"]
+                                              for priority in PRIORITIES} if _admission is not None else {})
+metrics.counter("adapter_admission_rejected_total", "requests turned away with 429 by admission control",
+                ["reason"], function=lambda: {(reason,): _admission.stats[f"rejected_{reason}"]
+                                              for reason in ("queue_full", "deadline", "expired")}
+                if _admission is not None else {})
+metrics.counter("adapter_response_cache_hits_total", "requests answered from the response cache",
+                function=_response_cache_stat("hits"))
+metrics.counter("adapter_response_cache_misses_total", "cacheable requests missing the response cache",
+                function=_response_cache_stat("misses"))
 
 
-class ChatCompletionResponse(BaseModel):
-    id: str
-    object: Literal["chat.completion"] = "chat.completion"
-    created: int
-    model: str
-    choices: List[ChatCompletionChoice]
-    usage: ChatCompletionUsage
+def set_service_loader(loader: Callable[[], ChatCompletion]) -> None:
+    assert isinstance(
+        loader, Callable), f"invalid service_loader: {loader}"
+    global _service_loader
+    _service_loader = loader
 
 
-class ChatCompletionMessageRoleOnly(BaseModel):
-    role: Literal["assistant", "function"]
+def set_model_registry(registry: ModelRegistry) -> None:
+    """
+    serves the models of registry by the model field of requests, instead of the single service of the service loader
+    """
+    assert isinstance(
+        registry, ModelRegistry), f"invalid model registry: {registry}"
+    global _registry
+    _registry = registry
 
 
-class ChatCompletionMessageContentOnly(BaseModel):
-    content: Optional[str] = None  # content can be a string or null
+def set_response_cache(cache: Optional[ResponseCache]) -> None:
+    """answers repeated deterministic requests from cache, None turns caching off"""
+    assert cache is None or isinstance(
+        cache, ResponseCache), f"invalid response cache: {cache}"
+    global _response_cache
+    _response_cache = cache
 
 
-class ChatCompletionMessageEmpty(BaseModel):
-    pass
+def set_request_log(log: Optional[RequestLog]) -> None:
+    """logs a record per request to log, None turns request logging off"""
+    assert log is None or isinstance(
+        log, RequestLog), f"invalid request log: {log}"
+    global _request_log
+    _request_log = log
 
 
-class ChatCompletionChoiceDelta(BaseModel):
-    index: int
-    delta: Union[ChatCompletionMessageRoleOnly,
-                 ChatCompletionMessageContentOnly, ChatCompletionMessageEmpty]
-    finish_reason: Optional[str]
+def set_context_window(window: Optional[ContextWindow]) -> None:
+    """trims the messages of each request to window, None forwards them as they are"""
+    assert window is None or isinstance(
+        window, ContextWindow), f"invalid context window: {window}"
+    global _context_window
+    _context_window = window
 
 
-class ChatCompletionStreamingResponse(BaseModel):
-    id: str
-    object: Literal["chat.completion.chunk"] = "chat.completion.chunk"
-    created: int
-    model: str
-    choices: List[ChatCompletionChoiceDelta]
+def set_session_store(store: Optional[SessionStore]) -> None:
+    """keeps conversations under /v1/sessions in store, None turns the session API off"""
+    assert store is None or isinstance(
+        store, SessionStore), f"invalid session store: {store}"
+    global _session_store
+    _session_store = store
 
 
-class Model(BaseModel):
-    id: str
-    object: Literal["model"] = "model"
-    created: int
-    owned_by: str
+def set_admission_controller(controller: Optional[AdmissionController]) -> None:
+    """
+    admits chat and text completion requests by estimated tokens through controller, None lets them
+    all in as they come
+    """
+    assert controller is None or isinstance(
+        controller, AdmissionController), f"invalid admission controller: {controller}"
+    global _admission
+    _admission = controller
 
 
-class ModelsResponse(BaseModel):
-    object: Literal["list"] = "list"
-    data: List[Model]
+def set_warm_up(prompt_tokens: Sequence[int] = (32, 512), max_new_tokens: int = 8, concurrency: int = 1) -> None:
+    """
+    before the service reports ready, runs greedy prompts of about each of prompt_tokens tokens,
+    concurrency at a time; empty prompt_tokens turns the warm-up off
+    """
+    assert all(tokens > 0 for tokens in prompt_tokens), f"invalid prompt_tokens: {prompt_tokens}"
+    assert max_new_tokens > 0, f"invalid max_new_tokens: {max_new_tokens}"
+    assert concurrency > 0, f"invalid concurrency: {concurrency}"
+    global _warm_up_prompt_tokens, _warm_up_max_tokens, _warm_up_concurrency
+    _warm_up_prompt_tokens = list(prompt_tokens)
+    _warm_up_max_tokens = max_new_tokens
+    _warm_up_concurrency = concurrency
 
 
-_service: ChatCompletion = None
-_service_loader: Callable[[], ChatCompletion] = None
+def set_inference_executor(executor: InferenceExecutor) -> None:
+    assert isinstance(
+        executor, InferenceExecutor), f"invalid inference executor: {executor}"
+    global _executor
+    _executor = executor
 
 
-def set_service_loader(loader: Callable[[], ChatCompletion]) -> None:
-    assert isinstance(
-        loader, Callable), f"invalid service_loader: {loader}"
-    global _service_loader
-    _service_loader = loader
+def set_stream_coalescing(max_tokens: int = 1, max_delay_ms: float = 0) -> None:
+    """
+    merges the deltas of a stream into one event per max_tokens deltas or per max_delay_ms,
+    the default sends one event per delta
+    """
+    assert max_tokens > 0, f"invalid max_tokens: {max_tokens}"
+    assert max_delay_ms >= 0, f"invalid max_delay_ms: {max_delay_ms}"
+    global _stream_coalesce_tokens, _stream_coalesce_ms
+    _stream_coalesce_tokens = max_tokens
+    _stream_coalesce_ms = max_delay_ms
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global _service
-    assert isinstance(
-        _service_loader, Callable), f"set service loader by calling set_service_loader(<loader>) first"
-    _service = _service_loader()
-    assert isinstance(
-        _service, ChatCompletion), f"service_loader() return invalid serivce: {_service}"
+    global _service_load, _executor
+    if _registry is None:
+        assert isinstance(
+            _service_loader, Callable), f"set service loader by calling set_service_loader(<loader>) or set_model_registry(<registry>) first"
+        # the server takes connections while the service loads, /health/ready tells when it is done
+        _service_load = ServiceLoad(
+            _service_loader, _warm_up_prompt_tokens, _warm_up_max_tokens, _warm_up_concurrency)
+        _service_load.start()
+    if _executor is None:
+        _executor = InferenceExecutor()
 
     yield
 
-    # collects GPU memory
-    if torch.cuda.is_available():
+    _executor.shutdown(wait=False)
+    if _registry is not None:
+        _registry.close()
+    else:
+        # a service still loading is closed once it is loaded
+        _service_load.close()
+    if _response_cache is not None:
+        _response_cache.close()
+    if _request_log is not None:
+        _request_log.close()
+    if _session_store is not None:
+        _session_store.close()
+
+    # collects GPU memory, if a service did load torch
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
         torch.cuda.empty_cache()
         torch.cuda.ipc_collect()
 
@@ -155,15 +282,28 @@ app.add_middleware(
 _cur_req_id: int = 1000
 
 
-def gen_req_id() -> str:
+def gen_req_id(prefix: str = "chatcmpl") -> str:
     global _cur_req_id
     id = _cur_req_id
     _cur_req_id += 1
-    return f"chatcmpl-{id}"
+    return f"{prefix}-{id}"
+
+
+_model_created: int = int(time.time())
 
 
 @app.get("/v1/models")
 async def models() -> ModelsResponse:
+    if _registry is not None:
+        return ModelsResponse(
+            data=[Model(
+                id=info.name,
+                created=_model_created,
+                owned_by=info.owned_by,
+                loaded=info.loaded,
+            ) for info in _registry.models()],
+        )
+
     rsp = ModelsResponse(
         data=[
             Model(
@@ -176,93 +316,737 @@ async def models() -> ModelsResponse:
     return rsp
 
 
-def build_chat_compl_resp(id: str, model: str, messages) -> ChatCompletionResponse:
-    completion = _service.chat(messages)
-    print(completion)
+async def get_service(model: str) -> ChatCompletion:
+    """the service of a model, models of the registry load on their first request"""
+    if _registry is None:
+        if _service_load is None:
+            # the lifespan of the app did not run (yet)
+            raise HTTPException(status_code=503, detail="service is not started", headers={"Retry-After": "5"})
+        if not _service_load.ready:
+            raise HTTPException(status_code=503, detail=f"service is {_service_load.state.replace('_', ' ')}",
+                                headers={"Retry-After": "5"})
+        return _service_load.service
+    service = _registry.get_loaded(model)
+    if service is not None:
+        return service
+    if model not in _registry:
+        raise HTTPException(
+            status_code=404, detail=f"model not found: {model}")
+    # loading takes long, it runs beside the inference workers
+    return await asyncio.get_running_loop().run_in_executor(None, _registry.get, model)
 
-    prompt_tokens = _service.num_tokens_from_messages(messages)
-    completion_tokens = _service.num_tokens(completion)
-    total_tokens = prompt_tokens+completion_tokens
 
-    rsp = ChatCompletionResponse(
-        id=id,
-        created=int(time.time()),
-        model=model,
-        choices=[ChatCompletionChoice(
-            index=0,
-            message=ChatCompletionMessage(
-                role="assistant",
-                content=completion,
-            ),
-            finish_reason="stop",
-        )],
-        usage=ChatCompletionUsage(
-            prompt_tokens=prompt_tokens,
-            completion_tokens=completion_tokens,
-            total_tokens=total_tokens,
-        ),
-    )
-    return rsp
+async def admit(req: Union[ChatCompletionRequest, TextCompletionRequest], tokens: int) -> AdmissionTicket:
+    """waits until the admission controller admits the estimated tokens of req, or answers 429"""
+    if req.deadline_ms is not None and req.deadline_ms <= 0:
+        raise HTTPException(
+            status_code=400, detail=f"invalid deadline_ms: {req.deadline_ms}")
+    try:
+        # requests without a user share a tenant
+        return await _admission.acquire(req.user or "", max(tokens, 1), req.priority or "normal",
+                                        req.deadline_ms / 1000 if req.deadline_ms is not None else None)
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={
+                            "Retry-After": str(e.retry_after)})
 
 
-def build_chat_compl_streaming_resp(id: str, model: str, messages) -> Iterator[str]:
-    completion_gen = _service.chat_stream(messages)
-    rsp = ChatCompletionStreamingResponse(
-        id=id,
-        created=int(time.time()),
-        model=model,
-        choices=[ChatCompletionChoiceDelta(
-            index=0,
-            delta=ChatCompletionMessageRoleOnly(
-                role="assistant",
-            ),
-            finish_reason=None,
-        )],
-    )
-    yield rsp.model_dump_json()
-
-    for delta_compl in completion_gen:
-        print(delta_compl, end="", flush=True)
-        if delta_compl != "":
-            delta = ChatCompletionMessageContentOnly(
-                content=delta_compl,
-            )
+def count_admission_tokens(service: ChatCompletion, messages: List[ChatMessage]) -> int:
+    """the prompt tokens of messages, by the tokenizer of service unless the admission controller counts"""
+    if _admission.count_tokens is not None:
+        return sum(_admission.count_tokens(message.content) for message in messages)
+    return service.num_prompt_tokens(messages)
+
+
+def count_admission_prompt_tokens(service: ChatCompletion, prompts: List[Prompt]) -> int:
+    """the tokens of raw prompts, which are either texts or token ids"""
+    tokens = 0
+    for prompt in prompts:
+        if not isinstance(prompt, str):
+            tokens += len(prompt)
+        elif _admission.count_tokens is not None:
+            tokens += _admission.count_tokens(prompt)
         else:
-            delta = ChatCompletionMessageEmpty()
-
-        rsp = ChatCompletionStreamingResponse(
-            id=id,
-            created=int(time.time()),
-            model=model,
-            choices=[ChatCompletionChoiceDelta(
-                index=0,
-                delta=delta,
-                finish_reason=None,
-            )],
-        )
-        yield rsp.model_dump_json()
-    print()
+            tokens += service.num_tokens(prompt)
+    return tokens
+
+
+def build_chat_compl_context_headers(trim: Optional[ContextTrim]) -> Dict[str, str]:
+    """a stream has no response body to carry the context, it is sent as headers"""
+    if trim is None:
+        return {}
+    return {
+        "X-Context-Strategy": trim.strategy,
+        "X-Context-Original-Tokens": str(trim.original_tokens),
+        "X-Context-Prompt-Tokens": str(trim.prompt_tokens),
+        "X-Context-Dropped-Messages": str(trim.dropped_messages),
+        "X-Context-Summarized": "true" if trim.summarized else "false",
+    }
+
+
+def build_chat_compl_resp(service: ChatCompletion, id: str, model: str, messages: List[ChatMessage],
+                          params: GenerationParams, key: Optional[str] = None,
+                          trim: Optional[ContextTrim] = None) -> ChatCompletionResponse:
+    result = service.complete(messages, params)
+    if key is not None:
+        _response_cache.put(key, result)
+    return build_chat_compl_resp_from_result(id, model, result, trim)
+
+
+def encode_chat_compl_deltas(encoder: ChunkEncoder, items: List[Union[CompletionDelta, CompletionUsage]],
+                             include_usage: bool) -> List[str]:
+    """merges the deltas of each choice into one chunk"""
+    texts: Dict[int, List[str]] = {}
+    finish_reasons: Dict[int, str] = {}
+    chunks: List[str] = []
+    usage: Optional[CompletionUsage] = None
+    for item in items:
+        if isinstance(item, CompletionUsage):
+            usage = item
+            continue
+        texts.setdefault(item.index, []).append(item.text)
+        if item.finish_reason is not None:
+            finish_reasons[item.index] = item.finish_reason
+    for index, parts in texts.items():
+        text = "".join(parts)
+        if text != "":
+            chunks.append(encoder.content(index, text))
+        if index in finish_reasons:
+            chunks.append(encoder.finish(index, finish_reasons[index]))
+    if usage is not None and include_usage:
+        chunks.append(encoder.usage(
+            usage.prompt_tokens, usage.completion_tokens))
+    return chunks
+
+
+def complete_stream_cached(service: ChatCompletion, key: str, messages: List[ChatMessage], params: GenerationParams,
+                           cancel_token: CancelToken) -> Iterator[Union[CompletionDelta, CompletionUsage]]:
+    return _response_cache.record(key, service.complete_stream(messages, params, cancel_token))
+
+
+async def replay_chat_compl(result: CompletionResult) -> AsyncIterator[Union[CompletionDelta, CompletionUsage]]:
+    for item in replay_stream(result):
+        yield item
+
+
+def observe_chat_compl(service_label: str, start: float, prompt_tokens: int, completion_tokens: int) -> None:
+    duration = time.perf_counter() - start
+    _request_duration.labels(service_label).observe(duration)
+    _prompt_tokens.labels(service_label).observe(prompt_tokens)
+    _completion_tokens.labels(service_label).observe(completion_tokens)
+    if duration > 0:
+        _tokens_per_second.labels(service_label).observe(
+            completion_tokens / duration)
+
+
+async def observe_chat_compl_stream(service_label: str, start: float,
+                                    completion_gen: AsyncIterator[Union[CompletionDelta, CompletionUsage]]) -> AsyncIterator[Union[CompletionDelta, CompletionUsage]]:
+    """passes a stream through, observing its time to first token and the time between its deltas"""
+    time_to_first_token = _time_to_first_token.labels(service_label)
+    inter_token_latency = _inter_token_latency.labels(service_label)
+    last: Optional[float] = None
+    async for item in completion_gen:
+        if isinstance(item, CompletionUsage):
+            observe_chat_compl(service_label, start,
+                               item.prompt_tokens, item.completion_tokens)
+        elif item.text != "":
+            now = time.perf_counter()
+            if last is None:
+                time_to_first_token.observe(now - start)
+            else:
+                inter_token_latency.observe(now - last)
+            last = now
+        yield item
+
+
+def num_choices(req: Union[ChatCompletionRequest, TextCompletionRequest]) -> int:
+    """the choices of a request, n per prompt for text completions"""
+    if isinstance(req, TextCompletionRequest):
+        return len(build_input_list(req.prompt)) * (req.n or 1)
+    return req.n or 1
+
+
+def log_chat_compl(id: str, req: Union[ChatCompletionRequest, TextCompletionRequest], start: float, status: int,
+                   usage: Optional[CompletionUsage] = None, finish_reasons: Optional[List[Optional[str]]] = None,
+                   texts: Optional[List[str]] = None, time_to_first_token: Optional[float] = None,
+                   cached: bool = False, error: Optional[str] = None, sampled: bool = True) -> None:
+    fields: Dict[str, Any] = {
+        "id": id,
+        "model": req.model,
+        "user": req.user,
+        "stream": bool(req.stream),
+    }
+    if isinstance(req, TextCompletionRequest):
+        fields["prompts"] = len(build_input_list(req.prompt))
+    else:
+        fields["messages"] = len(req.messages)
+    fields["status"] = status
+    fields["duration"] = round(time.perf_counter() - start, 6)
+    if usage is not None:
+        fields["prompt_tokens"] = usage.prompt_tokens
+        fields["completion_tokens"] = usage.completion_tokens
+    if finish_reasons is not None:
+        fields["finish_reasons"] = finish_reasons
+    if time_to_first_token is not None:
+        fields["time_to_first_token"] = round(time_to_first_token, 6)
+    if cached:
+        fields["cached"] = True
+    if error is not None:
+        fields["error"] = error
+    content: Optional[Dict[str, Any]] = None
+    if _request_log.log_content:
+        if isinstance(req, TextCompletionRequest):
+            content = {"prompts": build_input_list(req.prompt)}
+        else:
+            content = {"messages": [
+                {"role": message.role, "content": message.content} for message in req.messages]}
+        if texts is not None:
+            content["completions"] = texts
+    _request_log.record(fields, content, sampled)
+
+
+async def log_chat_compl_stream(id: str, req: Union[ChatCompletionRequest, TextCompletionRequest], start: float,
+                                completion_gen: AsyncIterator[Union[CompletionDelta, CompletionUsage]],
+                                cached: bool = False, sampled: bool = True) -> AsyncIterator[Union[CompletionDelta, CompletionUsage]]:
+    """passes a stream through, logging it once it ends, if it was sampled or failed"""
+    # the texts are only kept when they are logged
+    texts: Optional[Dict[int, List[str]]] = {
+    } if _request_log.log_content else None
+    finish_reasons: Dict[int, str] = {}
+    usage: Optional[CompletionUsage] = None
+    time_to_first_token: Optional[float] = None
+    status = 499  # the client went away before the end, which is only logged if sampled
+    error: Optional[str] = None
+    try:
+        async for item in completion_gen:
+            if isinstance(item, CompletionUsage):
+                usage = item
+            else:
+                if time_to_first_token is None and item.text != "":
+                    time_to_first_token = time.perf_counter() - start
+                if texts is not None:
+                    texts.setdefault(item.index, []).append(item.text)
+                if item.finish_reason is not None:
+                    finish_reasons[item.index] = item.finish_reason
+            yield item
+        status = 200
+    except Exception as e:
+        status = 500
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        n = num_choices(req)
+        log_chat_compl(id, req, start, status, usage,
+                       [finish_reasons.get(index) for index in range(n)],
+                       ["".join(texts.get(index, [])) for index in range(n)
+                        ] if texts is not None else None,
+                       time_to_first_token, cached, error, sampled)
+
+
+async def build_chat_compl_streaming_resp(id: str, model: str, n: int, include_usage: bool,
+                                          completion_gen: AsyncIterator[Union[CompletionDelta, CompletionUsage]],
+                                          cancel_token: CancelToken,
+                                          encoder: Optional[ChunkEncoder] = None) -> AsyncIterator[str]:
+    try:
+        async for chunk in _build_chat_compl_streaming_resp(id, model, n, include_usage, completion_gen, encoder):
+            yield chunk
+    finally:
+        # a dropped connection stops the response early, the generation behind it stops too
+        cancel_token.cancel()
+
+
+async def _build_chat_compl_streaming_resp(id: str, model: str, n: int, include_usage: bool,
+                                           completion_gen: AsyncIterator[Union[CompletionDelta, CompletionUsage]],
+                                           encoder: Optional[ChunkEncoder] = None) -> AsyncIterator[str]:
+    """the chunks of a stream, starting with the roles of n choices"""
+    if encoder is None:
+        encoder = ChunkEncoder(id, model, int(time.time()))
+    for index in range(n):
+        yield encoder.role(index)
+
+    if _stream_coalesce_tokens > 1 or _stream_coalesce_ms > 0:
+        async for items in coalesce(completion_gen, _stream_coalesce_tokens, _stream_coalesce_ms):
+            for chunk in encode_chat_compl_deltas(encoder, items, include_usage):
+                yield chunk
+        yield "[DONE]"
+        return
+
+    async for delta_compl in completion_gen:
+        if isinstance(delta_compl, CompletionUsage):
+            if include_usage:
+                yield encoder.usage(delta_compl.prompt_tokens, delta_compl.completion_tokens)
+            continue
+        if delta_compl.text != "":
+            yield encoder.content(delta_compl.index, delta_compl.text)
+        elif delta_compl.finish_reason is None:
+            yield encoder.empty(delta_compl.index)
+        if delta_compl.finish_reason is not None:
+            yield encoder.finish(delta_compl.index, delta_compl.finish_reason)
     yield "[DONE]"
 
 
+def build_session_release(session: Session) -> Callable[[Optional[List[ChatMessage]]], None]:
+    """
+    ends the turn of session once, whichever comes first of the stream of the turn and the end of
+    its response (which is all there is when the stream never started)
+    """
+    released = False
+
+    def release(messages: Optional[List[ChatMessage]] = None) -> None:
+        nonlocal released
+        if not released:
+            released = True
+            _session_store.release(session, messages)
+    return release
+
+
+async def record_session_stream(release: Callable[[Optional[List[ChatMessage]]], None], messages: List[ChatMessage],
+                                completion_gen: AsyncIterator[Union[CompletionDelta, CompletionUsage]]) -> AsyncIterator[Union[CompletionDelta, CompletionUsage]]:
+    """passes a stream through, adding its first choice to the session of release once it ends"""
+    texts: List[str] = []
+    completed = False
+    try:
+        async for item in completion_gen:
+            if isinstance(item, CompletionDelta) and item.index == 0:
+                texts.append(item.text)
+            yield item
+        completed = True
+    finally:
+        # a turn that did not finish leaves the session as it was
+        release(messages + [ChatMessage(role="assistant", content="".join(texts))] if completed else None)
+
+
 @app.post("/v1/chat/completions")
 async def chat_completions(req: ChatCompletionRequest) -> Union[ChatCompletionResponse, str]:
+    return await serve_chat_completions(req)
+
+
+async def serve_chat_completions(req: ChatCompletionRequest,
+                                 session: Optional[Session] = None) -> Union[ChatCompletionResponse, EventSourceResponse]:
     id = gen_req_id()
+    return await serve_logged(id, req, lambda start, sampled: _chat_completions(req, id, start, sampled, session))
+
+
+async def serve_logged(id: str, req: Union[ChatCompletionRequest, TextCompletionRequest],
+                       serve: Callable[[float, bool], Awaitable[Any]]) -> Any:
+    """
+    answers req with serve(start, sampled), counting it in flight from its arrival until its response
+    ends, and logging its failures whether sampled or not
+    """
+    start = time.perf_counter()
+    sampled = _request_log is not None and _request_log.sample()
+    _requests_in_flight.inc()
+    streaming = False
+    try:
+        rsp = await serve(start, sampled)
+        if isinstance(rsp, ClosingEventSourceResponse):
+            # a stream stays in flight until its response ends, whether its body ran or not
+            rsp.call_on_close(_requests_in_flight.dec)
+            streaming = True
+        return rsp
+    except HTTPException as e:
+        # failures are logged whether sampled or not
+        if _request_log is not None:
+            log_chat_compl(id, req, start, e.status_code, error=str(e.detail))
+        raise
+    except Exception as e:
+        if _request_log is not None:
+            log_chat_compl(id, req, start, 500,
+                           error=f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        if not streaming:
+            _requests_in_flight.dec()
+
+
+async def _chat_completions(req: ChatCompletionRequest, id: str, start: float, sampled: bool,
+                            session: Optional[Session] = None) -> Union[ChatCompletionResponse, EventSourceResponse]:
     model = req.model
-    messages: List[ChatMessage] = []
+    # a session turn only sends its new messages
+    messages: List[ChatMessage] = list(
+        session.messages) if session is not None else []
+    for message in req.messages:
+        messages.append(ChatMessage(
+            role=message.role,
+            content=message.content,
+        ))
+
+    params = build_generation_params(req)
+    if params.n < 1:
+        raise HTTPException(status_code=400, detail=f"invalid n: {params.n}")
+    service = await get_service(model)
+    try:
+        service.check_generation_params(params)
+    except GenerationParamsError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    include_usage = req.stream_options is not None and bool(
+        req.stream_options.include_usage)
+    # registry models are a known set, the model names sent to a single service are not
+    service_label = model if _registry is not None else type(service).__name__
+    _requests_total.labels(service_label, "true" if req.stream else "false").inc()
+
+    trim: Optional[ContextTrim] = None
+    if _context_window is not None:
+        # counting the tokens of new messages takes the tokenizer, which does not belong on the event loop
+        messages, trim = await asyncio.get_running_loop().run_in_executor(
+            None, _context_window.fit, service, messages)
+    headers = build_chat_compl_context_headers(trim)
+
+    key: Optional[str] = None
+    if _response_cache is not None:
+        resolved = service.generation_params(params)
+        if _response_cache.accepts(resolved):
+            key = cache_key(model, messages, resolved)
+            # a miss in memory queries the sqlite file, which does not belong on the event loop
+            result = await asyncio.get_running_loop().run_in_executor(None, _response_cache.get, key)
+            if result is not None:
+                if req.stream:
+                    completion_gen = observe_chat_compl_stream(
+                        service_label, start, replay_chat_compl(result))
+                    if _request_log is not None:
+                        completion_gen = log_chat_compl_stream(
+                            id, req, start, completion_gen, cached=True, sampled=sampled)
+                    release_session = build_session_release(session) if session is not None else None
+                    if release_session is not None:
+                        completion_gen = record_session_stream(
+                            release_session, messages, completion_gen)
+                    rsp = ClosingEventSourceResponse(build_chat_compl_streaming_resp(
+                        id, model, params.n, include_usage, completion_gen, CancelToken()), headers=headers)
+                    if release_session is not None:
+                        rsp.call_on_close(release_session)
+                    return rsp
+                observe_chat_compl(service_label, start,
+                                   result.usage.prompt_tokens, result.usage.completion_tokens)
+                if sampled:
+                    log_chat_compl(id, req, start, 200, result.usage,
+                                   [choice.finish_reason for choice in result.choices],
+                                   [choice.text for choice in result.choices], cached=True)
+                rsp = build_chat_compl_resp_from_result(
+                    id, model, result, trim)
+                if session is not None:
+                    _session_store.release(
+                        session, messages + [ChatMessage(role="assistant", content=result.choices[0].text)])
+                return rsp
+
+    ticket: Optional[AdmissionTicket] = None
+    if _admission is not None:
+        # answers from cache above take no admission, they do not generate
+        if trim is not None:
+            prompt_tokens = trim.prompt_tokens
+        else:
+            # like trimming, counting takes the tokenizer off the event loop
+            prompt_tokens = await asyncio.get_running_loop().run_in_executor(
+                None, count_admission_tokens, service, messages)
+        resolved = service.generation_params(params)
+        ticket = await admit(req, prompt_tokens + resolved.n * resolved.max_new_tokens)
 
-    print(f"<|request: {id}, promt|>")
+    # generation runs on the inference executor, the event loop only relays results
+    ticket_held = False
+    try:
+        if req.stream:
+            cancel_token = CancelToken()
+            if key is None:
+                completion_gen = _executor.iterate(
+                    service.complete_stream, messages, params, cancel_token, cancel_token=cancel_token)
+            else:
+                completion_gen = _executor.iterate(
+                    complete_stream_cached, service, key, messages, params, cancel_token, cancel_token=cancel_token)
+            completion_gen = observe_chat_compl_stream(
+                service_label, start, completion_gen)
+            if _request_log is not None:
+                # a stream can still fail, which is logged whether sampled or not
+                completion_gen = log_chat_compl_stream(
+                    id, req, start, completion_gen, sampled=sampled)
+            release_session = build_session_release(session) if session is not None else None
+            if release_session is not None:
+                completion_gen = record_session_stream(
+                    release_session, messages, completion_gen)
+            rsp = ClosingEventSourceResponse(
+                build_chat_compl_streaming_resp(
+                    id, model, params.n, include_usage, completion_gen, cancel_token),
+                headers=headers)
+            rsp.call_on_close(cancel_token.cancel)
+            if release_session is not None:
+                # a stream that never starts still ends the turn
+                rsp.call_on_close(release_session)
+            if ticket is not None:
+                # a stream holds its admitted tokens until its response ends
+                rsp.call_on_close(ticket.release)
+                ticket_held = True
+            return rsp
+
+        rsp = await _executor.run(build_chat_compl_resp, service, id, model, messages, params, key, trim)
+        observe_chat_compl(service_label, start,
+                           rsp.usage.prompt_tokens, rsp.usage.completion_tokens)
+        if sampled:
+            log_chat_compl(id, req, start, 200,
+                           CompletionUsage(prompt_tokens=rsp.usage.prompt_tokens,
+                                           completion_tokens=rsp.usage.completion_tokens),
+                           [choice.finish_reason for choice in rsp.choices],
+                           [choice.message.content for choice in rsp.choices])
+        if session is not None:
+            _session_store.release(
+                session, messages + [ChatMessage(role="assistant", content=rsp.choices[0].message.content)])
+        return rsp
+    except ExecutorFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    finally:
+        if ticket is not None and not ticket_held:
+            ticket.release()
+
+
+def get_session_store() -> SessionStore:
+    if _session_store is None:
+        raise HTTPException(
+            status_code=404, detail="sessions are not enabled")
+    return _session_store
+
+
+def build_session_resp(session: Session) -> SessionResponse:
+    return SessionResponse(
+        id=session.id,
+        created=session.created,
+        messages=[ChatCompletionMessage(role=message.role, content=message.content)
+                  for message in session.messages],
+    )
+
+
+@app.post("/v1/sessions")
+async def create_session(req: SessionCreateRequest) -> SessionResponse:
+    store = get_session_store()
+    messages: List[ChatMessage] = []
+    if req.system:
+        messages.append(ChatMessage(role="system", content=req.system))
     for message in req.messages:
         messages.append(ChatMessage(
             role=message.role,
             content=message.content,
         ))
-        print(f"<|role: {message.role}|>")
-        print(f"{message.content}\n")
-    print(f"<|response: {id}, completion|>")
+    session = await asyncio.get_running_loop().run_in_executor(None, store.create, messages)
+    return build_session_resp(session)
+
+
+@app.get("/v1/sessions/{session_id}")
+async def get_session(session_id: str) -> SessionResponse:
+    store = get_session_store()
+    # a spilled session is read from disk
+    session = await asyncio.get_running_loop().run_in_executor(None, store.get, session_id)
+    if session is None:
+        raise HTTPException(
+            status_code=404, detail=f"session not found: {session_id}")
+    return build_session_resp(session)
+
+
+@app.delete("/v1/sessions/{session_id}")
+async def delete_session(session_id: str) -> SessionDeleteResponse:
+    store = get_session_store()
+    deleted = await asyncio.get_running_loop().run_in_executor(None, store.delete, session_id)
+    if not deleted:
+        raise HTTPException(
+            status_code=404, detail=f"session not found: {session_id}")
+    return SessionDeleteResponse(id=session_id)
+
+
+@app.post("/v1/sessions/{session_id}/chat/completions")
+async def session_chat_completions(session_id: str, req: ChatCompletionRequest) -> Union[ChatCompletionResponse, str]:
+    """
+    a turn of a session: messages only holds the new messages, and the answer of the first choice
+    joins the session once it is complete
+    """
+    store = get_session_store()
+    try:
+        session = await asyncio.get_running_loop().run_in_executor(None, store.acquire, session_id)
+    except SessionBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if session is None:
+        raise HTTPException(
+            status_code=404, detail=f"session not found: {session_id}")
+    try:
+        return await serve_chat_completions(req, session)
+    except BaseException:
+        store.release(session)
+        raise
+
+
+def build_input_list(input: Union[str, List[str], List[int], List[List[int]]]) -> List[Union[str, List[int]]]:
+    """the texts or token ids of an input that may be one of them or a list of them"""
+    if isinstance(input, str):
+        return [input]
+    if input and isinstance(input[0], int):
+        # a single input of token ids
+        return [input]
+    return list(input)
+
+
+def build_text_compl_resp(service: ChatCompletion, id: str, model: str, prompts: List[Prompt],
+                          params: GenerationParams, echo: bool) -> TextCompletionResponse:
+    result = service.complete_prompts(prompts, params, echo)
+    return TextCompletionResponse(
+        id=id,
+        created=int(time.time()),
+        model=model,
+        choices=[TextCompletionChoice(
+            index=choice.index,
+            text=choice.text,
+            finish_reason=choice.finish_reason,
+        ) for choice in result.choices],
+        usage=ChatCompletionUsage(
+            prompt_tokens=result.usage.prompt_tokens,
+            completion_tokens=result.usage.completion_tokens,
+            total_tokens=result.usage.prompt_tokens + result.usage.completion_tokens,
+        ),
+    )
+
+
+@app.post("/v1/completions")
+async def completions(req: TextCompletionRequest) -> Union[TextCompletionResponse, str]:
+    """
+    raw prompts without chat template, all prompts of a request are generated in one batch. Choice
+    p * n + i is sequence i of prompt p.
+    """
+    id = gen_req_id("cmpl")
+    return await serve_logged(id, req, lambda start, sampled: _completions(req, id, start, sampled))
+
+
+async def _completions(req: TextCompletionRequest, id: str, start: float,
+                       sampled: bool) -> Union[TextCompletionResponse, EventSourceResponse]:
+    prompts: List[Prompt] = build_input_list(req.prompt)
+    if not prompts or any(len(prompt) == 0 for prompt in prompts):
+        raise HTTPException(status_code=400, detail="prompt is empty")
+    if req.logprobs is not None:
+        raise HTTPException(status_code=400, detail="logprobs is not supported")
+    if req.suffix:
+        raise HTTPException(status_code=400, detail="suffix is not supported")
+    params = build_generation_params(req)
+    if "max_tokens" not in req.model_fields_set:
+        # unlike chat, completions are short unless asked otherwise
+        params.max_new_tokens = 16
+    if params.n < 1:
+        raise HTTPException(status_code=400, detail=f"invalid n: {params.n}")
+    service = await get_service(req.model)
+    if not service.supports_prompt_completion:
+        raise HTTPException(
+            status_code=400, detail=f"{type(service).__name__} does not support prompt completion")
+    include_usage = req.stream_options is not None and bool(
+        req.stream_options.include_usage)
+    service_label = req.model if _registry is not None else type(service).__name__
+    _requests_total.labels(service_label, "true" if req.stream else "false").inc()
+
+    ticket: Optional[AdmissionTicket] = None
+    if _admission is not None:
+        resolved = service.generation_params(params)
+        prompt_tokens = await asyncio.get_running_loop().run_in_executor(
+            None, count_admission_prompt_tokens, service, prompts)
+        ticket = await admit(req, prompt_tokens + len(prompts) * resolved.n * resolved.max_new_tokens)
+
+    ticket_held = False
+    try:
+        if req.stream:
+            cancel_token = CancelToken()
+            completion_gen = _executor.iterate(
+                service.complete_prompts_stream, prompts, params, cancel_token, req.echo, cancel_token=cancel_token)
+            completion_gen = observe_chat_compl_stream(
+                service_label, start, completion_gen)
+            if _request_log is not None:
+                completion_gen = log_chat_compl_stream(
+                    id, req, start, completion_gen, sampled=sampled)
+            encoder = TextChunkEncoder(id, req.model, int(time.time()))
+            rsp = ClosingEventSourceResponse(build_chat_compl_streaming_resp(
+                id, req.model, 0, include_usage, completion_gen, cancel_token, encoder))
+            rsp.call_on_close(cancel_token.cancel)
+            if ticket is not None:
+                # a stream holds its admitted tokens until its response ends
+                rsp.call_on_close(ticket.release)
+                ticket_held = True
+            return rsp
+
+        rsp = await _executor.run(build_text_compl_resp, service, id, req.model, prompts, params, req.echo)
+        observe_chat_compl(service_label, start,
+                           rsp.usage.prompt_tokens, rsp.usage.completion_tokens)
+        if sampled:
+            log_chat_compl(id, req, start, 200,
+                           CompletionUsage(prompt_tokens=rsp.usage.prompt_tokens,
+                                           completion_tokens=rsp.usage.completion_tokens),
+                           [choice.finish_reason for choice in rsp.choices],
+                           [choice.text for choice in rsp.choices])
+        return rsp
+    except ExecutorFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    finally:
+        if ticket is not None and not ticket_held:
+            ticket.release()
+
+
+def encode_embedding(embedding: List[float], dimensions: Optional[int],
+                     encoding_format: str) -> Union[List[float], str]:
+    if dimensions is not None and dimensions < len(embedding):
+        embedding = embedding[:dimensions]
+        norm = math.sqrt(sum(x * x for x in embedding))
+        if norm > 0:
+            embedding = [x / norm for x in embedding]
+    if encoding_format == "base64":
+        floats = array.array("f", embedding)
+        if sys.byteorder == "big":
+            floats.byteswap()
+        return base64.b64encode(floats.tobytes()).decode("ascii")
+    return embedding
+
+
+@app.post("/v1/embeddings")
+async def embeddings(req: EmbeddingRequest) -> EmbeddingResponse:
+    inputs: List[EmbeddingInput] = build_input_list(req.input)
+    if not inputs:
+        raise HTTPException(status_code=400, detail="input is empty")
+    if req.dimensions is not None and req.dimensions < 1:
+        raise HTTPException(
+            status_code=400, detail=f"invalid dimensions: {req.dimensions}")
+    service = await get_service(req.model)
+    try:
+        # inputs of concurrent requests are batched by the service, no worker waits for them; submitting
+        # only queues them, but a replica pool sends them over a pipe, which does not belong on the event loop
+        future = await asyncio.get_running_loop().run_in_executor(None, service.submit_embeddings, inputs)
+        result = await asyncio.wrap_future(future)
+    except EmbeddingInputError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except NotImplementedError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return EmbeddingResponse(
+        data=[Embedding(
+            index=index,
+            embedding=encode_embedding(
+                embedding, req.dimensions, req.encoding_format),
+        ) for index, embedding in enumerate(result.embeddings)],
+        model=req.model,
+        usage=EmbeddingUsage(
+            prompt_tokens=result.prompt_tokens,
+            total_tokens=result.prompt_tokens,
+        ),
+    )
+
+
+@app.get("/health/live")
+async def health_live() -> HealthResponse:
+    """the process is up, it fails only once loading the service failed"""
+    if _service_load is not None and _service_load.state == "failed":
+        return JSONResponse(HealthResponse(status="failed", stages=_service_load.stages,
+                                           error=_service_load.error).model_dump(), status_code=503)
+    return HealthResponse(status="live")
+
+
+@app.get("/health/ready")
+async def health_ready() -> HealthResponse:
+    """the service is loaded and warmed up; registry models load on their first request and are always ready"""
+    if _registry is not None:
+        return HealthResponse(status="ready")
+    if _service_load is None:
+        # like get_service, before the lifespan of the app ran
+        return JSONResponse(HealthResponse(status="not_started").model_dump(), status_code=503)
+    rsp = HealthResponse(status=_service_load.state,
+                         stages=_service_load.stages, error=_service_load.error)
+    if not _service_load.ready:
+        return JSONResponse(rsp.model_dump(), status_code=503)
+    return rsp
 
-    if req.stream:
-        return EventSourceResponse(
-            build_chat_compl_streaming_resp(id, model, messages))
 
-    return build_chat_compl_resp(id, model, messages)
+@app.get("/metrics")
+async def get_metrics() -> PlainTextResponse:
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
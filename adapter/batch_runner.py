@@ -0,0 +1,215 @@
+import itertools
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, BinaryIO, Callable, Deque, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple, Union
+from pydantic import ValidationError
+from adapter.chat_completion import ChatCompletion, ChatMessage, CompletionResult, GenerationParams
+from adapter.protocol import ChatCompletionRequest, build_chat_compl_resp_from_result, build_generation_params
+
+
+BATCH_URL = "/v1/chat/completions"
+
+
+class BatchStats(NamedTuple):
+    lines: int  # requests read from the input
+    skipped: int  # requests done by an earlier run
+    completed: int
+    failed: int
+    prompt_tokens: int
+    completion_tokens: int
+    seconds: float
+
+
+class _BatchItem(NamedTuple):
+    line: int
+    custom_id: Optional[str]
+    model: str
+    messages: List[ChatMessage]
+    params: GenerationParams
+    length: int  # characters of the messages, to sort by
+
+
+class _BatchError(NamedTuple):
+    line: int
+    custom_id: Optional[str]
+    code: str  # invalid_request, or server_error for a failed generation
+    message: str
+
+
+def parse_batch_line(line: int, text: str) -> Union[_BatchItem, _BatchError]:
+    """a request line of an OpenAI batch input file"""
+    custom_id: Optional[str] = None
+    try:
+        entry = json.loads(text)
+        custom_id = entry.get("custom_id")
+        url = entry.get("url", BATCH_URL)
+        if url != BATCH_URL:
+            return _BatchError(line, custom_id, "invalid_request", f"unsupported url: {url}")
+        req = ChatCompletionRequest.model_validate(entry.get("body"))
+    except (ValueError, AttributeError, ValidationError) as e:
+        return _BatchError(line, custom_id, "invalid_request", f"invalid request: {e}")
+    messages = [ChatMessage(role=message.role, content=message.content)
+                for message in req.messages]
+    params = build_generation_params(req)
+    if params.n < 1:
+        return _BatchError(line, custom_id, "invalid_request", f"invalid n: {params.n}")
+    return _BatchItem(line, custom_id, req.model, messages, params,
+                      sum(len(message.content) for message in messages))
+
+
+class _BatchOutput:
+    """
+    the output file and its checkpoint: after each result the checkpoint records the line and the
+    length of the output, so that a resumed run skips the recorded lines and cuts the output back to
+    the last recorded result, dropping a result that was written but not recorded
+    """
+    done: Set[int]
+    _output: BinaryIO
+    _checkpoint: BinaryIO
+
+    def __init__(self, output_path: str, checkpoint_path: str) -> None:
+        self.done = set()
+        offset = 0
+        valid = 0
+        if os.path.exists(checkpoint_path) and os.path.exists(output_path):
+            with open(checkpoint_path, "rb") as f:
+                for record in f:
+                    try:
+                        entry = json.loads(record)
+                    except ValueError:
+                        # a record cut short by the kill
+                        break
+                    self.done.add(entry["line"])
+                    offset = entry["offset"]
+                    valid += len(record)
+        self._output = open(output_path, "r+b" if offset > 0 else "wb")
+        self._output.truncate(offset)
+        self._output.seek(offset)
+        self._checkpoint = open(checkpoint_path, "r+b" if valid > 0 else "wb")
+        self._checkpoint.truncate(valid)
+        self._checkpoint.seek(valid)
+
+    def write(self, line: int, record: Dict[str, Any]) -> None:
+        self._output.write(
+            (json.dumps(record, ensure_ascii=False) + "\n").encode("utf8"))
+        self._output.flush()
+        self._checkpoint.write(
+            f'{{"line":{line},"offset":{self._output.tell()}}}\n'.encode("ascii"))
+        self._checkpoint.flush()
+
+    def close(self) -> None:
+        self._output.close()
+        self._checkpoint.close()
+
+
+class BatchRunner:
+    """
+    Runs an OpenAI batch input file (JSONL of {"custom_id", "method", "url", "body"}, see
+    https://platform.openai.com/docs/guides/batch) of chat completion requests offline, without HTTP.
+    Requests are read sort_window at a time and sorted by prompt length, longest first, so that the
+    sequences that run together have similar lengths and little padding; up to concurrency of them
+    are in flight, which keeps a BatchingChatCompletion of the same max_batch_size full. Results are
+    written as they finish, in the OpenAI batch output format with their custom_id, and each one is
+    recorded in the checkpoint, so that a killed run started again skips the lines already done.
+    """
+    _service: ChatCompletion
+    _concurrency: int
+    _sort_window: int
+
+    def __init__(self, service: ChatCompletion, concurrency: int = 64, sort_window: int = 8192) -> None:
+        assert concurrency > 0, f"invalid concurrency: {concurrency}"
+        assert sort_window > 0, f"invalid sort_window: {sort_window}"
+        self._service = service
+        self._concurrency = concurrency
+        self._sort_window = sort_window
+
+    def _complete(self, item: _BatchItem) -> CompletionResult:
+        return self._service.complete(item.messages, item.params)
+
+    def run(self, input_path: str, output_path: str, checkpoint_path: Optional[str] = None,
+            progress: Optional[Callable[[BatchStats], None]] = None) -> BatchStats:
+        """runs the requests of input_path that are not done yet, the checkpoint defaults to output_path.ckpt"""
+        start = time.perf_counter()
+        output = _BatchOutput(
+            output_path, checkpoint_path or output_path + ".ckpt")
+        counts = {"lines": 0, "skipped": 0, "completed": 0,
+                  "failed": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+        def stats() -> BatchStats:
+            return BatchStats(seconds=time.perf_counter() - start, **counts)
+
+        def write_error(error: _BatchError) -> None:
+            counts["failed"] += 1
+            output.write(error.line, {
+                "id": f"batch_req_{error.line}",
+                "custom_id": error.custom_id,
+                "response": None,
+                "error": {"code": error.code, "message": error.message},
+            })
+
+        def write_result(item: _BatchItem, result: CompletionResult) -> None:
+            counts["completed"] += 1
+            counts["prompt_tokens"] += result.usage.prompt_tokens
+            counts["completion_tokens"] += result.usage.completion_tokens
+            rsp = build_chat_compl_resp_from_result(
+                f"chatcmpl-batch-{item.line}", item.model, result)
+            output.write(item.line, {
+                "id": f"batch_req_{item.line}",
+                "custom_id": item.custom_id,
+                "response": {"status_code": 200, "request_id": rsp.id, "body": rsp.model_dump(exclude_none=True)},
+                "error": None,
+            })
+
+        def read(lines: Iterator[Tuple[int, str]]) -> Iterator[Union[_BatchItem, _BatchError]]:
+            for line, text in lines:
+                if not text.strip():
+                    continue
+                counts["lines"] += 1
+                if line in output.done:
+                    counts["skipped"] += 1
+                    continue
+                yield parse_batch_line(line, text)
+
+        try:
+            with open(input_path, encoding="utf8") as input_file, \
+                    ThreadPoolExecutor(self._concurrency, "batch-runner") as pool:
+                items = read(enumerate(input_file))
+                exhausted = False
+                pending: Deque[_BatchItem] = deque()
+                running: Dict["Future[CompletionResult]", _BatchItem] = {}
+                while True:
+                    if not pending and not exhausted:
+                        window = list(itertools.islice(
+                            items, self._sort_window))
+                        exhausted = len(window) < self._sort_window
+                        for item in window:
+                            if isinstance(item, _BatchError):
+                                write_error(item)
+                        # the longest first, a batch too large for the device fails early
+                        pending.extend(sorted((item for item in window if isinstance(item, _BatchItem)),
+                                              key=lambda item: item.length, reverse=True))
+                    while pending and len(running) < self._concurrency:
+                        item = pending.popleft()
+                        running[pool.submit(self._complete, item)] = item
+                    if not running:
+                        if exhausted:
+                            break
+                        continue
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        item = running.pop(future)
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            write_error(_BatchError(
+                                item.line, item.custom_id, "server_error", f"{type(e).__name__}: {e}"))
+                        else:
+                            write_result(item, result)
+                        if progress is not None:
+                            progress(stats())
+        finally:
+            output.close()
+        return stats()
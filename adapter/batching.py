@@ -0,0 +1,177 @@
+import threading
+from collections import deque
+from typing import Deque, Iterator, List, Optional, TYPE_CHECKING
+import torch
+from adapter.chat_completion import ChatCompletion, ChatMessage, GenerationParams
+from adapter.generation import DecodeBatch, GenerationGroup, GenerationRequest
+
+if TYPE_CHECKING:
+    from adapter.prefix_cache import PrefixCache
+    from adapter.speculative import SpeculativeDecoding
+
+
+class BatchingEngine:
+    """
+    Continuous batching over a single model: every decode step runs one batched forward pass for all
+    running sequences. New requests are prefilled and join the batch between steps, finished ones
+    leave it right away. Sequences of different lengths share the batch through a left-padded cache.
+    """
+    _batch: DecodeBatch
+    _max_batch_size: int
+    _max_prefills_per_step: int
+    _cond: threading.Condition
+    _waiting: Deque[GenerationRequest]
+    _closed: bool
+    _thread: threading.Thread
+
+    def __init__(self, service: ChatCompletion, max_batch_size: int = 8, max_prefills_per_step: int = 4) -> None:
+        assert max_batch_size > 0, f"invalid max_batch_size: {max_batch_size}"
+        assert max_prefills_per_step > 0, f"invalid max_prefills_per_step: {max_prefills_per_step}"
+        self._batch = DecodeBatch(
+            service._model_runner(), service.eos_token_ids, service.prefix_cache)
+        self._max_batch_size = max_batch_size
+        self._max_prefills_per_step = max_prefills_per_step
+        self._cond = threading.Condition()
+        self._waiting = deque()
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name="batching-engine", daemon=True)
+        self._thread.start()
+
+    @property
+    def batch(self) -> DecodeBatch:
+        return self._batch
+
+    @property
+    def num_running(self) -> int:
+        """number of sequences in the running batch"""
+        return len(self._batch)
+
+    @property
+    def num_waiting(self) -> int:
+        return len(self._waiting)
+
+    def submit(self, input_ids: List[int], params: GenerationParams) -> GenerationRequest:
+        request = GenerationRequest(input_ids, params)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("batching engine is shut down")
+            self._waiting.append(request)
+            self._cond.notify()
+        return request
+
+    def submit_many(self, input_ids: List[List[int]], params: GenerationParams) -> GenerationGroup:
+        """submits the prompts together, so that they are prefilled in the same steps where they fit"""
+        group = GenerationGroup(input_ids, params)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("batching engine is shut down")
+            self._waiting.extend(group.requests)
+            self._cond.notify()
+        return group
+
+    def shutdown(self) -> None:
+        """stops the engine thread once the submitted requests are done"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def _take_waiting(self) -> Optional[List[GenerationRequest]]:
+        """returns the requests to prefill, None once shut down and idle"""
+        with self._cond:
+            while not self._waiting and len(self._batch) == 0:
+                if self._closed:
+                    return None
+                self._cond.wait()
+            free = self._max_batch_size - len(self._batch)
+            taken: List[GenerationRequest] = []
+            while self._waiting and len(taken) < self._max_prefills_per_step:
+                n = self._waiting[0].params.n
+                # a request larger than the whole batch still runs, alone
+                if n > free and (taken or len(self._batch) > 0):
+                    break
+                taken.append(self._waiting.popleft())
+                free -= n
+            return taken
+
+    def _run(self) -> None:
+        with torch.inference_mode():
+            while True:
+                taken = self._take_waiting()
+                if taken is None:
+                    return
+                # prompts of a similar length share a prefill, each failure goes to its request
+                self._batch.prefill_many(taken)
+                if len(self._batch) == 0:
+                    continue
+                try:
+                    self._batch.step()
+                except Exception as e:
+                    self._batch.fail(e)
+
+
+class BatchingChatCompletion(ChatCompletion):
+    """
+    Serves a ChatCompletion through a BatchingEngine, so that concurrent chats share decode steps.
+    The wrapped service has to support direct generation (build_input_ids).
+    """
+    _service: ChatCompletion
+    _engine: BatchingEngine
+
+    def __init__(self, service: ChatCompletion, max_batch_size: int = 8, max_prefills_per_step: int = 4) -> None:
+        super().__init__(service._model, service._tokenizer, native_generation=True)
+        self._service = service
+        # the engine runs the model of service, embeddings take turns with it
+        self._model_lock = service._model_lock
+        self._kv_layout = service._kv_layout
+        self._hidden_layout = service._hidden_layout
+        self._prefix_cache = service.prefix_cache
+        self._engine = BatchingEngine(
+            service, max_batch_size, max_prefills_per_step)
+
+    @property
+    def engine(self) -> BatchingEngine:
+        return self._engine
+
+    def build_input_ids(self, messages: List[ChatMessage]) -> List[int]:
+        return self._service.build_input_ids(messages)
+
+    def embedding_input_ids(self, text: str) -> List[int]:
+        return self._service.embedding_input_ids(text)
+
+    @property
+    def eos_token_ids(self) -> List[int]:
+        return self._service.eos_token_ids
+
+    def generation_params(self, params: Optional[GenerationParams] = None) -> GenerationParams:
+        return self._service.generation_params(params)
+
+    def enable_prefix_cache(self, max_bytes: int) -> "PrefixCache":
+        prefix_cache = super().enable_prefix_cache(max_bytes)
+        self._engine.batch.prefix_cache = prefix_cache
+        return prefix_cache
+
+    def enable_speculative_decoding(self, num_draft_tokens: int = 5, ngram_size: int = 3,
+                                    draft: Optional[ChatCompletion] = None) -> "SpeculativeDecoding":
+        raise TypeError(
+            "speculative decoding runs a single sequence, it does not apply to continuous batching")
+
+    def close(self) -> None:
+        self._engine.shutdown()
+        super().close()
+        self._service.close()
+
+    def _generate(self, input_ids: List[int], params: GenerationParams) -> GenerationRequest:
+        return self._engine.submit(input_ids, params)
+
+    def _generate_many(self, input_ids: List[List[int]], params: GenerationParams) -> GenerationGroup:
+        return self._engine.submit_many(input_ids, params)
+
+    def prompt_input_ids(self, prompt: str) -> List[int]:
+        return self._service.prompt_input_ids(prompt)
+
+    def chat(self, messages: List[ChatMessage]) -> str:
+        return self._chat_native(messages)
+
+    def chat_stream(self, messages: List[ChatMessage]) -> Iterator[str]:
+        return self._chat_stream_native(messages)
@@ -1,15 +1,25 @@
-from typing import List, Iterator
+from typing import List, Iterator, Optional
 from adapter.chat_completion import ChatCompletion, ChatMessage
+from adapter.context import ContextTrim, ContextWindow
 
 
 class ChatBot:
+    """
+    keeps the messages of a conversation, with context_window the history is trimmed to its budget
+    before each turn, so that it stops growing
+    """
     _service: ChatCompletion
     _system: str
     _messages: List[ChatMessage]
+    _context_window: Optional[ContextWindow]
+    _context: Optional[ContextTrim]
 
-    def __init__(self, service: ChatCompletion, system: str = "", history: List[ChatMessage] = []) -> None:
+    def __init__(self, service: ChatCompletion, system: str = "", history: List[ChatMessage] = [],
+                 context_window: Optional[ContextWindow] = None) -> None:
         self._service = service
         self._system = system
+        self._context_window = context_window
+        self._context = None
         if system == "":
             self._messages = []
         else:
@@ -22,11 +32,17 @@ class ChatBot:
             if not self._system and history[0].role == "system":
                 self._system = history[0].content
 
+    def _fit(self) -> None:
+        if self._context_window is not None:
+            self._messages, self._context = self._context_window.fit(
+                self._service, self._messages)
+
     def chat(self, message: str) -> str:
         self._messages.append(ChatMessage(
             role="user",
             content=message,
         ))
+        self._fit()
         completion = self._service.chat(self._messages)
         self._messages.append(ChatMessage(
             role="assistant",
@@ -39,6 +55,7 @@ class ChatBot:
             role="user",
             content=message,
         ))
+        self._fit()
         completion_gen = self._service.chat_stream(self._messages)
         delta_compl_list: List[str] = []
         for delta_compl in completion_gen:
@@ -50,6 +67,7 @@ class ChatBot:
         ))
 
     def clear(self):
+        self._context = None
         if self._system == "":
             self._messages = []
         else:
@@ -61,3 +79,8 @@ class ChatBot:
     @property
     def history(self) -> List[ChatMessage]:
         return self._messages
+
+    @property
+    def context(self) -> Optional[ContextTrim]:
+        """how the history was trimmed for the last turn, None without context_window"""
+        return self._context
@@ -0,0 +1,58 @@
+import threading
+from typing import Callable, Dict, List
+
+
+class CancelToken:
+    """
+    Set by whoever stops waiting for a generation, e.g. when the client of a stream disconnects.
+    The code producing the generation checks it, or registers callbacks that stop the work.
+    """
+    _lock: threading.Lock
+    _cancelled: bool
+    _callbacks: List[Callable[[], None]]
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._callbacks = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    def cancel(self) -> None:
+        with self._lock:
+            if self._cancelled:
+                return
+            self._cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def add_callback(self, callback: Callable[[], None]) -> None:
+        """calls callback on cancel, right away when already cancelled"""
+        with self._lock:
+            if not self._cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+
+_stats_lock = threading.Lock()
+_cancelled_generations = 0
+_avoided_tokens = 0
+
+
+def record_cancellation(avoided_tokens: int) -> None:
+    """counts a cancelled generation and the tokens it would still have been allowed to generate"""
+    global _cancelled_generations, _avoided_tokens
+    with _stats_lock:
+        _cancelled_generations += 1
+        _avoided_tokens += avoided_tokens
+
+
+def cancellation_stats() -> Dict[str, int]:
+    return {
+        "cancelled_generations": _cancelled_generations,
+        "avoided_tokens": _avoided_tokens,
+    }
@@ -1,8 +1,21 @@
+import importlib
+import importlib.metadata
+import threading
+from concurrent.futures import Future
 from typing import List
-from typing import List, Dict, Any, Type, ClassVar, Iterator, Literal
+from typing import List, Dict, Any, Type, ClassVar, Iterator, Literal, NamedTuple, Optional, Tuple, Union, TYPE_CHECKING
 from abc import ABC, abstractmethod
-from transformers import PreTrainedModel, PreTrainedTokenizer
 from pydantic import BaseModel
+from adapter.cancel import CancelToken, record_cancellation
+from adapter.detokenizer import IncrementalDetokenizer
+from adapter.stop import StopMatcher
+
+if TYPE_CHECKING:
+    from transformers import PreTrainedModel, PreTrainedTokenizer
+    from adapter.embeddings import EmbeddingBatcher, Pooling
+    from adapter.generation import GenerationGroup, GenerationRequest, ModelRunner
+    from adapter.prefix_cache import PrefixCache
+    from adapter.speculative import SpeculativeDecoding
 
 
 class ChatMessage(BaseModel):
@@ -10,13 +23,95 @@ class ChatMessage(BaseModel):
     content: str
 
 
+class GenerationParams(BaseModel):
+    """
+    sampling parameters of a direct generation, unset fields fall back to the service defaults
+    """
+    max_new_tokens: int = 2048
+    temperature: float = 1.0
+    top_p: float = 1.0
+    top_k: int = 0
+    repetition_penalty: float = 1.0
+    do_sample: bool = True
+    n: int = 1  # number of sequences sampled from the prompt
+    stop: List[str] = []  # generation stops before the first of these strings
+
+
+class CompletionChoice(BaseModel):
+    index: int
+    text: str
+    finish_reason: str
+
+
+class CompletionUsage(BaseModel):
+    prompt_tokens: int
+    completion_tokens: int
+
+
+class CompletionResult(BaseModel):
+    choices: List[CompletionChoice]
+    usage: CompletionUsage
+
+
+class CompletionDelta(NamedTuple):
+    index: int
+    text: str
+    finish_reason: Optional[str] = None  # set on the last delta of a choice
+
+
+class EmbeddingResult(NamedTuple):
+    embeddings: List[List[float]]  # one unit length vector per input
+    prompt_tokens: int
+
+
+class EmbeddingInputError(ValueError):
+    """an input that cannot be embedded, e.g. an empty or too long one"""
+    pass
+
+
+class GenerationParamsError(ValueError):
+    """generation params a service cannot generate with"""
+    pass
+
+
+# a text, or the token ids of one
+EmbeddingInput = Union[str, List[int]]
+# a prompt to complete as it is, without chat template: a text, or its token ids
+Prompt = Union[str, List[int]]
+
+
 class ChatCompletion(ABC):
-    _model: PreTrainedModel
-    _tokenizer: PreTrainedTokenizer
+    _model: "PreTrainedModel"
+    _tokenizer: "PreTrainedTokenizer"
+    # (batch dim, sequence dim) of the per-layer key/value tensors in past_key_values
+    _kv_layout: ClassVar[Tuple[int, int]] = (0, 2)
+    # (batch dim, sequence dim) of the hidden states of the base model
+    _hidden_layout: ClassVar[Tuple[int, int]] = (0, 1)
+    # passed to tokenizer.encode for the texts to embed
+    _embedding_encode_kwargs: ClassVar[Dict[str, Any]] = {}
+    # defaults of the remote chat() that are not in model.generation_config
+    _generation_defaults: ClassVar[Dict[str, Any]] = {}
+    # params the remote chat() takes from the model's generation config, a request cannot change them
+    _remote_chat_params: ClassVar[Tuple[str, ...]] = (
+        "max_new_tokens", "temperature", "top_p", "top_k", "repetition_penalty", "do_sample")
+
+    _native_generation: bool
+    # held by each forward of the model, generations and embedding batches run on different threads
+    _model_lock: threading.Lock
+    _runner: Optional["ModelRunner"]
+    _prefix_cache: Optional["PrefixCache"]
+    _embedder: Optional["EmbeddingBatcher"]
+    _speculative: Optional["SpeculativeDecoding"]
 
-    def __init__(self, model: PreTrainedModel, tokenizer: PreTrainedTokenizer):
+    def __init__(self, model: "PreTrainedModel", tokenizer: "PreTrainedTokenizer", native_generation: bool = False):
         self._model = model
         self._tokenizer = tokenizer
+        self._native_generation = native_generation
+        self._model_lock = threading.Lock()
+        self._runner = None
+        self._prefix_cache = None
+        self._embedder = None
+        self._speculative = None
 
     @abstractmethod
     def chat(self, messages: List[ChatMessage]) -> str:
@@ -26,6 +121,400 @@ class ChatCompletion(ABC):
     def chat_stream(self, messages: List[ChatMessage]) -> Iterator[str]:
         pass
 
+    def build_input_ids(self, messages: List[ChatMessage]) -> List[int]:
+        """
+        renders messages with the model's chat template, for generating with the model directly
+        """
+        raise NotImplementedError(
+            f"{type(self).__name__} does not support direct generation")
+
+    @property
+    def supports_direct_generation(self) -> bool:
+        return type(self).build_input_ids is not ChatCompletion.build_input_ids
+
+    @property
+    def supports_prompt_completion(self) -> bool:
+        """whether complete_prompts() can generate, which takes the model itself"""
+        return self._model is not None
+
+    @property
+    def eos_token_ids(self) -> List[int]:
+        ids: List[int] = []
+        config = getattr(self._model, "generation_config", None)
+        eos = getattr(config, "eos_token_id", None)
+        if isinstance(eos, int):
+            ids.append(eos)
+        elif eos:
+            ids.extend(eos)
+        if self._tokenizer.eos_token_id is not None and self._tokenizer.eos_token_id not in ids:
+            ids.append(self._tokenizer.eos_token_id)
+        return ids
+
+    def generation_params(self, params: Optional[GenerationParams] = None) -> GenerationParams:
+        values: Dict[str, Any] = {}
+        config = getattr(self._model, "generation_config", None)
+        for name in GenerationParams.model_fields:
+            value = getattr(config, name, None)
+            if value is not None:
+                values[name] = value
+        values.update(self._generation_defaults)
+        if params is not None:
+            values.update(params.model_dump(exclude_unset=True))
+        return GenerationParams(**values)
+
+    def check_generation_params(self, params: Optional[GenerationParams] = None) -> None:
+        """raises GenerationParamsError unless the service can generate with params"""
+        params = self.generation_params(params)
+        if not self._use_direct_generation(params):
+            self._check_remote_chat(params)
+
+    @property
+    def memory_bytes(self) -> int:
+        """bytes held by the model weights and the prefix cache"""
+        nbytes = sum(t.numel() * t.element_size()
+                     for t in self._model.parameters())
+        nbytes += sum(t.numel() * t.element_size()
+                      for t in self._model.buffers())
+        if self._prefix_cache is not None:
+            nbytes += self._prefix_cache.nbytes
+        return nbytes
+
+    def close(self) -> None:
+        """releases what the service holds besides the model, requests already running still finish"""
+        if self._embedder is not None:
+            self._embedder.shutdown()
+
+    @property
+    def prefix_cache(self) -> Optional["PrefixCache"]:
+        return self._prefix_cache
+
+    def enable_prefix_cache(self, max_bytes: int) -> "PrefixCache":
+        """
+        reuses the prompt cache of earlier requests in direct generation, bounded by max_bytes of tensors
+        """
+        from adapter.prefix_cache import PrefixCache
+        self._prefix_cache = PrefixCache(self._kv_layout, max_bytes)
+        return self._prefix_cache
+
+    @property
+    def speculative(self) -> Optional["SpeculativeDecoding"]:
+        return self._speculative
+
+    def enable_speculative_decoding(self, num_draft_tokens: int = 5, ngram_size: int = 3,
+                                    draft: Optional["ChatCompletion"] = None) -> "SpeculativeDecoding":
+        """
+        decodes greedy requests of a single sequence speculatively in direct generation, drafting by
+        prompt lookup and with the model of draft, a smaller service of the same tokenizer
+        """
+        from adapter.speculative import SpeculativeDecoding
+        if draft is not None:
+            # the drafts are fed to the model as they are, their ids have to mean the same tokens
+            assert len(draft._tokenizer) == len(self._tokenizer), \
+                f"the draft has a vocab of {len(draft._tokenizer)} tokens, the model of {len(self._tokenizer)}"
+            assert sorted(draft._tokenizer.all_special_ids) == sorted(self._tokenizer.all_special_ids) \
+                and draft.eos_token_ids == self.eos_token_ids, \
+                "the draft has other special tokens than the model"
+        self._speculative = SpeculativeDecoding(
+            num_draft_tokens, ngram_size, draft._model_runner() if draft is not None else None)
+        return self._speculative
+
+    @property
+    def embedder(self) -> Optional["EmbeddingBatcher"]:
+        return self._embedder
+
+    def enable_embeddings(self, max_batch_size: int = 32, max_batch_tokens: int = 16384, max_wait_ms: float = 5,
+                          max_input_tokens: int = 8192, cache_size: int = 4096,
+                          pooling: "Pooling" = "mean") -> "EmbeddingBatcher":
+        """
+        embeds texts with the hidden states of the model, batching concurrent inputs of similar length
+        """
+        from adapter.embeddings import EmbeddingBatcher
+        if self._embedder is not None:
+            self._embedder.shutdown()
+        self._embedder = EmbeddingBatcher(
+            self._model, self._hidden_layout, self.embedding_input_ids, max_batch_size, max_batch_tokens,
+            max_wait_ms, max_input_tokens, cache_size, pooling, self._tokenizer.pad_token_id or 0, self._model_lock)
+        return self._embedder
+
+    def embedding_input_ids(self, text: str) -> List[int]:
+        return self._tokenizer.encode(text, **self._embedding_encode_kwargs)
+
+    def submit_embeddings(self, inputs: List[EmbeddingInput]) -> "Future[EmbeddingResult]":
+        """embeds inputs in the background, with the defaults of enable_embeddings() unless it was called"""
+        if self._model is None:
+            raise NotImplementedError(
+                f"{type(self).__name__} does not support embeddings")
+        if self._embedder is None:
+            self.enable_embeddings()
+        return self._embedder.submit(inputs)
+
+    def embed(self, inputs: List[EmbeddingInput]) -> EmbeddingResult:
+        return self.submit_embeddings(inputs).result()
+
+    def _model_runner(self) -> "ModelRunner":
+        if self._runner is None:
+            from adapter.generation import ModelRunner
+            self._runner = ModelRunner(self._model, self._kv_layout, self._model_lock)
+        return self._runner
+
+    def _use_direct_generation(self, params: GenerationParams) -> bool:
+        """whether to generate with the model directly instead of through the remote chat()"""
+        # the remote chat() samples a single sequence with the defaults of the model
+        return (self._native_generation or params.n > 1 or bool(self._remote_chat_changes(params))) \
+            and self.supports_direct_generation
+
+    def _remote_chat_changes(self, params: GenerationParams) -> List[str]:
+        """the params that differ from the model defaults, which the remote chat() would ignore"""
+        defaults = self.generation_params()
+        return [name for name in self._remote_chat_params if getattr(params, name) != getattr(defaults, name)]
+
+    def _check_remote_chat(self, params: GenerationParams) -> None:
+        changed = self._remote_chat_changes(params)
+        if changed:
+            raise GenerationParamsError(
+                f"{type(self).__name__} only generates with the model defaults of {', '.join(changed)}")
+
+    def _finish_reason(self, text: str, params: GenerationParams) -> str:
+        """the finish reason of a remote chat() answer, which only returns the text"""
+        return "length" if self.num_tokens(text) >= params.max_new_tokens else "stop"
+
+    def _locked_chat(self, messages: List[ChatMessage]) -> str:
+        """a remote chat() under the model lock, which a service without a model in the process does not need"""
+        if self._model is None:
+            return self.chat(messages)
+        with self._model_lock:
+            return self.chat(messages)
+
+    def _locked_steps(self, deltas: Iterator[str]) -> Iterator[str]:
+        """runs each step of a remote chat_stream() under the model lock, releasing it between deltas"""
+        if self._model is None:
+            yield from deltas
+            return
+        while True:
+            with self._model_lock:
+                delta = next(deltas, None)
+            if delta is None:
+                return
+            yield delta
+
+    def _chat_native(self, messages: List[ChatMessage]) -> str:
+        return self.complete(messages).choices[0].text
+
+    def _chat_stream_native(self, messages: List[ChatMessage]) -> Iterator[str]:
+        for delta in self.complete_stream(messages):
+            if isinstance(delta, CompletionDelta):
+                yield delta.text
+
+    def _generate(self, input_ids: List[int], params: GenerationParams) -> "GenerationRequest":
+        from adapter.generation import generate
+        if self._speculative is not None and self._speculative.accepts(params):
+            return self._speculative.generate(
+                self._model_runner(), self.eos_token_ids, input_ids, params, self._prefix_cache)
+        return generate(self._model_runner(), self.eos_token_ids, input_ids, params, self._prefix_cache)
+
+    def _generate_many(self, input_ids: List[List[int]], params: GenerationParams) -> "GenerationGroup":
+        from adapter.generation import generate_many
+        return generate_many(self._model_runner(), self.eos_token_ids, input_ids, params, self._prefix_cache)
+
+    def prompt_input_ids(self, prompt: str) -> List[int]:
+        """the token ids of a raw prompt, with the special tokens the tokenizer adds to a text"""
+        return self._tokenizer.encode(prompt)
+
+    def num_prompt_tokens(self, messages: List[ChatMessage]) -> int:
+        """number of tokens of the prompt as the model sees it"""
+        if self.supports_direct_generation:
+            return len(self.build_input_ids(messages))
+        return self.num_tokens_from_messages(messages)
+
+    def complete(self, messages: List[ChatMessage], params: Optional[GenerationParams] = None) -> CompletionResult:
+        """
+        like chat(), but with generation params and params.n choices
+        """
+        params = self.generation_params(params)
+        if not self._use_direct_generation(params) and not params.stop:
+            self._check_remote_chat(params)
+            texts = [self._locked_chat(messages) for _ in range(params.n)]
+            # the remote chat() only returns text, so its tokens have to be counted again
+            tokens = [self.num_tokens(text) for text in texts]
+            return CompletionResult(
+                choices=[CompletionChoice(
+                    index=index,
+                    text=text,
+                    finish_reason="length" if tokens[index] >= params.max_new_tokens else "stop",
+                ) for index, text in enumerate(texts)],
+                usage=CompletionUsage(
+                    prompt_tokens=self.num_prompt_tokens(messages),
+                    completion_tokens=sum(tokens),
+                ),
+            )
+
+        # stop strings are matched on the text as it is generated, which needs the streaming path
+        return self._collect(self._complete_stream(messages, params), params.n)
+
+    def _collect(self, items: Iterator[Union[CompletionDelta, CompletionUsage]], count: int) -> CompletionResult:
+        deltas: List[List[str]] = [[] for _ in range(count)]
+        finish_reasons: List[str] = ["stop"] * count
+        usage: Optional[CompletionUsage] = None
+        for item in items:
+            if isinstance(item, CompletionUsage):
+                usage = item
+                continue
+            deltas[item.index].append(item.text)
+            if item.finish_reason is not None:
+                finish_reasons[item.index] = item.finish_reason
+        return CompletionResult(
+            choices=[CompletionChoice(
+                index=index,
+                text="".join(deltas[index]),
+                finish_reason=finish_reasons[index],
+            ) for index in range(count)],
+            usage=usage,
+        )
+
+    def complete_prompts(self, prompts: List[Prompt], params: Optional[GenerationParams] = None,
+                         echo: bool = False) -> CompletionResult:
+        """
+        completes raw prompts without chat template, choice p * params.n + i is sequence i of prompt p
+        """
+        params = self.generation_params(params)
+        return self._collect(self.complete_prompts_stream(prompts, params, echo=echo), len(prompts) * params.n)
+
+    def complete_prompts_stream(self, prompts: List[Prompt], params: Optional[GenerationParams] = None,
+                                cancel_token: Optional[CancelToken] = None,
+                                echo: bool = False) -> Iterator[Union[CompletionDelta, CompletionUsage]]:
+        """
+        like complete_stream() for raw prompts, which are generated together in one batch. With echo
+        each choice starts with its prompt.
+        """
+        if not self.supports_prompt_completion:
+            raise NotImplementedError(
+                f"{type(self).__name__} does not support prompt completion")
+        params = self.generation_params(params)
+        input_ids = [self.prompt_input_ids(prompt) if isinstance(prompt, str) else list(prompt)
+                     for prompt in prompts]
+        echoes: Optional[List[str]] = None
+        if echo:
+            echoes = [prompt if isinstance(prompt, str) else self._tokenizer.decode(prompt)
+                      for prompt in prompts]
+        return self._complete_prompts_stream(input_ids, params, cancel_token, echoes)
+
+    def _complete_prompts_stream(self, input_ids: List[List[int]], params: GenerationParams,
+                                 cancel_token: Optional[CancelToken],
+                                 echoes: Optional[List[str]]) -> Iterator[Union[CompletionDelta, CompletionUsage]]:
+        if cancel_token is None:
+            cancel_token = CancelToken()
+        if echoes is not None:
+            for p, text in enumerate(echoes):
+                for i in range(params.n):
+                    yield CompletionDelta(p * params.n + i, text)
+        group = self._generate_many(input_ids, params)
+        yield from self._stream_generation(group, len(input_ids) * params.n,
+                                           sum(len(ids) for ids in input_ids), params, cancel_token)
+
+    def complete_stream(self, messages: List[ChatMessage], params: Optional[GenerationParams] = None,
+                        cancel_token: Optional[CancelToken] = None) -> Iterator[Union[CompletionDelta, CompletionUsage]]:
+        """
+        like chat_stream(), but with generation params and params.n choices, deltas of different choices interleave.
+        The last item is the CompletionUsage. Generation stops early when cancel_token is cancelled or the
+        iterator is closed, a cancelled stream ends without usage.
+        """
+        return self._complete_stream(messages, self.generation_params(params), cancel_token)
+
+    def _complete_stream(self, messages: List[ChatMessage], params: GenerationParams,
+                         cancel_token: Optional[CancelToken] = None) -> Iterator[Union[CompletionDelta, CompletionUsage]]:
+        if cancel_token is None:
+            cancel_token = CancelToken()
+        if not self._use_direct_generation(params):
+            self._check_remote_chat(params)
+            completion_tokens = 0
+            for index in range(params.n):
+                matcher = StopMatcher(params.stop) if params.stop else None
+                deltas: List[str] = []
+                completion_gen = self.chat_stream(messages)
+                try:
+                    for delta in self._locked_steps(completion_gen):
+                        if cancel_token.cancelled:
+                            # the remote generation has no token budget to report
+                            record_cancellation(0)
+                            return
+                        deltas.append(delta)
+                        if matcher is not None:
+                            delta, stopped = matcher.feed(delta)
+                            if stopped:
+                                yield CompletionDelta(index, delta, "stop")
+                                break
+                        if delta != "":
+                            yield CompletionDelta(index, delta)
+                    else:
+                        tail = matcher.flush() if matcher is not None else ""
+                        yield CompletionDelta(index, tail, self._finish_reason("".join(deltas), params))
+                finally:
+                    # stops the remote generation on a stop string, a cancel or an early close
+                    if hasattr(completion_gen, "close"):
+                        completion_gen.close()
+                completion_tokens += self.num_tokens("".join(deltas))
+            yield CompletionUsage(
+                prompt_tokens=self.num_prompt_tokens(messages),
+                completion_tokens=completion_tokens,
+            )
+            return
+
+        input_ids = self.build_input_ids(messages)
+        request = self._generate(input_ids, params)
+        yield from self._stream_generation(request, params.n, len(input_ids), params, cancel_token)
+
+    def _stream_generation(self, request: Union["GenerationRequest", "GenerationGroup"], count: int,
+                           prompt_tokens: int, params: GenerationParams,
+                           cancel_token: CancelToken) -> Iterator[Union[CompletionDelta, CompletionUsage]]:
+        """detokenizes the count sequences of request into deltas, matching the stop strings"""
+        cancel_token.add_callback(request.cancel)
+        detokenizers = [IncrementalDetokenizer(self._tokenizer)
+                        for _ in range(count)]
+        matchers = [StopMatcher(params.stop) if params.stop else None
+                    for _ in range(count)]
+        stopped = [False] * count
+        try:
+            for event in request:
+                index = event.index
+                if cancel_token.cancelled:
+                    return
+                if stopped[index]:
+                    # generated before the abort took effect
+                    continue
+                detokenizer = detokenizers[index]
+                matcher = matchers[index]
+                if event.token_id is not None:
+                    delta = detokenizer.add(event.token_id)
+                    if delta == "":
+                        continue
+                    if matcher is not None:
+                        delta, stopped[index] = matcher.feed(delta)
+                        if stopped[index]:
+                            request.abort(index)
+                            yield CompletionDelta(index, delta, "stop")
+                            continue
+                    if delta != "":
+                        yield CompletionDelta(index, delta)
+                else:
+                    delta = detokenizer.flush()
+                    finish_reason = event.finish_reason
+                    if matcher is not None:
+                        delta, found = matcher.feed(delta)
+                        if found:
+                            finish_reason = "stop"
+                        else:
+                            delta += matcher.flush()
+                    yield CompletionDelta(index, delta, finish_reason)
+        except GeneratorExit:
+            # closing the iterator early also frees the sequences in the batch
+            request.cancel()
+            raise
+        yield CompletionUsage(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=sum(len(detokenizer.token_ids)
+                                  for detokenizer in detokenizers),
+        )
+
     def num_tokens(self, text: str) -> int:
         return len(self._tokenizer.encode(text))
 
@@ -38,6 +527,15 @@ class ChatCompletion(ABC):
 
 
 _services: Dict[str, Type[ChatCompletion]] = {}
+# modules that register a service when imported, imported on the first request of the service
+_service_modules: Dict[str, str] = {
+    "baichuan2": "adapter.services.baichuan2_chat_completion",
+    "chatglm2": "adapter.services.chatglm2_chat_completion",
+    "qwen": "adapter.services.qwen_chat_completion",
+}
+# other packages can provide services under this entry point group, naming a ChatCompletion class
+# or a module that registers its service when imported
+SERVICE_ENTRY_POINT_GROUP = "adapter.services"
 
 
 def register_chat_completion_service(name: str, service: Type[ChatCompletion]):
@@ -45,5 +543,38 @@ def register_chat_completion_service(name: str, service: Type[ChatCompletion]):
     _services[name] = service
 
 
+def register_chat_completion_service_module(name: str, module: str) -> None:
+    """registers a service by the module that registers it, the module is only imported when the service is created"""
+    _service_modules[name] = module
+
+
+def _service_entry_points() -> Dict[str, Any]:
+    return {ep.name: ep for ep in importlib.metadata.entry_points(group=SERVICE_ENTRY_POINT_GROUP)}
+
+
+def chat_completion_service_names() -> List[str]:
+    """names of the registered services, including those not imported yet"""
+    names = dict.fromkeys(_services)
+    names.update(dict.fromkeys(_service_modules))
+    names.update(dict.fromkeys(_service_entry_points()))
+    return list(names)
+
+
+def get_chat_completion_service(name: str) -> Type[ChatCompletion]:
+    """returns the service class registered under name, importing its module on first use"""
+    if name not in _services:
+        if name in _service_modules:
+            importlib.import_module(_service_modules[name])
+        else:
+            ep = _service_entry_points().get(name)
+            if ep is not None:
+                loaded = ep.load()
+                if isinstance(loaded, type) and issubclass(loaded, ChatCompletion):
+                    register_chat_completion_service(name, loaded)
+    if name not in _services:
+        raise KeyError(f"unknown chat completion service: {name}")
+    return _services[name]
+
+
 def create_chat_completion_service(name: str, *args, **kwargs) -> ChatCompletion:
-    return _services[name](*args, **kwargs)
+    return get_chat_completion_service(name)(*args, **kwargs)
@@ -0,0 +1,192 @@
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Callable, List, Literal, NamedTuple, Optional, Tuple
+from adapter.chat_completion import ChatCompletion, ChatMessage
+
+
+ContextStrategy = Literal["sliding", "first_last", "summary"]
+# (the messages to fold into the summary, the tokens it may take) -> the summary
+Summarizer = Callable[[List[ChatMessage], int], str]
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+
+def estimate_tokens(text: str) -> int:
+    """a token count without the tokenizer, an upper bound when no token is shorter than a character"""
+    return len(text)
+
+
+class ContextTrim(NamedTuple):
+    strategy: str
+    original_tokens: int  # estimated tokens of the messages before trimming
+    prompt_tokens: int  # estimated tokens of the messages kept
+    dropped_messages: int
+    summarized: bool
+
+
+def extract_summary(messages: List[ChatMessage], max_chars: int) -> str:
+    """a summary without a model: the start of each message, all cut to about max_chars"""
+    if not messages:
+        return ""
+    per_message = max(max_chars // len(messages), 16)
+    lines: List[str] = []
+    for message in messages:
+        content = message.content
+        # an earlier summary is folded in as it is, its lines already name their roles
+        folded = message.role == "system" and content.startswith(SUMMARY_PREFIX)
+        if folded:
+            content = content[len(SUMMARY_PREFIX):]
+        else:
+            content = f"{message.role}: " + " ".join(content.split())
+        if len(content) > per_message:
+            content = content[:per_message - 3] + "..."
+        lines.append(content)
+    return "\n".join(lines)[:max_chars]
+
+
+class ContextWindow:
+    """
+    Fits conversations into max_prompt_tokens by dropping whole old rounds (a user message and the
+    answers after it). The leading system messages and the latest user turn are always kept. With the
+    sliding strategy the oldest rounds go first, first_last also keeps the first keep_first rounds, and
+    summary replaces the dropped rounds with a system message of at most summary_tokens written by
+    summarize (see extract_summary for the default), which folds an earlier summary in again.
+
+    Tokens are counted per message, as the tokens of its content plus message_overhead for the role
+    and the chat format, and kept per service in an LRU of max_entries by content, so a growing
+    conversation only counts its new messages. count_tokens counts instead of service.num_tokens, e.g.
+    estimate_tokens for services without a tokenizer in the process.
+    """
+    _max_prompt_tokens: int
+    _strategy: str
+    _keep_first: int
+    _summary_tokens: int
+    _summarize: Optional[Summarizer]
+    _message_overhead: int
+    _count_tokens: Optional[Callable[[str], int]]
+    _max_entries: int
+    _counts: "weakref.WeakKeyDictionary[ChatCompletion, OrderedDict[str, int]]"
+    _lock: threading.Lock
+
+    def __init__(self, max_prompt_tokens: int, strategy: ContextStrategy = "sliding", keep_first: int = 1,
+                 summary_tokens: int = 256, summarize: Optional[Summarizer] = None, message_overhead: int = 4,
+                 count_tokens: Optional[Callable[[str], int]] = None, max_entries: int = 65536) -> None:
+        assert max_prompt_tokens > 0, f"invalid max_prompt_tokens: {max_prompt_tokens}"
+        assert strategy in ("sliding", "first_last", "summary"), f"invalid strategy: {strategy}"
+        assert keep_first >= 0, f"invalid keep_first: {keep_first}"
+        assert strategy != "summary" or 0 < summary_tokens < max_prompt_tokens, \
+            f"invalid summary_tokens: {summary_tokens}"
+        self._max_prompt_tokens = max_prompt_tokens
+        self._strategy = strategy
+        self._keep_first = keep_first
+        self._summary_tokens = summary_tokens
+        self._summarize = summarize
+        self._message_overhead = message_overhead
+        self._count_tokens = count_tokens
+        self._max_entries = max_entries
+        self._counts = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    @property
+    def max_prompt_tokens(self) -> int:
+        return self._max_prompt_tokens
+
+    @property
+    def strategy(self) -> str:
+        return self._strategy
+
+    def _num_tokens(self, service: ChatCompletion, text: str) -> int:
+        if self._count_tokens is not None:
+            return self._count_tokens(text)
+        return service.num_tokens(text)
+
+    def count(self, service: ChatCompletion, message: ChatMessage) -> int:
+        """the estimated tokens of message, counted once per content"""
+        with self._lock:
+            counts = self._counts.get(service)
+            if counts is None:
+                counts = self._counts[service] = OrderedDict()
+            n = counts.get(message.content)
+            if n is not None:
+                counts.move_to_end(message.content)
+                return n + self._message_overhead
+        n = self._num_tokens(service, message.content) if message.content else 0
+        with self._lock:
+            counts[message.content] = n
+            while len(counts) > self._max_entries:
+                counts.popitem(last=False)
+        return n + self._message_overhead
+
+    def _summary(self, service: ChatCompletion, messages: List[ChatMessage]) -> ChatMessage:
+        budget = self._summary_tokens - self._message_overhead
+        text = ""
+        if self._summarize is not None:
+            text = self._summarize(messages, budget)
+        else:
+            # starts at about 4 characters a token, and shortens until the tokens fit
+            max_chars = budget * 4
+            while True:
+                text = extract_summary(messages, max_chars)
+                if max_chars <= 16 or self._num_tokens(service, SUMMARY_PREFIX + text) <= budget:
+                    break
+                max_chars //= 2
+        return ChatMessage(role="system", content=SUMMARY_PREFIX + text)
+
+    def fit(self, service: ChatCompletion, messages: List[ChatMessage]) -> Tuple[List[ChatMessage], ContextTrim]:
+        """the messages to send to service, and what was trimmed"""
+        counts = [self.count(service, message) for message in messages]
+        total = sum(counts)
+        if total <= self._max_prompt_tokens:
+            return messages, ContextTrim(self._strategy, total, total, 0, False)
+
+        # pinned: the leading system messages (but not an earlier summary) and the latest user turn
+        head = 0
+        while head < len(messages) and messages[head].role == "system" and \
+                not messages[head].content.startswith(SUMMARY_PREFIX):
+            head += 1
+        tail = len(messages)
+        for i in range(len(messages) - 1, head - 1, -1):
+            if messages[i].role == "user":
+                tail = i
+                break
+        # the rounds in between, each from a user message to the next
+        rounds: List[Tuple[int, int]] = []
+        start = head
+        for i in range(head + 1, tail + 1):
+            if i == tail or messages[i].role == "user":
+                if start < i:
+                    rounds.append((start, i))
+                start = i
+
+        budget = self._max_prompt_tokens
+        if self._strategy == "summary":
+            budget -= self._summary_tokens
+        keep = [True] * len(rounds)
+        kept_tokens = total
+        first = self._keep_first if self._strategy == "first_last" else 0
+        # the oldest rounds go first, after those that first_last keeps
+        for index in list(range(first, len(rounds))) + list(range(min(first, len(rounds)))):
+            if kept_tokens <= budget:
+                break
+            begin, end = rounds[index]
+            keep[index] = False
+            kept_tokens -= sum(counts[begin:end])
+
+        kept: List[ChatMessage] = list(messages[:head])
+        dropped: List[ChatMessage] = []
+        for (begin, end), keep_round in zip(rounds, keep):
+            (kept if keep_round else dropped).extend(messages[begin:end])
+        dropped_count = len(dropped)
+        summarized = False
+        if self._strategy == "summary" and dropped:
+            summary = self._summary(service, dropped)
+            kept_tokens += self.count(service, summary)
+            # an earlier summary folded into the new one was not really dropped
+            dropped_count -= sum(1 for message in dropped
+                                 if message.role == "system" and message.content.startswith(SUMMARY_PREFIX))
+            summarized = True
+            # the summary goes after the system prompt, ahead of the rounds kept
+            kept.insert(head, summary)
+        kept.extend(messages[tail:])
+        return kept, ContextTrim(self._strategy, total, kept_tokens, dropped_count, summarized)
@@ -0,0 +1,55 @@
+from typing import List, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from transformers import PreTrainedTokenizer
+
+
+class IncrementalDetokenizer:
+    """
+    Turns generated token ids into text deltas while decoding only a short window of recent ids per
+    token, instead of the whole completion. The window starts at the ids of the previous delta, which
+    gives tokenizers the context they need for leading spaces and merges. A delta is held back while it
+    ends in an incomplete multi-byte character (U+FFFD), so CJK text split across byte tokens is only
+    emitted once complete. The concatenated deltas equal decoding all ids at once.
+    """
+    _tokenizer: "PreTrainedTokenizer"
+    _skip_special_tokens: bool
+    _ids: List[int]
+    _prefix_offset: int  # start of the decoding window
+    _read_offset: int  # ids before this have been emitted
+
+    def __init__(self, tokenizer: "PreTrainedTokenizer", skip_special_tokens: bool = True) -> None:
+        self._tokenizer = tokenizer
+        self._skip_special_tokens = skip_special_tokens
+        self._ids = []
+        self._prefix_offset = 0
+        self._read_offset = 0
+
+    @property
+    def token_ids(self) -> List[int]:
+        return self._ids
+
+    def _decode(self, ids: List[int]) -> str:
+        return self._tokenizer.decode(ids, skip_special_tokens=self._skip_special_tokens)
+
+    def add(self, token_id: int) -> str:
+        """appends a token, returns the text that became complete with it"""
+        self._ids.append(token_id)
+        prefix_text = self._decode(
+            self._ids[self._prefix_offset:self._read_offset])
+        new_text = self._decode(self._ids[self._prefix_offset:])
+        if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+            return ""
+        self._prefix_offset = self._read_offset
+        self._read_offset = len(self._ids)
+        return new_text[len(prefix_text):]
+
+    def flush(self) -> str:
+        """returns the text held back at the end of generation"""
+        if self._read_offset == len(self._ids):
+            return ""
+        prefix_text = self._decode(
+            self._ids[self._prefix_offset:self._read_offset])
+        new_text = self._decode(self._ids[self._prefix_offset:])
+        self._prefix_offset = self._read_offset = len(self._ids)
+        return new_text[len(prefix_text):]
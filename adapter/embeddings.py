@@ -0,0 +1,293 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Dict, Hashable, List, Literal, Optional, Tuple
+import torch
+from transformers import PreTrainedModel
+from adapter.chat_completion import EmbeddingInput, EmbeddingInputError, EmbeddingResult
+
+
+# mean of the hidden states of all tokens, or the hidden state of the last token
+Pooling = Literal["mean", "last"]
+
+
+class _EmbeddingRequest:
+    inputs: List[EmbeddingInput]
+    future: "Future[EmbeddingResult]"
+    embeddings: List[Optional[List[float]]]
+    remaining: int
+    prompt_tokens: int
+
+    def __init__(self, inputs: List[EmbeddingInput]) -> None:
+        self.inputs = inputs
+        self.future = Future()
+        self.embeddings = [None] * len(inputs)
+        self.remaining = len(inputs)
+        self.prompt_tokens = 0
+
+    def fill(self, index: int, embedding: List[float]) -> None:
+        self.embeddings[index] = embedding
+        self.remaining -= 1
+        if self.remaining == 0 and not self.future.done():
+            self.future.set_result(EmbeddingResult(
+                self.embeddings, self.prompt_tokens))
+
+
+class _PendingInput:
+    key: Hashable
+    ids: List[int]
+    bucket: int
+    arrived: float
+    waiters: List[Tuple[_EmbeddingRequest, int]]  # (request, index) of the inputs with these ids
+
+    def __init__(self, key: Hashable, ids: List[int], bucket: int, arrived: float) -> None:
+        self.key = key
+        self.ids = ids
+        self.bucket = bucket
+        self.arrived = arrived
+        self.waiters = []
+
+
+def _bucket(length: int) -> int:
+    """inputs are batched with those of the same power of two length, at least 16"""
+    bucket = 16
+    while bucket < length:
+        bucket *= 2
+    return bucket
+
+
+class EmbeddingBatcher:
+    """
+    Embeds inputs with the last hidden states of the base model, pooled and normalized to unit
+    length. Inputs of concurrent requests are batched on a background thread: it waits up to
+    max_wait_ms for more inputs, then runs the oldest input with up to max_batch_size others of the
+    same length bucket (and at most max_batch_tokens of padded tokens), so that little of a batch is
+    padding. Embeddings are kept in an LRU of cache_size by input, and an input that is already
+    waiting is embedded once for all requests. A batch runs under model_lock, so that it takes turns
+    with the generations on the same model.
+    """
+    _model: PreTrainedModel
+    _model_lock: threading.Lock
+    _hidden_layout: Tuple[int, int]
+    _encode: Callable[[str], List[int]]
+    _max_batch_size: int
+    _max_batch_tokens: int
+    _max_wait: float
+    _max_input_tokens: int
+    _cache_size: int
+    _pooling: str
+    _pad_token_id: int
+    _cache: "OrderedDict[Hashable, Tuple[List[float], int]]"  # LRU order, (embedding, tokens)
+    _cond: threading.Condition
+    _arrived: List[_EmbeddingRequest]
+    _pending: "OrderedDict[Hashable, _PendingInput]"  # arrival order
+    _closed: bool
+    _thread: threading.Thread
+    _hits: int
+    _misses: int
+    _batches: int
+    _tokens: int
+    _padded_tokens: int
+
+    def __init__(self, model: PreTrainedModel, hidden_layout: Tuple[int, int], encode: Callable[[str], List[int]],
+                 max_batch_size: int = 32, max_batch_tokens: int = 16384, max_wait_ms: float = 5,
+                 max_input_tokens: int = 8192, cache_size: int = 4096, pooling: Pooling = "mean",
+                 pad_token_id: int = 0, model_lock: Optional[threading.Lock] = None) -> None:
+        assert max_batch_size > 0, f"invalid max_batch_size: {max_batch_size}"
+        assert max_batch_tokens > 0, f"invalid max_batch_tokens: {max_batch_tokens}"
+        assert max_wait_ms >= 0, f"invalid max_wait_ms: {max_wait_ms}"
+        assert max_input_tokens > 0, f"invalid max_input_tokens: {max_input_tokens}"
+        assert cache_size >= 0, f"invalid cache_size: {cache_size}"
+        assert pooling in ("mean", "last"), f"invalid pooling: {pooling}"
+        self._model = model
+        self._model_lock = model_lock if model_lock is not None else threading.Lock()
+        self._hidden_layout = hidden_layout
+        self._encode = encode
+        self._max_batch_size = max_batch_size
+        self._max_batch_tokens = max_batch_tokens
+        self._max_wait = max_wait_ms / 1000
+        self._max_input_tokens = max_input_tokens
+        self._cache_size = cache_size
+        self._pooling = pooling
+        self._pad_token_id = pad_token_id
+        self._cache = OrderedDict()
+        self._cond = threading.Condition()
+        self._arrived = []
+        self._pending = OrderedDict()
+        self._closed = False
+        self._hits = 0
+        self._misses = 0
+        self._batches = 0
+        self._tokens = 0
+        self._padded_tokens = 0
+        self._thread = threading.Thread(
+            target=self._run, name="embedding-batcher", daemon=True)
+        self._thread.start()
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        lookups = self._hits + self._misses
+        return {
+            "cache_entries": len(self._cache),
+            "hits": self._hits,
+            "misses": self._misses,
+            "hit_rate": self._hits / lookups if lookups else 0.0,
+            "batches": self._batches,
+            "tokens": self._tokens,
+            "padded_tokens": self._padded_tokens,
+            # the share of the batched tokens that were real
+            "padding_efficiency": self._tokens / self._padded_tokens if self._padded_tokens else 1.0,
+        }
+
+    def submit(self, inputs: List[EmbeddingInput]) -> "Future[EmbeddingResult]":
+        request = _EmbeddingRequest(list(inputs))
+        if not inputs:
+            request.future.set_result(EmbeddingResult([], 0))
+            return request.future
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("embedding batcher is shut down")
+            self._arrived.append(request)
+            self._cond.notify()
+        return request.future
+
+    def shutdown(self) -> None:
+        """stops the batcher thread once the submitted inputs are embedded"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def _cached(self, key: Hashable) -> Optional[Tuple[List[float], int]]:
+        entry = self._cache.get(key)
+        if entry is not None:
+            self._cache.move_to_end(key)
+        return entry
+
+    def _store(self, key: Hashable, entry: Tuple[List[float], int]) -> None:
+        if self._cache_size == 0:
+            return
+        self._cache[key] = entry
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+    def _admit(self, request: _EmbeddingRequest, now: float) -> None:
+        """tokenizes the inputs of request, answering those in the cache right away"""
+        try:
+            entries: List[Tuple[Hashable, List[int]]] = []
+            for input in request.inputs:
+                if isinstance(input, str):
+                    # texts are cached by text, so that a hit is not tokenized again
+                    key: Hashable = input
+                    ids = None if key in self._cache else self._encode(input)
+                else:
+                    key = tuple(input)
+                    ids = list(input)
+                if ids is not None:
+                    if not ids:
+                        raise EmbeddingInputError("an input has no tokens")
+                    if len(ids) > self._max_input_tokens:
+                        raise EmbeddingInputError(
+                            f"an input has {len(ids)} tokens, more than the {self._max_input_tokens} allowed")
+                entries.append((key, ids))
+        except Exception as e:
+            request.future.set_exception(e)
+            return
+        for index, (key, ids) in enumerate(entries):
+            cached = self._cached(key)
+            if cached is not None:
+                self._hits += 1
+                request.prompt_tokens += cached[1]
+                request.fill(index, cached[0])
+                continue
+            self._misses += 1
+            request.prompt_tokens += len(ids)
+            pending = self._pending.get(key)
+            if pending is None:
+                pending = self._pending[key] = _PendingInput(
+                    key, ids, _bucket(len(ids)), now)
+            pending.waiters.append((request, index))
+
+    def _take_batch(self) -> Optional[List[_PendingInput]]:
+        """waits for the inputs of the next batch, None once shut down and idle"""
+        while True:
+            with self._cond:
+                while not self._arrived and not self._pending:
+                    if self._closed:
+                        return None
+                    self._cond.wait()
+                arrived, self._arrived = self._arrived, []
+            # only this thread uses the pending inputs and the cache, tokenizing does not hold up submit()
+            now = time.perf_counter()
+            for request in arrived:
+                self._admit(request, now)
+            if not self._pending:
+                continue
+            oldest = next(iter(self._pending.values()))
+            delay = oldest.arrived + self._max_wait - now
+            if len(self._pending) >= self._max_batch_size or delay <= 0 or self._closed:
+                break
+            with self._cond:
+                if not self._arrived:
+                    self._cond.wait(delay)
+
+        batch: List[_PendingInput] = []
+        for pending in self._pending.values():
+            if pending.bucket != oldest.bucket:
+                continue
+            if batch and (len(batch) + 1) * oldest.bucket > self._max_batch_tokens:
+                break
+            batch.append(pending)
+            if len(batch) == self._max_batch_size:
+                break
+        for pending in batch:
+            del self._pending[pending.key]
+        return batch
+
+    def _run(self) -> None:
+        with torch.inference_mode():
+            while True:
+                batch = self._take_batch()
+                if batch is None:
+                    return
+                try:
+                    embeddings = self._embed([pending.ids for pending in batch])
+                except Exception as e:
+                    for pending in batch:
+                        for request, _ in pending.waiters:
+                            if not request.future.done():
+                                request.future.set_exception(e)
+                    continue
+                for pending, embedding in zip(batch, embeddings):
+                    self._store(pending.key, (embedding, len(pending.ids)))
+                    for request, index in pending.waiters:
+                        if not request.future.done():
+                            request.fill(index, embedding)
+
+    def _embed(self, batch_ids: List[List[int]]) -> List[List[float]]:
+        lengths = [len(ids) for ids in batch_ids]
+        length = max(lengths)
+        device = self._model.device
+        # right padding keeps the positions of the tokens, and causal attention keeps them from the padding
+        input_ids = torch.tensor([ids + [self._pad_token_id] * (length - len(ids)) for ids in batch_ids],
+                                 dtype=torch.long, device=device)
+        attention_mask = torch.tensor([[1] * n + [0] * (length - n) for n in lengths],
+                                      dtype=torch.long, device=device)
+        with self._model_lock:
+            outputs = self._model.base_model(
+                input_ids=input_ids, attention_mask=attention_mask, use_cache=False)
+        hidden = outputs[0]
+        if self._hidden_layout[0] != 0:
+            hidden = hidden.transpose(0, 1)
+        hidden = hidden.float()
+        if self._pooling == "mean":
+            mask = attention_mask.unsqueeze(-1).to(hidden.dtype)
+            pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1)
+        else:
+            last = torch.tensor([n - 1 for n in lengths], device=hidden.device)
+            pooled = hidden[torch.arange(len(lengths), device=hidden.device), last]
+        pooled = torch.nn.functional.normalize(pooled, dim=-1)
+        self._batches += 1
+        self._tokens += sum(lengths)
+        self._padded_tokens += len(lengths) * length
+        return pooled.cpu().tolist()
@@ -0,0 +1,162 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Iterator, Optional, TypeVar
+from adapter.cancel import CancelToken
+
+
+T = TypeVar("T")
+
+
+class ExecutorFullError(Exception):
+    pass
+
+
+class _End:
+    pass
+
+
+class _Raise:
+    error: BaseException
+
+    def __init__(self, error: BaseException) -> None:
+        self.error = error
+
+
+_END = _End()
+
+
+class InferenceExecutor:
+    """
+    Runs blocking inference calls on a fixed number of worker threads, so the event loop keeps serving
+    other requests. At most `max_workers` calls run at once and at most `max_queue_size` more wait for a
+    worker; anything beyond that is rejected with ExecutorFullError instead of piling up.
+    """
+    _max_workers: int
+    _max_queue_size: int
+    _pool: ThreadPoolExecutor
+    _lock: threading.Lock
+    _pending: int
+    _running: int
+
+    def __init__(self, max_workers: int = 1, max_queue_size: int = 64) -> None:
+        assert max_workers > 0, f"invalid max_workers: {max_workers}"
+        assert max_queue_size >= 0, f"invalid max_queue_size: {max_queue_size}"
+        self._max_workers = max_workers
+        self._max_queue_size = max_queue_size
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="inference")
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._running = 0
+
+    @property
+    def max_workers(self) -> int:
+        return self._max_workers
+
+    @property
+    def max_queue_size(self) -> int:
+        return self._max_queue_size
+
+    @property
+    def queue_depth(self) -> int:
+        """number of submitted calls waiting for a free worker"""
+        return self._pending - self._running
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    def _acquire(self) -> None:
+        with self._lock:
+            if self._pending >= self._max_workers + self._max_queue_size:
+                raise ExecutorFullError(
+                    f"inference queue is full ({self._max_queue_size} waiting)")
+            self._pending += 1
+
+    def _release(self) -> None:
+        with self._lock:
+            self._pending -= 1
+
+    def _call(self, fn: Callable[..., T], *args: Any) -> T:
+        with self._lock:
+            self._running += 1
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    def _submit(self, fn: Callable[..., T], *args: Any) -> "asyncio.Future[T]":
+        self._acquire()
+        try:
+            future = self._pool.submit(self._call, fn, *args)
+        except BaseException:
+            self._release()
+            raise
+        # the slot is held until the call really finishes (or is cancelled before it starts),
+        # not just until the awaiting coroutine gives up
+        future.add_done_callback(lambda _: self._release())
+        return asyncio.wrap_future(future)
+
+    async def run(self, fn: Callable[..., T], *args: Any) -> T:
+        """runs fn(*args) on a worker and awaits its result"""
+        return await self._submit(fn, *args)
+
+    def iterate(self, gen_fn: Callable[..., Iterator[T]], *args: Any,
+                cancel_token: Optional[CancelToken] = None) -> AsyncIterator[T]:
+        """
+        runs the sync generator returned by gen_fn(*args) on a worker and returns an async iterator over
+        its items. The call is submitted right away, so a full queue raises here and not mid-stream.
+        When cancel_token is cancelled, or the async iterator is closed before the end, the generator is
+        closed after its current item and a call still waiting for a worker is dropped.
+        """
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        if cancel_token is None:
+            cancel_token = CancelToken()
+
+        def put(item: Any) -> None:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+
+        def produce() -> None:
+            if cancel_token.cancelled:
+                return
+            gen = gen_fn(*args)
+            try:
+                for item in gen:
+                    if cancel_token.cancelled:
+                        break
+                    put(item)
+            except BaseException as e:
+                put(_Raise(e))
+                return
+            finally:
+                if hasattr(gen, "close"):
+                    gen.close()
+            put(_END)
+
+        future = self._submit(produce)
+        return self._drain(queue, future, cancel_token)
+
+    async def _drain(self, queue: asyncio.Queue, future: "asyncio.Future[None]",
+                     cancel_token: CancelToken) -> AsyncIterator[Any]:
+        finished = False
+        try:
+            while True:
+                item = await queue.get()
+                if item is _END:
+                    break
+                if isinstance(item, _Raise):
+                    finished = True
+                    raise item.error
+                yield item
+            finished = True
+            await future
+        finally:
+            if not finished:
+                cancel_token.cancel()
+                future.cancel()
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._pool.shutdown(wait=wait)
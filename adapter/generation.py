@@ -0,0 +1,670 @@
+import inspect
+import queue
+import threading
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple, TYPE_CHECKING
+import torch
+from transformers import PreTrainedModel
+from adapter.cancel import record_cancellation
+from adapter.chat_completion import GenerationParams
+
+if TYPE_CHECKING:
+    from adapter.prefix_cache import PrefixCache
+
+
+# past_key_values in the legacy layout: one tuple of (key, value, ...) tensors per layer
+KVCache = Tuple[Tuple[torch.Tensor, ...], ...]
+
+
+def _to_legacy(past: Any) -> KVCache:
+    if isinstance(past, (tuple, list)):
+        return tuple(tuple(layer) for layer in past)
+    if hasattr(past, "to_legacy_cache"):
+        return past.to_legacy_cache()
+    return tuple((layer.keys, layer.values) for layer in past.layers)
+
+
+def kv_map(past: KVCache, fn) -> KVCache:
+    return tuple(tuple(fn(t) for t in layer) for layer in past)
+
+
+def kv_length(past: KVCache, layout: Tuple[int, int]) -> int:
+    return past[0][0].shape[layout[1]]
+
+
+def kv_select(past: KVCache, layout: Tuple[int, int], indices: torch.Tensor) -> KVCache:
+    """keeps the batch rows in indices"""
+    return kv_map(past, lambda t: t.index_select(layout[0], indices.to(t.device)))
+
+
+def kv_slice(past: KVCache, layout: Tuple[int, int], start: int, end: int) -> KVCache:
+    """keeps the sequence positions [start, end)"""
+    return kv_map(past, lambda t: t.narrow(layout[1], start, end - start))
+
+
+def kv_left_pad(past: KVCache, layout: Tuple[int, int], pad: int) -> KVCache:
+    if pad == 0:
+        return past
+
+    def fn(t: torch.Tensor) -> torch.Tensor:
+        shape = list(t.shape)
+        shape[layout[1]] = pad
+        return torch.cat([t.new_zeros(shape), t], dim=layout[1])
+    return kv_map(past, fn)
+
+
+def kv_concat(pasts: Sequence[KVCache], layout: Tuple[int, int]) -> KVCache:
+    """concatenates batches whose caches have the same length"""
+    return tuple(
+        tuple(torch.cat([past[i][j] for past in pasts], dim=layout[0])
+              for j in range(len(pasts[0][i])))
+        for i in range(len(pasts[0])))
+
+
+class ModelRunner:
+    """
+    Calls the causal LM forward with an explicit attention mask and position ids, and keeps the
+    past_key_values in the legacy tuple layout so that batches can be spliced between steps. Each
+    forward holds lock, which the other users of the model (e.g. embeddings) share.
+    """
+    _model: PreTrainedModel
+    _kv_layout: Tuple[int, int]
+    _lock: threading.Lock
+    _accepts_position_ids: bool
+    _cache_class: Optional[type]
+
+    def __init__(self, model: PreTrainedModel, kv_layout: Tuple[int, int],
+                 lock: Optional[threading.Lock] = None) -> None:
+        self._model = model
+        self._kv_layout = kv_layout
+        self._lock = lock if lock is not None else threading.Lock()
+        params = inspect.signature(model.forward).parameters
+        self._accepts_position_ids = "position_ids" in params
+        self._cache_class = None
+
+    @property
+    def kv_layout(self) -> Tuple[int, int]:
+        return self._kv_layout
+
+    @property
+    def device(self) -> torch.device:
+        return self._model.device
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, position_ids: torch.Tensor,
+                past: Optional[KVCache], all_positions: bool = False) -> Tuple[torch.Tensor, KVCache]:
+        """
+        returns the logits of the last position [batch, vocab], or of every input position
+        [batch, length, vocab] with all_positions, and the updated cache
+        """
+        kwargs = {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "use_cache": True,
+        }
+        if self._accepts_position_ids:
+            kwargs["position_ids"] = position_ids
+        if past is not None:
+            if self._cache_class is None:
+                kwargs["past_key_values"] = past
+            elif hasattr(self._cache_class, "from_legacy_cache"):
+                kwargs["past_key_values"] = self._cache_class.from_legacy_cache(past)
+            else:
+                kwargs["past_key_values"] = self._cache_class(past)
+        with self._lock:
+            outputs = self._model(**kwargs)
+        new_past = outputs.past_key_values
+        if not isinstance(new_past, (tuple, list)):
+            # newer transformers return Cache objects, hand the same kind back next time
+            self._cache_class = type(new_past)
+        logits = outputs.logits if all_positions else outputs.logits[:, -1, :]
+        return logits, _to_legacy(new_past)
+
+    def prefill(self, input_ids: List[int], past: Optional[KVCache] = None) -> Tuple[torch.Tensor, KVCache]:
+        """runs a single prompt, optionally continuing a cache that holds its first tokens"""
+        start = 0 if past is None else kv_length(past, self._kv_layout)
+        ids = torch.tensor([input_ids[start:]], dtype=torch.long, device=self.device)
+        attention_mask = torch.ones(
+            (1, len(input_ids)), dtype=torch.long, device=self.device)
+        position_ids = torch.arange(
+            start, len(input_ids), dtype=torch.long, device=self.device).unsqueeze(0)
+        return self.forward(ids, attention_mask, position_ids, past)
+
+
+class Sampler:
+    """
+    Samples one token per row from a batch of logits, every row with its own parameters.
+    Rows are added with the token ids already seen (for the repetition penalty) and removed by index.
+    """
+    _params: List[GenerationParams]
+    _seen: Optional[torch.Tensor]
+    _tensors: Optional[Tuple[torch.Tensor, ...]]
+
+    def __init__(self) -> None:
+        self._params = []
+        self._seen = None
+        self._tensors = None
+
+    def __len__(self) -> int:
+        return len(self._params)
+
+    def add(self, params: GenerationParams, seen_ids: List[int], logits: torch.Tensor, count: int = 1) -> None:
+        """adds count rows for sequences sharing a prompt, logits [1, vocab] is their first step"""
+        device = logits.device
+        row = torch.zeros(
+            (1, logits.shape[-1]), dtype=torch.bool, device=device)
+        if seen_ids:
+            row[0, torch.tensor(seen_ids, dtype=torch.long, device=device)] = True
+        rows = row.expand(count, -1).clone()
+        self._seen = rows if self._seen is None else torch.cat(
+            [self._seen, rows])
+        self._params.extend([params] * count)
+        self._tensors = None
+
+    def extend(self, other: "Sampler") -> None:
+        self._seen = other._seen if self._seen is None else torch.cat(
+            [self._seen, other._seen])
+        self._params.extend(other._params)
+        self._tensors = None
+
+    def select(self, indices: List[int]) -> None:
+        self._params = [self._params[i] for i in indices]
+        if indices:
+            self._seen = self._seen.index_select(0, torch.tensor(
+                indices, dtype=torch.long, device=self._seen.device))
+        else:
+            self._seen = None
+        self._tensors = None
+
+    def _build_tensors(self, device: torch.device) -> Tuple[torch.Tensor, ...]:
+        if self._tensors is None:
+            params = self._params
+            self._tensors = (
+                torch.tensor([not p.do_sample or p.temperature <= 0 for p in params],
+                             dtype=torch.bool, device=device),
+                torch.tensor([max(p.temperature, 1e-5) for p in params],
+                             dtype=torch.float, device=device).unsqueeze(1),
+                torch.tensor([p.top_p for p in params],
+                             dtype=torch.float, device=device).unsqueeze(1),
+                torch.tensor([p.top_k for p in params],
+                             dtype=torch.long, device=device).unsqueeze(1),
+                torch.tensor([p.repetition_penalty for p in params],
+                             dtype=torch.float, device=device).unsqueeze(1),
+            )
+        return self._tensors
+
+    def sample(self, logits: torch.Tensor) -> torch.Tensor:
+        """logits [batch, vocab] -> token ids [batch]"""
+        logits = logits.float()
+        greedy, temperature, top_p, top_k, penalty = self._build_tensors(
+            logits.device)
+
+        if bool((penalty != 1.0).any()):
+            penalized = torch.where(logits > 0, logits / penalty, logits * penalty)
+            logits = torch.where(self._seen, penalized, logits)
+
+        next_ids = logits.argmax(dim=-1)
+        if bool(greedy.all()):
+            return next_ids
+
+        sorted_logits, sorted_ids = torch.sort(
+            logits / temperature, dim=-1, descending=True)
+        ranks = torch.arange(
+            sorted_logits.shape[1], device=logits.device).unsqueeze(0)
+        sorted_logits = sorted_logits.masked_fill(
+            (top_k > 0) & (ranks >= top_k), float("-inf"))
+        probs = sorted_logits.softmax(dim=-1)
+        # drop the tail outside top_p, the most likely token always stays
+        sorted_logits = sorted_logits.masked_fill(
+            probs.cumsum(dim=-1) - probs > top_p, float("-inf"))
+        choice = torch.multinomial(sorted_logits.softmax(dim=-1), 1)
+        sampled_ids = sorted_ids.gather(1, choice).squeeze(1)
+        return torch.where(greedy, next_ids, sampled_ids)
+
+    def update(self, token_ids: torch.Tensor) -> None:
+        """marks the sampled tokens as seen"""
+        rows = torch.arange(token_ids.shape[0], device=self._seen.device)
+        self._seen[rows, token_ids.to(self._seen.device)] = True
+
+
+class TokenEvent(NamedTuple):
+    index: int  # sequence index within the request
+    token_id: Optional[int]  # None when the sequence finished
+    finish_reason: Optional[str] = None
+
+
+class GenerationRequest:
+    """
+    A prompt with params.n sequences sampled from it. Iterating it yields the TokenEvents of all its
+    sequences in the order they are generated, eos tokens are not yielded.
+    """
+    input_ids: List[int]
+    params: GenerationParams
+    output_ids: List[List[int]]
+    finish_reasons: List[Optional[str]]
+    _aborted: List[Optional[str]]  # finish reason of sequences to stop at the next step
+    _cancelled: bool
+    _queue: "queue.SimpleQueue"
+    _offset: int  # added to the sequence index of the events
+
+    def __init__(self, input_ids: List[int], params: GenerationParams,
+                 events: Optional["queue.SimpleQueue"] = None, offset: int = 0) -> None:
+        self.input_ids = input_ids
+        self.params = params
+        self.output_ids = [[] for _ in range(params.n)]
+        self.finish_reasons = [None] * params.n
+        self._aborted = [None] * params.n
+        self._cancelled = False
+        self._queue = events if events is not None else queue.SimpleQueue()
+        self._offset = offset
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    def abort(self, index: int) -> None:
+        """
+        stops generating sequence index before the next decode step, it finishes with reason "stop".
+        Tokens it generated in the meantime are still yielded.
+        """
+        if self._aborted[index] is None:
+            self._aborted[index] = "stop"
+
+    def cancel(self) -> None:
+        """
+        stops generating all sequences before the next decode step, unfinished ones finish with
+        reason "cancelled". Meant for a consumer that gives up, can be called from any thread.
+        """
+        if self._cancelled:
+            return
+        self._cancelled = True
+        unfinished = [index for index in range(self.params.n)
+                      if self.finish_reasons[index] is None and self._aborted[index] is None]
+        if not unfinished:
+            return
+        avoided_tokens = 0
+        for index in unfinished:
+            self._aborted[index] = "cancelled"
+            avoided_tokens += max(self.params.max_new_tokens -
+                                  len(self.output_ids[index]), 0)
+        record_cancellation(avoided_tokens)
+
+    def _get(self) -> Any:
+        return self._queue.get()
+
+    def __iter__(self) -> Iterator[TokenEvent]:
+        unfinished = self.params.n
+        while unfinished > 0:
+            event = self._get()
+            if isinstance(event, BaseException):
+                raise event
+            if event.token_id is None:
+                unfinished -= 1
+            yield event
+
+    def _put(self, index: int, token_id: int) -> None:
+        self.output_ids[index].append(token_id)
+        self._queue.put(TokenEvent(self._offset + index, token_id))
+
+    def _finish(self, index: int, reason: str) -> None:
+        self.finish_reasons[index] = reason
+        self._queue.put(TokenEvent(self._offset + index, None, reason))
+
+    def _fail(self, error: BaseException) -> None:
+        self._queue.put(error)
+
+
+class GenerationGroup:
+    """
+    The requests of several prompts with the same params, generated together. Iterating the group
+    yields the TokenEvents of all of them, sequence i of prompt p has index p * params.n + i.
+    """
+    requests: List[GenerationRequest]
+    params: GenerationParams
+    _queue: "queue.SimpleQueue"
+
+    def __init__(self, input_ids: List[List[int]], params: GenerationParams) -> None:
+        self.params = params
+        self._queue = queue.SimpleQueue()
+        self.requests = [GenerationRequest(ids, params, self._queue, p * params.n)
+                         for p, ids in enumerate(input_ids)]
+
+    def abort(self, index: int) -> None:
+        self.requests[index // self.params.n].abort(index % self.params.n)
+
+    def cancel(self) -> None:
+        for request in self.requests:
+            request.cancel()
+
+    def _get(self) -> Any:
+        return self._queue.get()
+
+    def __iter__(self) -> Iterator[TokenEvent]:
+        unfinished = len(self.requests) * self.params.n
+        while unfinished > 0:
+            event = self._get()
+            if isinstance(event, BaseException):
+                raise event
+            if event.token_id is None:
+                unfinished -= 1
+            yield event
+
+
+def _bucket(length: int) -> int:
+    """prompts are prefilled together with those of the same power of two length, at least 16"""
+    bucket = 16
+    while bucket < length:
+        bucket *= 2
+    return bucket
+
+
+class DecodeBatch:
+    """
+    The running sequences of one model, one row each in a left-padded cache. A request is prefilled
+    once and its n sequences join as rows sharing the prompt cache; rows leave as soon as they finish,
+    so rows of other requests can join between decode steps.
+    """
+    _runner: ModelRunner
+    _eos_token_ids: frozenset
+    prefix_cache: Optional["PrefixCache"]
+    _rows: List[Tuple[GenerationRequest, int]]
+    _past: Optional[KVCache]
+    _attention_mask: Optional[torch.Tensor]  # [rows, cache length]
+    _positions: Optional[torch.Tensor]  # [rows] position id of the next input token
+    _next_ids: Optional[torch.Tensor]  # [rows] sampled tokens not yet fed to the model
+    _sampler: Sampler
+
+    def __init__(self, runner: ModelRunner, eos_token_ids: List[int], prefix_cache: Optional["PrefixCache"] = None) -> None:
+        self._runner = runner
+        self._eos_token_ids = frozenset(eos_token_ids)
+        self.prefix_cache = prefix_cache
+        self.reset()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def reset(self) -> None:
+        self._rows = []
+        self._past = None
+        self._attention_mask = None
+        self._positions = None
+        self._next_ids = None
+        self._sampler = Sampler()
+
+    def fail(self, error: BaseException) -> None:
+        for request in {id(request): request for request, _ in self._rows}.values():
+            request._fail(error)
+        self.reset()
+
+    def _emit(self, request: GenerationRequest, index: int, token_id: int) -> bool:
+        """hands a sampled token to its sequence, returns False when the sequence is finished"""
+        if token_id in self._eos_token_ids:
+            request._finish(index, "stop")
+            return False
+        request._put(index, token_id)
+        if len(request.output_ids[index]) >= request.params.max_new_tokens:
+            request._finish(index, "length")
+            return False
+        return True
+
+    def _finish_cancelled(self, request: GenerationRequest) -> bool:
+        if not request.cancelled:
+            return False
+        for index in range(request.params.n):
+            request._finish(index, "cancelled")
+        return True
+
+    def prefill(self, request: GenerationRequest) -> None:
+        if self._finish_cancelled(request):
+            return
+        cached: Optional[KVCache] = None
+        if self.prefix_cache is not None:
+            _, cached = self.prefix_cache.lookup(request.input_ids)
+        self._prefill_one(request, cached)
+
+    def _prefill_one(self, request: GenerationRequest, cached: Optional[KVCache]) -> None:
+        logits, past = self._runner.prefill(request.input_ids, cached)
+        if self.prefix_cache is not None:
+            self.prefix_cache.insert(request.input_ids, past)
+        rows = self._start(request, logits, past)
+        if rows is not None:
+            self._join(*rows)
+
+    def prefill_many(self, requests: List[GenerationRequest]) -> None:
+        """
+        prefills requests, those without a cached prefix in one left-padded forward pass per length
+        bucket. A request whose prefill fails gets the error, the others still join.
+        """
+        buckets: Dict[int, List[GenerationRequest]] = {}
+        for request in requests:
+            try:
+                if self._finish_cancelled(request):
+                    continue
+                cached: Optional[KVCache] = None
+                if self.prefix_cache is not None:
+                    _, cached = self.prefix_cache.lookup(request.input_ids)
+                if cached is not None:
+                    self._prefill_one(request, cached)
+                else:
+                    buckets.setdefault(
+                        _bucket(len(request.input_ids)), []).append(request)
+            except Exception as e:
+                request._fail(e)
+        for bucket in buckets.values():
+            try:
+                if len(bucket) == 1:
+                    self._prefill_one(bucket[0], None)
+                else:
+                    self._prefill_batch(bucket)
+            except Exception as e:
+                for request in bucket:
+                    request._fail(e)
+
+    def _prefill_batch(self, requests: List[GenerationRequest]) -> None:
+        layout = self._runner.kv_layout
+        device = self._runner.device
+        lengths = [len(request.input_ids) for request in requests]
+        length = max(lengths)
+        # padding is never attended to, any token id does
+        input_ids = torch.tensor([[0] * (length - len(request.input_ids)) + request.input_ids
+                                  for request in requests], dtype=torch.long, device=device)
+        attention_mask = torch.tensor([[0] * (length - n) + [1] * n for n in lengths],
+                                      dtype=torch.long, device=device)
+        position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)
+        logits, past = self._runner.forward(
+            input_ids, attention_mask, position_ids, None)
+        rows: List[Tuple[GenerationRequest, int]] = []
+        pasts: List[KVCache] = []
+        masks: List[torch.Tensor] = []
+        next_ids: List[torch.Tensor] = []
+        sampler = Sampler()
+        for i, request in enumerate(requests):
+            row_past = kv_select(past, layout, torch.tensor([i]))
+            if self.prefix_cache is not None:
+                self.prefix_cache.insert(request.input_ids, kv_slice(
+                    row_past, layout, length - lengths[i], length))
+            started = self._start(
+                request, logits[i:i + 1], row_past, attention_mask[i:i + 1])
+            if started is None:
+                continue
+            rows.extend(started[0])
+            pasts.append(started[1])
+            next_ids.append(started[2])
+            sampler.extend(started[3])
+            masks.append(started[4])
+        if rows:
+            self._join(rows, kv_concat(pasts, layout), torch.cat(next_ids), sampler,
+                       torch.cat(masks))
+
+    def _start(self, request: GenerationRequest, logits: torch.Tensor, past: KVCache,
+               attention_mask: Optional[torch.Tensor] = None) -> Optional[Tuple[Any, ...]]:
+        """samples the first tokens of a prefilled request, returns the arguments of _join for its running rows"""
+        n = request.params.n
+        sampler = Sampler()
+        sampler.add(request.params, request.input_ids, logits, count=n)
+        next_ids = sampler.sample(logits.expand(n, -1))
+        sampler.update(next_ids)
+        keep = [i for i, token_id in enumerate(next_ids.tolist())
+                if self._emit(request, i, token_id)]
+        if not keep:
+            return None
+        # every sequence continues from the same prompt cache
+        past = kv_select(past, self._runner.kv_layout, torch.zeros(
+            len(keep), dtype=torch.long))
+        if attention_mask is not None:
+            attention_mask = attention_mask.expand(len(keep), -1)
+        sampler.select(keep)
+        return [(request, i) for i in keep], past, next_ids[keep], sampler, attention_mask
+
+    def _join(self, rows: List[Tuple[GenerationRequest, int]], past: KVCache, next_ids: torch.Tensor,
+              sampler: Sampler, attention_mask: Optional[torch.Tensor] = None) -> None:
+        """adds rows to the batch, attention_mask tells the padding of past, which has none without"""
+        layout = self._runner.kv_layout
+        device = self._runner.device
+        count = len(rows)
+        length = kv_length(past, layout)
+        if attention_mask is None:
+            attention_mask = torch.ones(
+                (count, length), dtype=torch.long, device=device)
+        positions = attention_mask.sum(dim=1)
+        next_ids = next_ids.to(device)
+        if self._past is None:
+            self._past = past
+            self._attention_mask = attention_mask
+            self._positions = positions
+            self._next_ids = next_ids
+        else:
+            batch_length = kv_length(self._past, layout)
+            if length < batch_length:
+                past = kv_left_pad(past, layout, batch_length - length)
+                attention_mask = torch.cat([attention_mask.new_zeros(
+                    (count, batch_length - length)), attention_mask], dim=1)
+            elif length > batch_length:
+                self._past = kv_left_pad(
+                    self._past, layout, length - batch_length)
+                self._attention_mask = torch.cat([self._attention_mask.new_zeros(
+                    (len(self._rows), length - batch_length)), self._attention_mask], dim=1)
+            self._past = kv_concat([self._past, past], layout)
+            self._attention_mask = torch.cat(
+                [self._attention_mask, attention_mask])
+            self._positions = torch.cat([self._positions, positions])
+            self._next_ids = torch.cat([self._next_ids, next_ids])
+        self._rows.extend(rows)
+        self._sampler.extend(sampler)
+
+    def step(self) -> None:
+        """runs one decode step for all rows"""
+        aborted = {i for i, (request, index) in enumerate(self._rows)
+                   if request._aborted[index] is not None}
+        if aborted:
+            for i in aborted:
+                request, index = self._rows[i]
+                request._finish(index, request._aborted[index])
+            self._retain([i for i in range(len(self._rows))
+                          if i not in aborted])
+            if not self._rows:
+                return
+        attention_mask = torch.cat([self._attention_mask, self._attention_mask.new_ones(
+            (len(self._rows), 1))], dim=1)
+        logits, self._past = self._runner.forward(
+            self._next_ids.unsqueeze(1), attention_mask, self._positions.unsqueeze(1), self._past)
+        self._attention_mask = attention_mask
+        self._positions = self._positions + 1
+        next_ids = self._sampler.sample(logits)
+        self._sampler.update(next_ids)
+        self._next_ids = next_ids.to(self._runner.device)
+
+        keep: List[int] = []
+        for i, token_id in enumerate(next_ids.tolist()):
+            request, index = self._rows[i]
+            if self._emit(request, index, token_id):
+                keep.append(i)
+            elif self.prefix_cache is not None and index == 0:
+                self._cache_row(i)
+        if len(keep) < len(self._rows):
+            self._retain(keep)
+
+    def _cache_row(self, row: int) -> None:
+        """caches the prompt and the completion of a finished row for the next turn of the chat"""
+        layout = self._runner.kv_layout
+        request, index = self._rows[row]
+        length = int(self._attention_mask[row].sum())
+        pad = self._attention_mask.shape[1] - length
+        past = kv_select(self._past, layout, torch.tensor([row]))
+        past = kv_slice(past, layout, pad, pad + length)
+        token_ids = (request.input_ids + request.output_ids[index])[:length]
+        self.prefix_cache.insert(token_ids, past)
+
+    def _retain(self, keep: List[int]) -> None:
+        if not keep:
+            self.reset()
+            return
+        layout = self._runner.kv_layout
+        indices = torch.tensor(keep, dtype=torch.long,
+                               device=self._runner.device)
+        self._rows = [self._rows[i] for i in keep]
+        self._past = kv_select(self._past, layout, indices)
+        self._attention_mask = self._attention_mask.index_select(0, indices)
+        self._positions = self._positions.index_select(0, indices)
+        self._next_ids = self._next_ids.index_select(0, indices)
+        self._sampler.select(keep)
+        # drop the leading columns that are padding for every remaining row
+        start = int(self._attention_mask.any(dim=0).long().argmax())
+        if start > 0:
+            length = self._attention_mask.shape[1]
+            self._past = kv_slice(self._past, layout, start, length)
+            self._attention_mask = self._attention_mask[:, start:]
+
+
+class _LocalGenerationRequest(GenerationRequest):
+    """a request that runs its own batch on the thread iterating it"""
+    _batch: DecodeBatch
+    _started: bool
+
+    def __init__(self, input_ids: List[int], params: GenerationParams, batch: DecodeBatch) -> None:
+        super().__init__(input_ids, params)
+        self._batch = batch
+        self._started = False
+
+    def _get(self) -> Any:
+        while self._queue.empty():
+            with torch.inference_mode():
+                if not self._started:
+                    self._started = True
+                    self._batch.prefill(self)
+                else:
+                    self._batch.step()
+        return self._queue.get()
+
+
+class _LocalGenerationGroup(GenerationGroup):
+    """a group that runs its own batch on the thread iterating it"""
+    _batch: DecodeBatch
+    _started: bool
+
+    def __init__(self, input_ids: List[List[int]], params: GenerationParams, batch: DecodeBatch) -> None:
+        super().__init__(input_ids, params)
+        self._batch = batch
+        self._started = False
+
+    def _get(self) -> Any:
+        while self._queue.empty():
+            with torch.inference_mode():
+                if not self._started:
+                    self._started = True
+                    self._batch.prefill_many(self.requests)
+                else:
+                    self._batch.step()
+        return self._queue.get()
+
+
+def generate(runner: ModelRunner, eos_token_ids: List[int], input_ids: List[int],
+             params: GenerationParams, prefix_cache: Optional["PrefixCache"] = None) -> GenerationRequest:
+    """generates the params.n sequences of a single prompt on the thread iterating the returned request"""
+    batch = DecodeBatch(runner, eos_token_ids, prefix_cache)
+    return _LocalGenerationRequest(input_ids, params, batch)
+
+
+def generate_many(runner: ModelRunner, eos_token_ids: List[int], input_ids: List[List[int]],
+                  params: GenerationParams, prefix_cache: Optional["PrefixCache"] = None) -> GenerationGroup:
+    """generates the params.n sequences of each prompt in one batch, on the thread iterating the returned group"""
+    batch = DecodeBatch(runner, eos_token_ids, prefix_cache)
+    return _LocalGenerationGroup(input_ids, params, batch)
@@ -0,0 +1,159 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Literal, Optional, Sequence
+from adapter.chat_completion import ChatCompletion, ChatMessage, GenerationParams
+
+
+LoadState = Literal["loading", "warming_up", "ready", "failed"]
+
+_logger = logging.getLogger(__name__)
+_local = threading.local()
+
+
+@contextmanager
+def load_stage(name: str) -> Iterator[None]:
+    """times a stage of loading a service, for the ServiceLoad running on this thread"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        load: Optional[ServiceLoad] = getattr(_local, "load", None)
+        if load is not None:
+            load._record(name, time.perf_counter() - start)
+
+
+def warm_up(service: ChatCompletion, prompt_tokens: Sequence[int], max_new_tokens: int = 8,
+            concurrency: int = 1) -> None:
+    """
+    runs greedy prompts of about each of prompt_tokens tokens, concurrency at a time, so that the
+    kernels and allocations of prefill and decode at those lengths are ready before the first request
+    """
+    params = GenerationParams(max_new_tokens=max_new_tokens, do_sample=False)
+    for tokens in prompt_tokens:
+        if service.supports_prompt_completion:
+            # a raw prompt takes the model itself, whatever the chat path is
+            def run() -> None:
+                service.complete_prompts(["hello " * tokens], params)
+        else:
+            def run() -> None:
+                service.complete(
+                    [ChatMessage(role="user", content="hello " * tokens)], params)
+        if concurrency == 1:
+            run()
+            continue
+        with ThreadPoolExecutor(concurrency) as pool:
+            for future in [pool.submit(run) for _ in range(concurrency)]:
+                future.result()
+
+
+class ServiceLoad:
+    """
+    Loads a service on a background thread, so that the server takes connections and answers its
+    health probes meanwhile, and then warms it up (see warm_up) unless warm_up_prompt_tokens is empty.
+    state goes from loading over warming_up to ready, or to failed with error. stages holds the seconds
+    of the loader ("load"), of the stages services time within it with load_stage() ("weights",
+    "tokenizer") and of "warm_up". close() closes the service, also one that finishes loading later.
+    """
+    _loader: Callable[[], ChatCompletion]
+    _warm_up_prompt_tokens: List[int]
+    _warm_up_max_tokens: int
+    _warm_up_concurrency: int
+    state: LoadState
+    error: Optional[str]
+    service: Optional[ChatCompletion]
+    _stages: Dict[str, float]
+    _lock: threading.Lock
+    _closed: bool
+    _done: threading.Event
+    _thread: Optional[threading.Thread]
+
+    def __init__(self, loader: Callable[[], ChatCompletion], warm_up_prompt_tokens: Sequence[int] = (),
+                 warm_up_max_tokens: int = 8, warm_up_concurrency: int = 1) -> None:
+        assert isinstance(loader, Callable), f"invalid loader: {loader}"
+        assert all(tokens > 0 for tokens in warm_up_prompt_tokens), \
+            f"invalid warm_up_prompt_tokens: {warm_up_prompt_tokens}"
+        assert warm_up_max_tokens > 0, f"invalid warm_up_max_tokens: {warm_up_max_tokens}"
+        assert warm_up_concurrency > 0, f"invalid warm_up_concurrency: {warm_up_concurrency}"
+        self._loader = loader
+        self._warm_up_prompt_tokens = list(warm_up_prompt_tokens)
+        self._warm_up_max_tokens = warm_up_max_tokens
+        self._warm_up_concurrency = warm_up_concurrency
+        self.state = "loading"
+        self.error = None
+        self.service = None
+        self._stages = {}
+        self._lock = threading.Lock()
+        self._closed = False
+        self._done = threading.Event()
+        self._thread = None
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    @property
+    def stages(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._stages)
+
+    def start(self) -> None:
+        self._thread = threading.Thread(
+            target=self._run, name="service-load", daemon=True)
+        self._thread.start()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """waits until the service is ready or failed, returns whether it is ready"""
+        self._done.wait(timeout)
+        return self.ready
+
+    def close(self) -> None:
+        """closes the service, or has the loading thread close it once it is loaded"""
+        with self._lock:
+            self._closed = True
+            service, self.service = self.service, None
+        if service is not None:
+            service.close()
+
+    def _record(self, name: str, seconds: float) -> None:
+        with self._lock:
+            # a stage that runs again, e.g. one tokenizer per replica, adds up
+            self._stages[name] = self._stages.get(name, 0.0) + seconds
+
+    def _run(self) -> None:
+        _local.load = self
+        try:
+            with load_stage("load"):
+                service = self._loader()
+            assert isinstance(
+                service, ChatCompletion), f"service_loader() return invalid serivce: {service}"
+            with self._lock:
+                closed = self._closed
+                if not closed:
+                    self.service = service
+            if closed:
+                # the server shut down while the service loaded, nothing else would close it
+                service.close()
+                self.error = "closed while loading"
+                self.state = "failed"
+            else:
+                if self._warm_up_prompt_tokens:
+                    self.state = "warming_up"
+                    with load_stage("warm_up"):
+                        warm_up(service, self._warm_up_prompt_tokens,
+                                self._warm_up_max_tokens, self._warm_up_concurrency)
+                self.state = "ready"
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            self.state = "failed"
+        finally:
+            _local.load = None
+            stages = ", ".join(f"{name} {seconds:.1f}s" for name,
+                               seconds in self.stages.items())
+            if self.error is not None:
+                _logger.error("service failed to load: %s (%s)", self.error, stages)
+            else:
+                _logger.info("service ready: %s", stages)
+            self._done.set()
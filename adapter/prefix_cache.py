@@ -0,0 +1,203 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+from adapter.generation import KVCache, kv_map, kv_length, kv_slice
+
+
+class _Node:
+    __slots__ = ("edge", "parent", "children", "entry")
+
+    edge: Tuple[int, ...]  # token ids on the edge from the parent
+    parent: Optional["_Node"]
+    children: Dict[int, "_Node"]  # keyed by the first token id of the child edge
+    entry: Optional["_Entry"]
+
+    def __init__(self, edge: Tuple[int, ...], parent: Optional["_Node"]) -> None:
+        self.edge = edge
+        self.parent = parent
+        self.children = {}
+        self.entry = None
+
+
+class _Entry:
+    __slots__ = ("node", "past", "nbytes")
+
+    node: _Node
+    past: KVCache
+    nbytes: int
+
+    def __init__(self, node: _Node, past: KVCache) -> None:
+        self.node = node
+        self.past = past
+        self.nbytes = sum(t.numel() * t.element_size()
+                          for layer in past for t in layer)
+
+
+def _common_prefix(a: Sequence[int], b: Sequence[int]) -> int:
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+class PrefixCache:
+    """
+    Keeps the past_key_values of earlier prompts in a radix tree over their token ids, so a new
+    prompt only prefills the tokens after its longest cached prefix. Entries are evicted in LRU
+    order once their tensors exceed max_bytes. An entry covers every prefix of its tokens, so
+    inserting a sequence drops the entries of its own prefixes.
+    """
+    _kv_layout: Tuple[int, int]
+    _max_bytes: int
+    _root: _Node
+    _entries: "OrderedDict[int, _Entry]"  # LRU order, keyed by id(entry)
+    _nbytes: int
+    _lock: threading.Lock
+    _lookups: int
+    _hits: int
+    _saved_tokens: int
+    _prefilled_tokens: int
+    _evictions: int
+
+    def __init__(self, kv_layout: Tuple[int, int], max_bytes: int) -> None:
+        assert max_bytes > 0, f"invalid max_bytes: {max_bytes}"
+        self._kv_layout = kv_layout
+        self._max_bytes = max_bytes
+        self._root = _Node((), None)
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self._lookups = 0
+        self._hits = 0
+        self._saved_tokens = 0
+        self._prefilled_tokens = 0
+        self._evictions = 0
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._nbytes,
+            "max_bytes": self._max_bytes,
+            "lookups": self._lookups,
+            "hits": self._hits,
+            "hit_rate": self._hits / self._lookups if self._lookups else 0.0,
+            "saved_tokens": self._saved_tokens,
+            "prefilled_tokens": self._prefilled_tokens,
+            "evictions": self._evictions,
+        }
+
+    def lookup(self, input_ids: List[int]) -> Tuple[int, Optional[KVCache]]:
+        """
+        returns the length of the longest cached prefix of input_ids and its cache. At least
+        the last token is left out, the prefill needs it to produce logits.
+        """
+        with self._lock:
+            self._lookups += 1
+            node = self._root
+            matched = 0
+            limit = len(input_ids) - 1
+            while matched < limit:
+                child = node.children.get(input_ids[matched])
+                if child is None:
+                    break
+                k = _common_prefix(child.edge, input_ids[matched:limit])
+                matched += k
+                node = child
+                if k < len(child.edge):
+                    break
+            if matched == 0:
+                self._prefilled_tokens += len(input_ids)
+                return 0, None
+            # every leaf holds an entry, and any entry below node starts with the matched tokens
+            while node.entry is None:
+                node = next(iter(node.children.values()))
+            entry = node.entry
+            self._entries.move_to_end(id(entry))
+            self._hits += 1
+            self._saved_tokens += matched
+            self._prefilled_tokens += len(input_ids) - matched
+            return matched, kv_slice(entry.past, self._kv_layout, 0, matched)
+
+    def insert(self, token_ids: List[int], past: KVCache) -> None:
+        """caches past, which holds exactly token_ids"""
+        assert kv_length(past, self._kv_layout) == len(token_ids), "cache does not match the token ids"
+        if not token_ids:
+            return
+        with self._lock:
+            node = self._root
+            matched = 0
+            while matched < len(token_ids):
+                child = node.children.get(token_ids[matched])
+                if child is None:
+                    new = _Node(tuple(token_ids[matched:]), node)
+                    node.children[new.edge[0]] = new
+                    node = new
+                    matched = len(token_ids)
+                    break
+                k = _common_prefix(child.edge, token_ids[matched:])
+                if k < len(child.edge):
+                    node = self._split(child, k)
+                else:
+                    node = child
+                matched += k
+
+            if node.children:
+                # a longer cached sequence already covers token_ids
+                descendant = node
+                while descendant.entry is None:
+                    descendant = next(iter(descendant.children.values()))
+                self._entries.move_to_end(id(descendant.entry))
+                return
+
+            entry = _Entry(node, kv_map(past, lambda t: t.contiguous()))
+            if entry.nbytes > self._max_bytes:
+                self._prune(node)
+                return
+            if node.entry is not None:
+                self._remove(node.entry)
+            ancestor = node.parent
+            while ancestor is not None:
+                if ancestor.entry is not None:
+                    self._remove(ancestor.entry)
+                ancestor = ancestor.parent
+            node.entry = entry
+            self._entries[id(entry)] = entry
+            self._nbytes += entry.nbytes
+            while self._nbytes > self._max_bytes:
+                lru = next(iter(self._entries.values()))
+                self._remove(lru)
+                self._prune(lru.node)
+                self._evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._root = _Node((), None)
+            self._entries.clear()
+            self._nbytes = 0
+
+    def _split(self, node: _Node, k: int) -> _Node:
+        """splits the edge of node after k tokens, returns the new middle node"""
+        parent = node.parent
+        middle = _Node(node.edge[:k], parent)
+        parent.children[middle.edge[0]] = middle
+        node.edge = node.edge[k:]
+        node.parent = middle
+        middle.children[node.edge[0]] = node
+        return middle
+
+    def _remove(self, entry: _Entry) -> None:
+        del self._entries[id(entry)]
+        self._nbytes -= entry.nbytes
+        entry.node.entry = None
+
+    def _prune(self, node: _Node) -> None:
+        """drops nodes left without entry and children, so that every leaf holds an entry"""
+        while node.parent is not None and node.entry is None and not node.children:
+            del node.parent.children[node.edge[0]]
+            node = node.parent
@@ -0,0 +1,241 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple, Union, TYPE_CHECKING
+from adapter.chat_completion import ChatMessage
+
+if TYPE_CHECKING:
+    from transformers import PreTrainedTokenizer
+
+
+class Conversation(NamedTuple):
+    system: str
+    history: List[Tuple[str, str]]  # (user, assistant) of the finished rounds
+    query: Optional[str]  # the user turn to answer, None when the messages end with the assistant
+
+
+def _join(parts: List[str]) -> str:
+    # the first non-empty part starts the text, so an empty message is dropped only at the start
+    text = ""
+    for part in parts:
+        text = part if text == "" else text + "\n" + part
+    return text
+
+
+def build_conversation(messages: List[ChatMessage], separate_system: bool = True,
+                       overwrite_system: bool = False) -> Conversation:
+    """
+    merges the messages into rounds: consecutive messages of the user (or of the assistant) are
+    joined by newlines. System messages are joined into the system prompt, or the last one wins with
+    overwrite_system; without separate_system they count as user messages.
+    """
+    systems: List[str] = []
+    history: List[Tuple[str, str]] = []
+    users: List[str] = []
+    assistants: List[str] = []
+    for message in messages:
+        if message.role == "system" and separate_system:
+            if overwrite_system:
+                systems = [message.content]
+            else:
+                systems.append(message.content)
+            continue
+        if message.role in ("user", "system"):
+            if assistants:
+                history.append((_join(users), _join(assistants)))
+                users, assistants = [], []
+            users.append(message.content)
+        else:
+            assistants.append(message.content)
+    if assistants:
+        history.append((_join(users), _join(assistants)))
+        query = None
+    else:
+        query = _join(users)
+    return Conversation(_join(systems), history, query)
+
+
+# a part of a template: a special token id, or text to encode, in which "{round}" is the number of the
+# round, "{content}" the message of the slot, and "{user}" and "{assistant}" those of a finished round
+TemplatePart = Union[str, int]
+# (system tokens, tokens of each finished round, query tokens or None) -> index of the first round to keep
+WindowFunction = Callable[[int, List[int], Optional[int]], int]
+
+
+class PromptTemplate:
+    """
+    How a model renders a conversation into token ids, the parts of each slot are concatenated:
+    prefix once, then system with the system prompt, round for each finished round, and query and
+    generation for the user turn to answer. Each text part is encoded on its own, so a message that
+    the model encodes separately is a part of its own, e.g. [user_token_id, "{content}"]. With
+    continuation the model tokenizes its whole prompt as one text, and text after the first is encoded
+    as it continues a text, see PromptBuilder. window drops the oldest rounds of long conversations,
+    and beyond max_tokens the prompt is cut from the left.
+    """
+    prefix: List[int]
+    system: List[TemplatePart]
+    round: List[TemplatePart]
+    query: List[TemplatePart]
+    generation: List[TemplatePart]
+    continuation: bool
+    sentinel: str
+    encode_kwargs: Dict[str, Any]  # passed to tokenizer.encode, which gets add_special_tokens=False otherwise
+    window: Optional[WindowFunction]
+    max_tokens: Optional[int]
+
+    def __init__(self, round: Sequence[TemplatePart], query: Sequence[TemplatePart],
+                 generation: Sequence[TemplatePart] = (), system: Sequence[TemplatePart] = (),
+                 prefix: Sequence[int] = (), continuation: bool = False, sentinel: str = "\n",
+                 encode_kwargs: Optional[Dict[str, Any]] = None, window: Optional[WindowFunction] = None,
+                 max_tokens: Optional[int] = None) -> None:
+        self.prefix = list(prefix)
+        self.system = list(system)
+        self.round = list(round)
+        self.query = list(query)
+        self.generation = list(generation)
+        self.continuation = continuation
+        self.sentinel = sentinel
+        self.encode_kwargs = encode_kwargs if encode_kwargs is not None else {}
+        self.window = window
+        self.max_tokens = max_tokens
+
+
+class PromptBuilder:
+    """
+    Builds the input ids of a conversation from a PromptTemplate, with the encoded ids of each text
+    part kept in an LRU of max_entries: a new turn of a conversation only encodes its new messages.
+
+    Tokenizers that encode a whole prompt at once (e.g. SentencePiece, which starts every text with a
+    word boundary) would encode a text differently when it starts the prompt than in its middle. So a
+    continuing text is encoded after the template's sentinel, whose ids are then cut off. Since the
+    model's own rendering is what counts, the first verify_count prompts are compared with the
+    reference the service passes to build(); on a difference the builder turns itself off and keeps
+    returning the reference.
+    """
+    _tokenizer: "PreTrainedTokenizer"
+    _template: PromptTemplate
+    _max_entries: int
+    _entries: "OrderedDict[Tuple[str, bool], Tuple[int, ...]]"  # LRU order, (text, continuation)
+    _sentinel_ids: List[int]
+    _lock: threading.Lock
+    _verify_remaining: int
+    _enabled: bool
+    _hits: int
+    _misses: int
+
+    def __init__(self, tokenizer: "PreTrainedTokenizer", template: PromptTemplate, max_entries: int = 4096,
+                 verify_count: int = 8) -> None:
+        assert max_entries > 0, f"invalid max_entries: {max_entries}"
+        self._tokenizer = tokenizer
+        self._template = template
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._verify_remaining = verify_count
+        self._enabled = True
+        self._hits = 0
+        self._misses = 0
+        self._sentinel_ids = self._encode_text(template.sentinel)
+
+    @property
+    def enabled(self) -> bool:
+        return self._enabled
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        lookups = self._hits + self._misses
+        return {
+            "enabled": self._enabled,
+            "entries": len(self._entries),
+            "hits": self._hits,
+            "misses": self._misses,
+            "hit_rate": self._hits / lookups if lookups else 0.0,
+        }
+
+    def _encode_text(self, text: str) -> List[int]:
+        kwargs = {"add_special_tokens": False, **self._template.encode_kwargs}
+        return self._tokenizer.encode(text, **kwargs)
+
+    def encode(self, text: str, continuation: bool = False) -> Tuple[int, ...]:
+        key = (text, continuation)
+        with self._lock:
+            ids = self._entries.get(key)
+            if ids is not None:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return ids
+            self._misses += 1
+        if continuation:
+            ids = self._encode_text(self._template.sentinel + text)
+            n = len(self._sentinel_ids)
+            # a text merging into the sentinel is left for the verification to find
+            ids = tuple(ids[n:] if ids[:n] == self._sentinel_ids else ids)
+        else:
+            ids = tuple(self._encode_text(text))
+        with self._lock:
+            self._entries[key] = ids
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+        return ids
+
+    def _render(self, parts: List[TemplatePart], values: Dict[str, Any], ids: List[int], started: bool) -> bool:
+        """appends the ids of parts to ids, started tells whether text came before"""
+        for part in parts:
+            if isinstance(part, int):
+                ids.append(part)
+                continue
+            text = part.format(**values)
+            if self._template.continuation and text == "":
+                continue
+            ids.extend(self.encode(
+                text, self._template.continuation and started))
+            started = True
+        return started
+
+    def _build(self, conversation: Conversation) -> List[int]:
+        template = self._template
+        system_ids: List[int] = []
+        started = self._render(template.system, {"content": conversation.system, "round": 0},
+                               system_ids, False)
+        first = 0
+        if template.window is not None:
+            # the ids are cached for the rendering below
+            round_lens: List[int] = []
+            for i, (user, assistant) in enumerate(conversation.history):
+                round_ids: List[int] = []
+                self._render(template.round, {"user": user, "assistant": assistant, "round": i + 1},
+                             round_ids, True)
+                round_lens.append(len(round_ids))
+            query_len: Optional[int] = None
+            if conversation.query is not None:
+                query_ids: List[int] = []
+                self._render(template.query, {"content": conversation.query, "round": len(round_lens) + 1},
+                             query_ids, True)
+                query_len = len(query_ids)
+            first = template.window(
+                len(template.prefix) + len(system_ids), round_lens, query_len)
+
+        ids: List[int] = list(template.prefix) + system_ids
+        for i, (user, assistant) in enumerate(conversation.history[first:]):
+            started = self._render(template.round, {"user": user, "assistant": assistant, "round": i + 1},
+                                   ids, started)
+        if conversation.query is not None:
+            values = {"content": conversation.query,
+                      "round": len(conversation.history) - first + 1}
+            started = self._render(template.query, values, ids, started)
+            self._render(template.generation, values, ids, started)
+        if template.max_tokens is not None:
+            ids = ids[-template.max_tokens:]
+        return ids
+
+    def build(self, conversation: Conversation, reference: Optional[Callable[[], List[int]]] = None) -> List[int]:
+        """the input ids of conversation, reference renders them the model's own way"""
+        if not self._enabled and reference is not None:
+            return reference()
+        ids = self._build(conversation)
+        if reference is not None and self._verify_remaining > 0:
+            self._verify_remaining -= 1
+            expected = reference()
+            if ids != expected:
+                self._enabled = False
+                return expected
+        return ids
@@ -0,0 +1,277 @@
+import time
+from typing import Any, Dict, List, Optional, Union, Literal
+from pydantic import BaseModel
+from adapter.chat_completion import CompletionResult, GenerationParams
+from adapter.context import ContextTrim
+
+
+class ChatCompletionFunctionCall(BaseModel):
+    name: str
+    arguments: str  # Arguments in JSON format
+
+
+class ChatCompletionMessage(BaseModel):
+    role: Literal["system", "user", "assistant", "function"]
+    content: Optional[str] = None  # content can be a string or null
+    name: Optional[str] = None
+    function_call: Optional[ChatCompletionFunctionCall] = None
+
+
+class ChatCompletionFunctionParam(BaseModel):
+    type: str
+    properties: Dict[str, Any]
+    required: Optional[List[str]]
+
+
+class ChatCompletionFunction(BaseModel):
+    name: str
+    description: Optional[str]
+    parameters: Union[ChatCompletionFunctionParam, Any]  # JSON Schema object
+
+
+class ChatCompletionStreamOptions(BaseModel):
+    include_usage: Optional[bool] = False  # send a last chunk with the usage of the request
+
+
+class ChatCompletionRequest(BaseModel):
+    """
+    see https://platform.openai.com/docs/api-reference/chat/create
+    """
+    model: str
+    messages: List[ChatCompletionMessage]
+    functions: Optional[List[ChatCompletionFunction]] = None
+    function_call: Optional[str] = None
+    temperature: Optional[float] = 1.0  # defaults to 1.0
+    top_p: Optional[float] = 1.0  # defaults to 1.0
+    n: Optional[int] = 1  # defaults to 1
+    stream: Optional[bool] = False  # defaults to False
+    stream_options: Optional[ChatCompletionStreamOptions] = None
+    stop: Optional[Union[str, list]] = None  # defaults to None
+    max_tokens: Optional[int] = 4096  # defaults to inf
+    presence_penalty: Optional[float] = 0  # defaults to 0
+    frequency_penalty: Optional[float] = 0  # defaults to 0
+    logit_bias: Optional[Dict[int, int]] = None  # defaults to None
+    user: Optional[str] = None  # the tenant of admission control
+    priority: Optional[Literal["high", "normal", "low"]] = None  # admission class, defaults to normal
+    deadline_ms: Optional[float] = None  # longest wait for admission, defaults to the server's
+
+
+class ChatCompletionChoice(BaseModel):
+    index: int
+    message: ChatCompletionMessage
+    finish_reason: str
+
+
+class ChatCompletionUsage(BaseModel):
+    prompt_tokens: int
+    completion_tokens: int
+    total_tokens: int
+
+
+class ChatCompletionContext(BaseModel):
+    """how the messages were trimmed to the context window of the server"""
+    strategy: str
+    original_tokens: int
+    prompt_tokens: int
+    dropped_messages: int
+    summarized: bool
+
+
+class ChatCompletionResponse(BaseModel):
+    id: str
+    object: Literal["chat.completion"] = "chat.completion"
+    created: int
+    model: str
+    choices: List[ChatCompletionChoice]
+    usage: ChatCompletionUsage
+    context: Optional[ChatCompletionContext] = None
+
+
+class ChatCompletionMessageRoleOnly(BaseModel):
+    role: Literal["assistant", "function"]
+
+
+class ChatCompletionMessageContentOnly(BaseModel):
+    content: Optional[str] = None  # content can be a string or null
+
+
+class ChatCompletionMessageEmpty(BaseModel):
+    pass
+
+
+class ChatCompletionChoiceDelta(BaseModel):
+    index: int
+    delta: Union[ChatCompletionMessageRoleOnly,
+                 ChatCompletionMessageContentOnly, ChatCompletionMessageEmpty]
+    finish_reason: Optional[str]
+
+
+class ChatCompletionStreamingResponse(BaseModel):
+    id: str
+    object: Literal["chat.completion.chunk"] = "chat.completion.chunk"
+    created: int
+    model: str
+    choices: List[ChatCompletionChoiceDelta]
+
+
+class ChatCompletionStreamingUsageResponse(ChatCompletionStreamingResponse):
+    usage: ChatCompletionUsage
+
+
+class Model(BaseModel):
+    id: str
+    object: Literal["model"] = "model"
+    created: int
+    owned_by: str
+    loaded: bool = True  # False for models that load on their first request
+
+
+class ModelsResponse(BaseModel):
+    object: Literal["list"] = "list"
+    data: List[Model]
+
+
+class SessionCreateRequest(BaseModel):
+    system: Optional[str] = None
+    messages: List[ChatCompletionMessage] = []  # the history the session starts with
+
+
+class SessionResponse(BaseModel):
+    id: str
+    object: Literal["chat.session"] = "chat.session"
+    created: int
+    messages: List[ChatCompletionMessage]
+
+
+class SessionDeleteResponse(BaseModel):
+    id: str
+    object: Literal["chat.session"] = "chat.session"
+    deleted: bool = True
+
+
+class EmbeddingRequest(BaseModel):
+    """
+    see https://platform.openai.com/docs/api-reference/embeddings/create
+    """
+    model: str
+    input: Union[str, List[str], List[int], List[List[int]]]  # texts, or their token ids
+    encoding_format: Literal["float", "base64"] = "float"
+    dimensions: Optional[int] = None  # the first dimensions of the embeddings, normalized again
+    user: Optional[str] = None
+
+
+class Embedding(BaseModel):
+    object: Literal["embedding"] = "embedding"
+    index: int
+    embedding: Union[List[float], str]  # base64 of little endian float32 with encoding_format base64
+
+
+class EmbeddingUsage(BaseModel):
+    prompt_tokens: int
+    total_tokens: int
+
+
+class EmbeddingResponse(BaseModel):
+    object: Literal["list"] = "list"
+    data: List[Embedding]
+    model: str
+    usage: EmbeddingUsage
+
+
+class TextCompletionRequest(BaseModel):
+    """
+    see https://platform.openai.com/docs/api-reference/completions/create
+    """
+    model: str
+    prompt: Union[str, List[str], List[int], List[List[int]]]  # prompts, or their token ids
+    suffix: Optional[str] = None  # not supported
+    max_tokens: Optional[int] = 16  # defaults to 16
+    temperature: Optional[float] = 1.0  # defaults to 1.0
+    top_p: Optional[float] = 1.0  # defaults to 1.0
+    n: Optional[int] = 1  # defaults to 1, choices per prompt
+    stream: Optional[bool] = False  # defaults to False
+    stream_options: Optional[ChatCompletionStreamOptions] = None
+    logprobs: Optional[int] = None  # not supported
+    echo: Optional[bool] = False  # choices start with their prompt
+    stop: Optional[Union[str, list]] = None  # defaults to None
+    presence_penalty: Optional[float] = 0  # defaults to 0
+    frequency_penalty: Optional[float] = 0  # defaults to 0
+    best_of: Optional[int] = None
+    logit_bias: Optional[Dict[int, int]] = None  # defaults to None
+    user: Optional[str] = None  # the tenant of admission control
+    priority: Optional[Literal["high", "normal", "low"]] = None  # admission class, defaults to normal
+    deadline_ms: Optional[float] = None  # longest wait for admission, defaults to the server's
+
+
+class TextCompletionChoice(BaseModel):
+    index: int
+    text: str
+    logprobs: Optional[Any] = None
+    finish_reason: str
+
+
+class TextCompletionResponse(BaseModel):
+    id: str
+    object: Literal["text_completion"] = "text_completion"
+    created: int
+    model: str
+    choices: List[TextCompletionChoice]
+    usage: ChatCompletionUsage
+
+
+class HealthResponse(BaseModel):
+    status: Literal["live", "not_started", "loading", "warming_up", "ready", "failed"]
+    stages: Dict[str, float] = {}  # seconds of each stage of loading the service
+    error: Optional[str] = None
+
+
+# conversions between the schemas and the service types, shared by the API and the batch runner
+
+def build_generation_params(req: Union[ChatCompletionRequest, TextCompletionRequest]) -> GenerationParams:
+    # only what the client did send, the rest falls back to the service defaults
+    values: Dict[str, Any] = {}
+    for field, name in [("temperature", "temperature"), ("top_p", "top_p"), ("max_tokens", "max_new_tokens"), ("n", "n")]:
+        value = getattr(req, field)
+        if field in req.model_fields_set and value is not None:
+            values[name] = value
+    if "temperature" in values:
+        values["do_sample"] = values["temperature"] > 0
+    if isinstance(req.stop, str):
+        values["stop"] = [req.stop]
+    elif req.stop:
+        values["stop"] = [str(stop) for stop in req.stop]
+    return GenerationParams(**values)
+
+
+def build_chat_compl_context(trim: Optional[ContextTrim]) -> Optional[ChatCompletionContext]:
+    if trim is None:
+        return None
+    return ChatCompletionContext(**trim._asdict())
+
+
+def build_chat_compl_resp_from_result(id: str, model: str, result: CompletionResult,
+                                      trim: Optional[ContextTrim] = None) -> ChatCompletionResponse:
+    prompt_tokens = result.usage.prompt_tokens
+    completion_tokens = result.usage.completion_tokens
+    total_tokens = prompt_tokens+completion_tokens
+
+    rsp = ChatCompletionResponse(
+        id=id,
+        created=int(time.time()),
+        model=model,
+        choices=[ChatCompletionChoice(
+            index=choice.index,
+            message=ChatCompletionMessage(
+                role="assistant",
+                content=choice.text,
+            ),
+            finish_reason=choice.finish_reason,
+        ) for choice in result.choices],
+        usage=ChatCompletionUsage(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=total_tokens,
+        ),
+        context=build_chat_compl_context(trim),
+    )
+    return rsp
@@ -0,0 +1,148 @@
+import gc
+import sys
+import threading
+from collections import OrderedDict
+from functools import partial
+from typing import Callable, Dict, List, NamedTuple, Optional
+from adapter.chat_completion import ChatCompletion, create_chat_completion_service
+
+
+class ModelInfo(NamedTuple):
+    name: str
+    owned_by: str
+    loaded: bool
+    memory_bytes: Optional[int]  # measured at the last load, None before the first one
+
+
+class ModelRegistry:
+    """
+    Chat completion services by model name, each loaded on its first request. Once the loaded services
+    hold more than max_memory_bytes, the least recently used ones are unloaded; requests already
+    running on an unloaded service still finish. A service whose size is known from an earlier load
+    makes room before it loads again.
+    """
+    _max_memory_bytes: int  # 0 for no limit
+    _loaders: Dict[str, Callable[[], ChatCompletion]]
+    _owners: Dict[str, str]
+    _loaded: "OrderedDict[str, ChatCompletion]"  # LRU order
+    _sizes: Dict[str, int]
+    _lock: threading.Lock
+    _load_lock: threading.Lock  # models load one at a time
+
+    def __init__(self, max_memory_bytes: int = 0) -> None:
+        assert max_memory_bytes >= 0, f"invalid max_memory_bytes: {max_memory_bytes}"
+        self._max_memory_bytes = max_memory_bytes
+        self._loaders = {}
+        self._owners = {}
+        self._loaded = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def register(self, name: str, loader: Callable[[], ChatCompletion], owned_by: str = "adapter") -> None:
+        assert isinstance(loader, Callable), f"invalid loader: {loader}"
+        with self._lock:
+            self._loaders[name] = loader
+            self._owners[name] = owned_by
+
+    def register_service(self, name: str, *args, **kwargs) -> None:
+        """registers a model served by the chat completion service registered under the same name"""
+        self.register(name, partial(
+            create_chat_completion_service, name, *args, **kwargs))
+
+    @property
+    def names(self) -> List[str]:
+        return list(self._loaders)
+
+    @property
+    def memory_bytes(self) -> int:
+        """bytes held by the loaded services"""
+        with self._lock:
+            return sum(self._sizes[name] for name in self._loaded)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._loaders
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._loaded
+
+    def models(self) -> List[ModelInfo]:
+        with self._lock:
+            return [ModelInfo(
+                name=name,
+                owned_by=self._owners[name],
+                loaded=name in self._loaded,
+                memory_bytes=self._sizes.get(name),
+            ) for name in self._loaders]
+
+    def get_loaded(self, name: str) -> Optional[ChatCompletion]:
+        """returns the service of a loaded model without loading it"""
+        with self._lock:
+            service = self._loaded.get(name)
+            if service is not None:
+                self._loaded.move_to_end(name)
+            return service
+
+    def get(self, name: str) -> ChatCompletion:
+        """returns the service of a model, loading it first if needed. Raises KeyError for unknown models."""
+        service = self.get_loaded(name)
+        if service is not None:
+            return service
+        if name not in self._loaders:
+            raise KeyError(name)
+        with self._load_lock:
+            # another request may have loaded it meanwhile
+            service = self.get_loaded(name)
+            if service is not None:
+                return service
+            with self._lock:
+                evicted = self._evict(self._sizes.get(name, 0))
+            self._close(evicted)
+            service = self._loaders[name]()
+            assert isinstance(
+                service, ChatCompletion), f"loader of {name} returned invalid service: {service}"
+            with self._lock:
+                self._loaded[name] = service
+                self._sizes[name] = service.memory_bytes
+                evicted = self._evict(0, keep=name)
+            self._close(evicted)
+            return service
+
+    def unload(self, name: str) -> bool:
+        with self._lock:
+            evicted = [self._loaded.pop(name)] if name in self._loaded else []
+        unloaded = len(evicted) > 0
+        self._close(evicted)
+        return unloaded
+
+    def close(self) -> None:
+        with self._lock:
+            evicted = list(self._loaded.values())
+            self._loaded.clear()
+        self._close(evicted)
+
+    def _evict(self, incoming_bytes: int, keep: Optional[str] = None) -> List[ChatCompletion]:
+        """pops LRU services until incoming_bytes more fit in the budget, keeps at least the one named keep"""
+        evicted: List[ChatCompletion] = []
+        if self._max_memory_bytes == 0:
+            return evicted
+        used = sum(self._sizes[name] for name in self._loaded)
+        for name in list(self._loaded):
+            if used + incoming_bytes <= self._max_memory_bytes:
+                break
+            if name == keep:
+                continue
+            evicted.append(self._loaded.pop(name))
+            used -= self._sizes[name]
+        return evicted
+
+    def _close(self, services: List[ChatCompletion]) -> None:
+        """closes services and frees their memory, the list is emptied to drop its references"""
+        if not services:
+            return
+        while services:
+            services.pop().close()
+        gc.collect()
+        torch = sys.modules.get("torch")
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
@@ -0,0 +1,461 @@
+import logging
+import multiprocessing
+import os
+import pickle
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing.connection import Connection
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union, TYPE_CHECKING
+from adapter.cancel import CancelToken
+from adapter.chat_completion import ChatCompletion, ChatMessage, CompletionDelta, CompletionResult, CompletionUsage, EmbeddingInput, EmbeddingResult, GenerationParams, Prompt
+
+if TYPE_CHECKING:
+    from adapter.embeddings import EmbeddingBatcher
+    from adapter.prefix_cache import PrefixCache
+    from adapter.speculative import SpeculativeDecoding
+
+
+_logger = logging.getLogger(__name__)
+
+
+class ReplicaError(Exception):
+    pass
+
+
+def _worker_main(loader: Callable[[], ChatCompletion], conn: Connection, max_concurrency: int) -> None:
+    """
+    runs in a replica process: loads the service, then runs the requests arriving on conn on up to
+    max_concurrency threads and sends their results back
+    """
+    send_lock = threading.Lock()
+
+    def send(message: Tuple[str, int, Any]) -> None:
+        with send_lock:
+            conn.send(message)
+
+    try:
+        service = loader()
+    except BaseException as e:
+        send(("failed", 0, f"{type(e).__name__}: {e}"))
+        return
+    tokens: Dict[int, CancelToken] = {}
+    pool = ThreadPoolExecutor(
+        max_workers=max_concurrency, thread_name_prefix="replica")
+
+    def send_error(rid: int, error: BaseException) -> None:
+        try:
+            pickle.dumps(error)
+        except Exception:
+            error = ReplicaError(f"{type(error).__name__}: {error}")
+        send(("error", rid, error))
+
+    def run(rid: int, method: str, messages: Any, params: Optional[GenerationParams]) -> None:
+        try:
+            if method == "complete":
+                send(("result", rid, service.complete(messages, params)))
+            elif method == "complete_prompts":
+                prompts, echo = messages
+                send(("result", rid, service.complete_prompts(prompts, params, echo)))
+            else:
+                if method == "stream_prompts":
+                    prompts, echo = messages
+                    items = service.complete_prompts_stream(
+                        prompts, params, tokens[rid], echo)
+                else:
+                    items = service.complete_stream(
+                        messages, params, tokens[rid])
+                for item in items:
+                    send(("item", rid, item))
+                send(("end", rid, None))
+        except Exception as e:
+            send_error(rid, e)
+        finally:
+            tokens.pop(rid, None)
+
+    def embed(rid: int, inputs: List[EmbeddingInput]) -> None:
+        # the embedding batcher has its own thread, the result is sent when it is done
+        def done(future: "Future[EmbeddingResult]") -> None:
+            error = future.exception()
+            if error is not None:
+                send_error(rid, error)
+            else:
+                send(("result", rid, future.result()))
+        try:
+            service.submit_embeddings(inputs).add_done_callback(done)
+        except Exception as e:
+            send_error(rid, e)
+
+    def count(rid: int, method: str, payload: Any) -> None:
+        try:
+            send(("result", rid, getattr(service, method)(payload)))
+        except Exception as e:
+            send_error(rid, e)
+
+    send(("ready", 0, os.getpid()))
+    while True:
+        try:
+            kind, rid, payload = conn.recv()
+        except (EOFError, OSError):
+            break
+        if kind == "shutdown":
+            break
+        if kind == "cancel":
+            token = tokens.get(rid)
+            if token is not None:
+                token.cancel()
+            continue
+        if payload[0] == "embed":
+            embed(rid, payload[1])
+            continue
+        if payload[0] in ("num_tokens", "num_prompt_tokens"):
+            # counting only takes the tokenizer, it does not wait for the generations on the pool
+            count(rid, payload[0], payload[1])
+            continue
+        tokens[rid] = CancelToken()
+        pool.submit(run, rid, *payload)
+    for token in list(tokens.values()):
+        token.cancel()
+    pool.shutdown(wait=True)
+    service.close()
+
+
+class _Replica:
+    index: int
+    process: multiprocessing.Process
+    conn: Connection
+    ready: bool
+    outstanding: int
+    _send_lock: threading.Lock
+
+    def __init__(self, index: int, process: multiprocessing.Process, conn: Connection) -> None:
+        self.index = index
+        self.process = process
+        self.conn = conn
+        self.ready = False
+        self.outstanding = 0
+        self._send_lock = threading.Lock()
+
+    def send(self, message: Tuple[str, int, Any]) -> None:
+        with self._send_lock:
+            self.conn.send(message)
+
+
+class _FutureResults:
+    """takes the results of a request in place of a queue, and completes future with them"""
+    _future: Future
+
+    def __init__(self, future: Future) -> None:
+        self._future = future
+
+    def put(self, result: Tuple[str, Any]) -> None:
+        kind, payload = result
+        if self._future.done():
+            return
+        if kind == "error":
+            self._future.set_exception(payload)
+        else:
+            self._future.set_result(payload)
+
+
+class ReplicaPool(ChatCompletion):
+    """
+    Serves chat completions from num_replicas worker processes, each with its own service built by
+    loader (which has to be picklable, e.g. a module level function). Each request goes to the replica
+    with the fewest outstanding requests, streamed deltas come back over a pipe per replica. A replica
+    that exits is started again after restart_delay seconds, its running requests fail with ReplicaError.
+    The pool holds no model itself: prefix caches, speculative decoding and embeddings are enabled by
+    loader in the replicas. A replica that fails to load keeps its error in stats until it is ready.
+    Tokens are counted by a replica too, without waiting for the requests it runs.
+    """
+    _loader: Callable[[], ChatCompletion]
+    _num_replicas: int
+    _max_concurrency: int
+    _restart_delay: float
+    _start_timeout: float
+    _context: Any  # multiprocessing context
+    _replicas: List[Optional[_Replica]]
+    _restarts: List[int]
+    _delays: List[float]  # doubles while a replica keeps exiting before it is ready
+    _errors: List[Optional[str]]  # why each replica failed to load, until it is ready
+    _requests: Dict[int, Tuple[_Replica, "queue.SimpleQueue"]]
+    _next_rid: int
+    _cond: threading.Condition
+    _closed: bool
+
+    def __init__(self, loader: Callable[[], ChatCompletion], num_replicas: int = 2, max_concurrency: int = 1,
+                 restart_delay: float = 1.0, start_timeout: float = 600, start_method: str = "spawn") -> None:
+        assert num_replicas > 0, f"invalid num_replicas: {num_replicas}"
+        assert max_concurrency > 0, f"invalid max_concurrency: {max_concurrency}"
+        self._loader = loader
+        self._num_replicas = num_replicas
+        self._max_concurrency = max_concurrency
+        self._restart_delay = restart_delay
+        self._start_timeout = start_timeout
+        self._context = multiprocessing.get_context(start_method)
+        self._replicas = [None] * num_replicas
+        self._restarts = [0] * num_replicas
+        self._delays = [restart_delay] * num_replicas
+        self._errors = [None] * num_replicas
+        self._requests = {}
+        self._next_rid = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        for index in range(num_replicas):
+            self._start(index)
+
+    def _start(self, index: int) -> None:
+        conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_worker_main,
+            args=(self._loader, child_conn, self._max_concurrency),
+            name=f"replica-{index}",
+            daemon=True,
+        )
+        process.start()
+        # only the child holds its end now, so the reader sees EOF when the child dies
+        child_conn.close()
+        replica = _Replica(index, process, conn)
+        with self._cond:
+            self._replicas[index] = replica
+        threading.Thread(target=self._read, args=(replica,),
+                         name=f"replica-{index}-reader", daemon=True).start()
+
+    def _read(self, replica: _Replica) -> None:
+        while True:
+            try:
+                kind, rid, payload = replica.conn.recv()
+            except (EOFError, OSError):
+                break
+            if kind == "ready":
+                with self._cond:
+                    replica.ready = True
+                    self._delays[replica.index] = self._restart_delay
+                    self._errors[replica.index] = None
+                    self._cond.notify_all()
+                continue
+            if kind == "failed":
+                _logger.error("replica %d failed to load: %s",
+                              replica.index, payload)
+                with self._cond:
+                    self._errors[replica.index] = payload
+                continue
+            pending = self._requests.get(rid)
+            if pending is not None:
+                pending[1].put((kind, payload))
+
+        replica.process.join()
+        with self._cond:
+            if not replica.ready:
+                self._delays[replica.index] = min(
+                    self._delays[replica.index] * 2, 60)
+            replica.ready = False
+            delay = self._delays[replica.index]
+            failed = [(rid, pending) for rid, pending in self._requests.items()
+                      if pending[0] is replica]
+            closed = self._closed
+        for rid, (_, results) in failed:
+            results.put(("error", ReplicaError(
+                f"replica {replica.index} exited with code {replica.process.exitcode}")))
+        replica.conn.close()
+        if closed:
+            return
+        _logger.warning("replica %d exited with code %s, restarting in %gs",
+                        replica.index, replica.process.exitcode, delay)
+        time.sleep(delay)
+        with self._cond:
+            if self._closed:
+                return
+            self._restarts[replica.index] += 1
+        self._start(replica.index)
+
+    @property
+    def num_replicas(self) -> int:
+        return self._num_replicas
+
+    @property
+    def stats(self) -> List[Dict[str, Any]]:
+        with self._cond:
+            return [{
+                "index": index,
+                "pid": replica.process.pid if replica is not None else None,
+                "ready": replica is not None and replica.ready,
+                "outstanding": replica.outstanding if replica is not None else 0,
+                "restarts": self._restarts[index],
+                "error": self._errors[index],
+            } for index, replica in enumerate(self._replicas)]
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """waits until every replica has loaded its service"""
+        with self._cond:
+            return self._cond.wait_for(lambda: all(
+                replica is not None and replica.ready for replica in self._replicas), timeout)
+
+    def _submit(self, method: str, messages: List[Any], params: Optional[GenerationParams],
+                results: Optional[Any] = None) -> Tuple[int, _Replica, Any]:
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._closed or any(
+                    replica is not None and replica.ready for replica in self._replicas), self._start_timeout):
+                errors = "; ".join(f"replica {index}: {error}" for index, error in enumerate(self._errors)
+                                   if error is not None)
+                raise ReplicaError(
+                    f"no replica is ready ({errors})" if errors else "no replica is ready")
+            if self._closed:
+                raise ReplicaError("replica pool is closed")
+            # least outstanding requests first, the lowest index on ties
+            replica = min((replica for replica in self._replicas if replica is not None and replica.ready),
+                          key=lambda replica: replica.outstanding)
+            rid = self._next_rid
+            self._next_rid += 1
+            if results is None:
+                results = queue.SimpleQueue()
+            self._requests[rid] = (replica, results)
+            replica.outstanding += 1
+        try:
+            replica.send(("run", rid, (method, messages, params)))
+        except (OSError, ValueError) as e:
+            self._finish(rid)
+            raise ReplicaError(
+                f"replica {replica.index} is not reachable: {e}") from e
+        return rid, replica, results
+
+    def _finish(self, rid: int) -> None:
+        with self._cond:
+            replica, _ = self._requests.pop(rid)
+            replica.outstanding -= 1
+
+    def _cancel(self, rid: int, replica: _Replica) -> None:
+        try:
+            replica.send(("cancel", rid, None))
+        except (OSError, ValueError):
+            # the replica is gone, and its requests with it
+            pass
+
+    def _result(self, method: str, payload: Any, params: Optional[GenerationParams]) -> Any:
+        rid, _, results = self._submit(method, payload, params)
+        try:
+            kind, payload = results.get()
+        finally:
+            self._finish(rid)
+        if kind == "error":
+            raise payload
+        return payload
+
+    def _start_stream(self, method: str, payload: Any, params: Optional[GenerationParams],
+                      cancel_token: Optional[CancelToken]) -> Iterator[Union[CompletionDelta, CompletionUsage]]:
+        # submitted right away, so that a pool without ready replicas fails before the stream starts
+        rid, replica, results = self._submit(method, payload, params)
+        if cancel_token is not None:
+            cancel_token.add_callback(lambda: self._cancel(rid, replica))
+        return self._stream(rid, replica, results)
+
+    def complete(self, messages: List[ChatMessage], params: Optional[GenerationParams] = None) -> CompletionResult:
+        return self._result("complete", messages, params)
+
+    def complete_stream(self, messages: List[ChatMessage], params: Optional[GenerationParams] = None,
+                        cancel_token: Optional[CancelToken] = None) -> Iterator[Union[CompletionDelta, CompletionUsage]]:
+        return self._start_stream("stream", messages, params, cancel_token)
+
+    @property
+    def supports_prompt_completion(self) -> bool:
+        # the replicas have the model
+        return True
+
+    def complete_prompts(self, prompts: List[Prompt], params: Optional[GenerationParams] = None,
+                         echo: bool = False) -> CompletionResult:
+        return self._result("complete_prompts", (prompts, echo), params)
+
+    def complete_prompts_stream(self, prompts: List[Prompt], params: Optional[GenerationParams] = None,
+                                cancel_token: Optional[CancelToken] = None,
+                                echo: bool = False) -> Iterator[Union[CompletionDelta, CompletionUsage]]:
+        return self._start_stream("stream_prompts", (prompts, echo), params, cancel_token)
+
+    def _stream(self, rid: int, replica: _Replica,
+                results: "queue.SimpleQueue") -> Iterator[Union[CompletionDelta, CompletionUsage]]:
+        done = False
+        try:
+            while True:
+                kind, payload = results.get()
+                if kind == "item":
+                    yield payload
+                    continue
+                done = True
+                if kind == "error":
+                    raise payload
+                return
+        finally:
+            if not done:
+                self._cancel(rid, replica)
+            self._finish(rid)
+
+    def submit_embeddings(self, inputs: List[EmbeddingInput]) -> "Future[EmbeddingResult]":
+        future: "Future[EmbeddingResult]" = Future()
+        rid, _, _ = self._submit("embed", inputs, None, _FutureResults(future))
+        future.add_done_callback(lambda _: self._finish(rid))
+        return future
+
+    def num_tokens(self, text: str) -> int:
+        # the replicas have the tokenizer
+        return self._result("num_tokens", text, None)
+
+    def num_prompt_tokens(self, messages: List[ChatMessage]) -> int:
+        return self._result("num_prompt_tokens", messages, None)
+
+    def chat(self, messages: List[ChatMessage]) -> str:
+        return self.complete(messages).choices[0].text
+
+    def chat_stream(self, messages: List[ChatMessage]) -> Iterator[str]:
+        for item in self.complete_stream(messages):
+            if isinstance(item, CompletionDelta):
+                yield item.text
+
+    def generation_params(self, params: Optional[GenerationParams] = None) -> GenerationParams:
+        # the defaults of the model are only known in the replicas, they apply them
+        return params if params is not None else GenerationParams()
+
+    def check_generation_params(self, params: Optional[GenerationParams] = None) -> None:
+        # the replicas check, a request they cannot generate fails there
+        pass
+
+    @property
+    def memory_bytes(self) -> int:
+        # replicas hold their memory in their own processes
+        return 0
+
+    @property
+    def prefix_cache(self) -> Optional["PrefixCache"]:
+        return None
+
+    def enable_prefix_cache(self, max_bytes: int) -> "PrefixCache":
+        raise TypeError("the replicas hold the models, enable the prefix cache in their loader")
+
+    @property
+    def speculative(self) -> Optional["SpeculativeDecoding"]:
+        return None
+
+    def enable_speculative_decoding(self, num_draft_tokens: int = 5, ngram_size: int = 3,
+                                    draft: Optional[ChatCompletion] = None) -> "SpeculativeDecoding":
+        raise TypeError("the replicas hold the models, enable speculative decoding in their loader")
+
+    @property
+    def embedder(self) -> Optional["EmbeddingBatcher"]:
+        return None
+
+    def enable_embeddings(self, *args, **kwargs) -> "EmbeddingBatcher":
+        raise TypeError("the replicas hold the models, enable embeddings in their loader")
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            replicas = [replica for replica in self._replicas if replica is not None]
+            self._cond.notify_all()
+        for replica in replicas:
+            try:
+                replica.send(("shutdown", 0, None))
+            except (OSError, ValueError):
+                pass
+        for replica in replicas:
+            replica.process.join(timeout=30)
+            if replica.process.is_alive():
+                replica.process.terminate()
@@ -0,0 +1,123 @@
+import json
+import queue
+import random
+import sys
+import threading
+import time
+from typing import Any, Dict, Optional, TextIO
+
+
+class RequestLog:
+    """
+    Writes one JSON line per request from a background thread, so that serving never waits for the
+    output. Records go through a queue of max_queue records and are dropped when it is full. Only a
+    sample_rate fraction of the successful requests (and of the ones whose client went away) is
+    logged, failed ones always are. Messages and completions are only logged with log_content, each
+    text cut to max_content_chars.
+    """
+    _stream: TextIO
+    _owns_stream: bool
+    _sample_rate: float
+    _log_content: bool
+    _max_content_chars: int
+    _queue: "queue.Queue[Optional[Dict[str, Any]]]"
+    _thread: threading.Thread
+    _written: int
+    _dropped: int
+
+    def __init__(self, stream: Optional[TextIO] = None, path: Optional[str] = None, sample_rate: float = 1.0,
+                 log_content: bool = False, max_content_chars: int = 1000, max_queue: int = 4096) -> None:
+        assert stream is None or path is None, "log to either a stream or a path"
+        assert 0 <= sample_rate <= 1, f"invalid sample_rate: {sample_rate}"
+        assert max_content_chars >= 0, f"invalid max_content_chars: {max_content_chars}"
+        assert max_queue > 0, f"invalid max_queue: {max_queue}"
+        if path is not None:
+            self._stream = open(path, "a", encoding="utf-8")
+            self._owns_stream = True
+        else:
+            self._stream = stream if stream is not None else sys.stdout
+            self._owns_stream = False
+        self._sample_rate = sample_rate
+        self._log_content = log_content
+        self._max_content_chars = max_content_chars
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._written = 0
+        self._dropped = 0
+        self._thread = threading.Thread(
+            target=self._write, name="request-log", daemon=True)
+        self._thread.start()
+
+    @property
+    def log_content(self) -> bool:
+        return self._log_content
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queued": self._queue.qsize(),
+            "written": self._written,
+            "dropped": self._dropped,
+        }
+
+    def sample(self) -> bool:
+        """whether to log a request, decided once when it arrives"""
+        return self._sample_rate >= 1 or random.random() < self._sample_rate
+
+    def record(self, fields: Dict[str, Any], content: Optional[Dict[str, Any]] = None, sampled: bool = True) -> None:
+        """
+        queues a record without blocking, content holds the message and completion texts, which are
+        only written with log_content. A record of a request that was not sampled (see sample()) is
+        only written when its status is a failure, which a client that went away (499) is not.
+        """
+        status = fields.get("status", 500)
+        if not sampled and (status < 400 or status == 499):
+            return
+        record = {"time": time.time(), **fields}
+        if content is not None and self._log_content:
+            # cut in the writer thread, not on the serving path
+            record["content"] = content
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self._dropped += 1
+
+    def _truncate(self, value: Any) -> Any:
+        if isinstance(value, str):
+            if len(value) > self._max_content_chars:
+                return value[:self._max_content_chars] + f"...[{len(value) - self._max_content_chars} more chars]"
+            return value
+        if isinstance(value, dict):
+            return {key: self._truncate(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self._truncate(item) for item in value]
+        return value
+
+    def _write(self) -> None:
+        while True:
+            record = self._queue.get()
+            stop = False
+            # writes what has queued up meanwhile before flushing once
+            while record is not None:
+                if "content" in record:
+                    record["content"] = self._truncate(record["content"])
+                self._stream.write(json.dumps(
+                    record, ensure_ascii=False, default=str) + "\n")
+                self._written += 1
+                try:
+                    record = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            else:
+                stop = True
+            self._stream.flush()
+            if stop:
+                return
+
+    def close(self) -> None:
+        """writes the queued records and stops the writer"""
+        if not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        self._thread.join()
+        if self._owns_stream:
+            self._stream.close()
@@ -0,0 +1,176 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+from adapter.chat_completion import ChatMessage, CompletionChoice, CompletionDelta, CompletionResult, CompletionUsage, GenerationParams
+
+
+def cache_key(model: str, messages: List[ChatMessage], params: GenerationParams) -> str:
+    """
+    hash of a request in canonical form: message text in NFC with unix line endings, and the
+    generation params that were set, with the service defaults already applied
+    """
+    canonical = json.dumps({
+        "model": model,
+        "messages": [[message.role, unicodedata.normalize("NFC", message.content.replace("\r\n", "\n"))]
+                     for message in messages],
+        "params": params.model_dump(exclude_unset=True),
+    }, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def replay_stream(result: CompletionResult) -> Iterator[Union[CompletionDelta, CompletionUsage]]:
+    """the items complete_stream() would have produced for result, one delta per choice"""
+    for choice in result.choices:
+        yield CompletionDelta(choice.index, choice.text, choice.finish_reason)
+    yield result.usage
+
+
+class ResponseCache:
+    """
+    Completion results of deterministic requests (greedy decoding) by cache_key(). Recent entries live
+    in an in-memory LRU of max_entries, with path also in a sqlite database that survives restarts;
+    entries expire ttl seconds after they were stored (never with ttl 0). Sampled requests are only
+    cached with cache_sampled, e.g. for evals that accept one sample per prompt.
+    """
+    _max_entries: int
+    _ttl: float
+    _cache_sampled: bool
+    _entries: "OrderedDict[str, Tuple[float, CompletionResult]]"  # LRU order, (expires at, result)
+    _db: Optional[sqlite3.Connection]
+    _lock: threading.Lock
+    _memory_hits: int
+    _disk_hits: int
+    _misses: int
+    _stores: int
+    _evictions: int
+    _expirations: int
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600, path: Optional[str] = None,
+                 cache_sampled: bool = False) -> None:
+        assert max_entries > 0, f"invalid max_entries: {max_entries}"
+        assert ttl >= 0, f"invalid ttl: {ttl}"
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._cache_sampled = cache_sampled
+        self._entries = OrderedDict()
+        self._db = None
+        self._lock = threading.Lock()
+        self._memory_hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._stores = 0
+        self._evictions = 0
+        self._expirations = 0
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, result TEXT NOT NULL, expires_at REAL NOT NULL)")
+            self._db.execute(
+                "DELETE FROM responses WHERE expires_at > 0 AND expires_at <= ?", (time.time(),))
+            self._db.commit()
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        lookups = self._memory_hits + self._disk_hits + self._misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self._max_entries,
+            "lookups": lookups,
+            "hits": self._memory_hits + self._disk_hits,
+            "memory_hits": self._memory_hits,
+            "disk_hits": self._disk_hits,
+            "misses": self._misses,
+            "hit_rate": (self._memory_hits + self._disk_hits) / lookups if lookups else 0.0,
+            "stores": self._stores,
+            "evictions": self._evictions,
+            "expirations": self._expirations,
+        }
+
+    def accepts(self, params: GenerationParams) -> bool:
+        """whether a request with these params (service defaults applied) is cached"""
+        deterministic = not params.do_sample or params.temperature == 0
+        return deterministic or self._cache_sampled
+
+    def get(self, key: str) -> Optional[CompletionResult]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, result = entry
+                if expires_at == 0 or expires_at > now:
+                    self._entries.move_to_end(key)
+                    self._memory_hits += 1
+                    return result
+                del self._entries[key]
+                self._expirations += 1
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT result, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    if row[1] == 0 or row[1] > now:
+                        result = CompletionResult.model_validate_json(row[0])
+                        self._put_memory(key, row[1], result)
+                        self._disk_hits += 1
+                        return result
+                    self._db.execute(
+                        "DELETE FROM responses WHERE key = ?", (key,))
+                    self._db.commit()
+                    self._expirations += 1
+            self._misses += 1
+            return None
+
+    def put(self, key: str, result: CompletionResult) -> None:
+        expires_at = time.time() + self._ttl if self._ttl > 0 else 0
+        with self._lock:
+            self._put_memory(key, expires_at, result)
+            self._stores += 1
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO responses (key, result, expires_at) VALUES (?, ?, ?)",
+                                 (key, result.model_dump_json(), expires_at))
+                self._db.commit()
+
+    def _put_memory(self, key: str, expires_at: float, result: CompletionResult) -> None:
+        self._entries[key] = (expires_at, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    def record(self, key: str, items: Iterator[Union[CompletionDelta, CompletionUsage]]) -> Iterator[Union[CompletionDelta, CompletionUsage]]:
+        """passes a complete_stream() through and caches its result once it completes with usage"""
+        texts: Dict[int, List[str]] = {}
+        finish_reasons: Dict[int, str] = {}
+        for item in items:
+            if isinstance(item, CompletionUsage):
+                self.put(key, CompletionResult(
+                    choices=[CompletionChoice(
+                        index=index,
+                        text="".join(texts[index]),
+                        finish_reason=finish_reasons.get(index, "stop"),
+                    ) for index in sorted(texts)],
+                    usage=item,
+                ))
+            else:
+                texts.setdefault(item.index, []).append(item.text)
+                if item.finish_reason is not None:
+                    finish_reasons[item.index] = item.finish_reason
+            yield item
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
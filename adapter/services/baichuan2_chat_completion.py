@@ -1,8 +1,11 @@
-from typing import List, Dict, Iterator, Literal
+import sys
+from typing import List, Dict, Iterator, Literal, Optional
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer, PreTrainedModel, PreTrainedTokenizer
 from transformers.generation.utils import GenerationConfig
 from adapter.chat_completion import ChatCompletion, ChatMessage, register_chat_completion_service
+from adapter.loading import load_stage
+from adapter.prompt import PromptBuilder, PromptTemplate, build_conversation
 
 
 SERVICE_NAME = "baichuan2"
@@ -10,71 +13,52 @@ SERVICE_NAME = "baichuan2"
 
 class Baichuan2ChatCompletion(ChatCompletion):
     _overwrite_system: bool
+    _max_input_tokens: int
+    _prompt_builder: PromptBuilder
 
-    def __init__(self, model_path: str, overwrite_system: bool = False) -> None:
+    def __init__(self, model_path: str, overwrite_system: bool = False, native_generation: bool = False) -> None:
         self._overwrite_system = overwrite_system
-        model: PreTrainedModel = AutoModelForCausalLM.from_pretrained(
-            model_path,
-            torch_dtype=torch.float16,
-            device_map="auto",
-            trust_remote_code=True,
-        )
-        model.generation_config = GenerationConfig.from_pretrained(
-            model_path)
-        tokenizer: PreTrainedTokenizer = AutoTokenizer.from_pretrained(
-            model_path,
-            use_fast=False,
-            trust_remote_code=True,
-        )
-        super().__init__(model, tokenizer)
+        with load_stage("weights"):
+            model: PreTrainedModel = AutoModelForCausalLM.from_pretrained(
+                model_path,
+                torch_dtype=torch.float16,
+                device_map="auto",
+                trust_remote_code=True,
+            )
+            model.generation_config = GenerationConfig.from_pretrained(
+                model_path)
+        with load_stage("tokenizer"):
+            tokenizer: PreTrainedTokenizer = AutoTokenizer.from_pretrained(
+                model_path,
+                use_fast=False,
+                trust_remote_code=True,
+            )
+        super().__init__(model, tokenizer, native_generation)
+        generation_config = model.generation_config
+        self._max_input_tokens = model.config.model_max_length - \
+            generation_config.max_new_tokens
+        # each message is encoded on its own, after the token of its role
+        self._prompt_builder = PromptBuilder(tokenizer, PromptTemplate(
+            system=["{content}"],
+            round=[generation_config.user_token_id, "{user}",
+                   generation_config.assistant_token_id, "{assistant}"],
+            query=[generation_config.user_token_id, "{content}"],
+            generation=[generation_config.assistant_token_id],
+            encode_kwargs={"add_special_tokens": True},
+            window=self._window,
+            max_tokens=self._max_input_tokens,
+        ))
 
     def _build_input(self, messages: List[ChatMessage]) -> List[Dict[Literal["role", "content"], str]]:
+        conversation = build_conversation(
+            messages, overwrite_system=self._overwrite_system)
         msgs: List[Dict[Literal["role", "content"], str]] = []
-        system = ""
-        wait_user = True
-        user, assistant = "", ""
-        for message in messages:
-            if message.role == "system":
-                if system == "" or self._overwrite_system:
-                    system = message.content
-                else:
-                    system += "\n" + message.content
-                continue
-
-            if wait_user:
-                # appending user
-                if message.role == "user":
-                    if user == "":
-                        user = message.content
-                    else:
-                        user += "\n" + message.content
-                else:
-                    wait_user = False
-                    assistant = message.content
-            else:
-                # appending assistant
-                if message.role == "user":
-                    msgs.extend([{
-                        "role": "user",
-                        "content": user,
-                    }, {
-                        "role": "assistant",
-                        "content": assistant,
-                    }])
-                    wait_user = True
-                    user, assistant = message.content, ""
-                else:
-                    if assistant == "":
-                        assistant = message.content
-                    else:
-                        assistant += "\n" + message.content
-
-        if wait_user:
+        if conversation.system != "":
             msgs.append({
-                "role": "user",
-                "content": user,
+                "role": "system",
+                "content": conversation.system,
             })
-        else:
+        for user, assistant in conversation.history:
             msgs.extend([{
                 "role": "user",
                 "content": user,
@@ -82,17 +66,44 @@ class Baichuan2ChatCompletion(ChatCompletion):
                 "role": "assistant",
                 "content": assistant,
             }])
-
-        if system != "":
-            msgs.insert(0, {
-                "role": "system",
-                "content": system,
+        if conversation.query is not None:
+            msgs.append({
+                "role": "user",
+                "content": conversation.query,
             })
-
-        # print(f"<msgs>\n{msgs}")
         return msgs
 
+    def _window(self, system_tokens: int, round_tokens: List[int], query_tokens: Optional[int]) -> int:
+        # like build_chat_input in the remote code: the newest rounds while they fit, at least one
+        max_history_tokens = self._max_input_tokens - system_tokens
+        lens = round_tokens + ([query_tokens] if query_tokens is not None else [])
+        history_tokens = 0
+        first = len(lens)
+        for i in range(len(lens) - 1, -1, -1):
+            if history_tokens == 0 or history_tokens + lens[i] <= max_history_tokens:
+                history_tokens += lens[i]
+                first = i
+                if history_tokens < max_history_tokens:
+                    continue
+            break
+        return min(first, len(round_tokens))
+
+    def _build_input_ids_remote(self, messages: List[ChatMessage]) -> List[int]:
+        msgs = self._build_input(messages)
+        # build_chat_input lives in the remote code next to the model class
+        build_chat_input = sys.modules[type(self._model).__module__].build_chat_input
+        input_ids = build_chat_input(
+            self._model, self._tokenizer, msgs, self._model.generation_config.max_new_tokens)
+        return input_ids[0].tolist()
+
+    def build_input_ids(self, messages: List[ChatMessage]) -> List[int]:
+        conversation = build_conversation(
+            messages, overwrite_system=self._overwrite_system)
+        return self._prompt_builder.build(conversation, lambda: self._build_input_ids_remote(messages))
+
     def chat(self, messages: List[ChatMessage]) -> str:
+        if self._native_generation:
+            return self._chat_native(messages)
         msgs = self._build_input(messages)
         completion = self._model.chat(
             self._tokenizer,
@@ -103,6 +114,9 @@ class Baichuan2ChatCompletion(ChatCompletion):
         return completion
 
     def chat_stream(self, messages: List[ChatMessage]) -> Iterator[str]:
+        if self._native_generation:
+            yield from self._chat_stream_native(messages)
+            return
         msgs = self._build_input(messages)
         completion_gen = self._model.chat(
             self._tokenizer,
@@ -1,60 +1,65 @@
-from typing import List, Tuple, Iterator
+from typing import Any, ClassVar, Dict, List, Tuple, Iterator
 from transformers import AutoModel, AutoTokenizer, PreTrainedModel, PreTrainedTokenizer
 from adapter.chat_completion import ChatCompletion, ChatMessage, register_chat_completion_service
+from adapter.loading import load_stage
+from adapter.prompt import Conversation, PromptBuilder, PromptTemplate, build_conversation
 
 
 SERVICE_NAME = "chatglm2"
 
 
 class ChatGLM2ChatCompletion(ChatCompletion):
-    def __init__(self, model_path: str) -> None:
-        model: PreTrainedModel = AutoModel.from_pretrained(
-            model_path,
-            trust_remote_code=True,
-        ).cuda().eval()
-        tokenizer: PreTrainedTokenizer = AutoTokenizer.from_pretrained(
-            model_path,
-            trust_remote_code=True,
-        )
-        super().__init__(model, tokenizer)
+    # past_key_values are [seq, batch, groups, head_dim]
+    _kv_layout: ClassVar[Tuple[int, int]] = (1, 0)
+    # hidden states are [seq, batch, hidden]
+    _hidden_layout: ClassVar[Tuple[int, int]] = (1, 0)
+    _generation_defaults: ClassVar[Dict[str, Any]] = {
+        "do_sample": True,
+        "top_p": 0.8,
+        "temperature": 0.8,
+    }
+    _prompt_builder: PromptBuilder
+
+    def __init__(self, model_path: str, native_generation: bool = False) -> None:
+        with load_stage("weights"):
+            model: PreTrainedModel = AutoModel.from_pretrained(
+                model_path,
+                trust_remote_code=True,
+            ).cuda().eval()
+        with load_stage("tokenizer"):
+            tokenizer: PreTrainedTokenizer = AutoTokenizer.from_pretrained(
+                model_path,
+                trust_remote_code=True,
+            )
+        super().__init__(model, tokenizer, native_generation)
+        # build_prompt renders the whole conversation as one text, which the SentencePiece tokenizer
+        # encodes after the [gMASK] sop prefix; a round is encoded as a whole, so that only the
+        # newlines between rounds are boundaries of encoded texts
+        self._prompt_builder = PromptBuilder(tokenizer, PromptTemplate(
+            prefix=tokenizer.get_prefix_tokens(),
+            round=["[Round {round}]\n\n问：{user}\n\n答：{assistant}\n\n"],
+            query=["[Round {round}]\n\n问：{content}\n\n答："],
+            continuation=True,
+        ))
 
     def _build_input(self, messages: List[ChatMessage]) -> Tuple[str, List[Tuple[str, str]]]:
-        query = ""
-        history: List[Tuple[str, str]] = []
-        wait_user = True
-        user, assistant = "", ""
-        for message in messages:
-            if wait_user:
-                # appending user
-                if message.role in ["user", "system"]:
-                    if user == "":
-                        user = message.content
-                    else:
-                        user += "\n" + message.content
-                else:
-                    wait_user = False
-                    assistant = message.content
-            else:
-                # appending assistant
-                if message.role in ["user", "system"]:
-                    history.append((user, assistant))
-                    wait_user = True
-                    user, assistant = message.content, ""
-                else:
-                    if assistant == "":
-                        assistant = message.content
-                    else:
-                        assistant += "\n" + message.content
+        # system messages are part of the user turn
+        conversation = build_conversation(messages, separate_system=False)
+        # messages ending with the assistant are answered as an empty user turn
+        query = conversation.query if conversation.query is not None else ""
+        return query, conversation.history
 
-        if wait_user:
-            query = user
-        else:
-            history.append((user, assistant))
+    def build_input_ids(self, messages: List[ChatMessage]) -> List[int]:
+        query, history = self._build_input(messages)
 
-        # print(f"<query>\n{query}\n<history>\n{history}")
-        return query, history
+        def build_inputs() -> List[int]:
+            inputs = self._model.build_inputs(self._tokenizer, query, history)
+            return inputs["input_ids"][0].tolist()
+        return self._prompt_builder.build(Conversation("", history, query), build_inputs)
 
     def chat(self, messages: List[ChatMessage]) -> str:
+        if self._native_generation:
+            return self._chat_native(messages)
         query, history = self._build_input(messages)
         completion, _ = self._model.chat(
             self._tokenizer,
@@ -65,6 +70,9 @@ class ChatGLM2ChatCompletion(ChatCompletion):
         return completion
 
     def chat_stream(self, messages: List[ChatMessage]) -> Iterator[str]:
+        if self._native_generation:
+            yield from self._chat_stream_native(messages)
+            return
         query, history = self._build_input(messages)
         completion_gen = self._model.stream_chat(
             self._tokenizer,
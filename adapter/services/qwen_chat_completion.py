@@ -1,78 +1,107 @@
-from typing import List, Tuple, Iterator
+import sys
+from typing import Any, ClassVar, Dict, List, Optional, Tuple, Iterator
 from transformers import AutoModelForCausalLM, AutoTokenizer, PreTrainedModel, PreTrainedTokenizer
 from transformers.generation.utils import GenerationConfig
 from adapter.chat_completion import ChatCompletion, ChatMessage, register_chat_completion_service
+from adapter.loading import load_stage
+from adapter.prompt import Conversation, PromptBuilder, PromptTemplate, build_conversation
 
 
 SERVICE_NAME = "qwen"
 
 
 class QwenChatCompletion(ChatCompletion):
+    # past_key_values are [batch, seq, heads, head_dim]
+    _kv_layout: ClassVar[Tuple[int, int]] = (0, 1)
+    # special tokens in texts to embed are text, as in the prompts
+    _embedding_encode_kwargs: ClassVar[Dict[str, Any]] = {
+        "allowed_special": set()}
     _overwrite_system: bool
+    _prompt_builder: Optional[PromptBuilder]
 
-    def __init__(self, model_path: str, overwrite_system: bool = False) -> None:
+    def __init__(self, model_path: str, overwrite_system: bool = False, native_generation: bool = False) -> None:
         self._overwrite_system = overwrite_system
-        model: PreTrainedModel = AutoModelForCausalLM.from_pretrained(
-            model_path,
-            device_map="auto",
-            trust_remote_code=True,
-        ).eval()
-        model.generation_config = GenerationConfig.from_pretrained(
-            model_path, trust_remote_code=True)
-        tokenizer: PreTrainedTokenizer = AutoTokenizer.from_pretrained(
-            model_path,
-            trust_remote_code=True,
-        )
-        super().__init__(model, tokenizer)
+        with load_stage("weights"):
+            model: PreTrainedModel = AutoModelForCausalLM.from_pretrained(
+                model_path,
+                device_map="auto",
+                trust_remote_code=True,
+            ).eval()
+            model.generation_config = GenerationConfig.from_pretrained(
+                model_path, trust_remote_code=True)
+        with load_stage("tokenizer"):
+            tokenizer: PreTrainedTokenizer = AutoTokenizer.from_pretrained(
+                model_path,
+                trust_remote_code=True,
+            )
+        super().__init__(model, tokenizer, native_generation)
+        self._prompt_builder = None
+        if model.generation_config.chat_format == "chatml":
+            im_start, im_end = tokenizer.im_start_id, tokenizer.im_end_id
+            # the role and the newline after it are encoded apart from the message, as in make_context
+            self._prompt_builder = PromptBuilder(tokenizer, PromptTemplate(
+                system=[im_start, "system", "\n", "{content}", im_end],
+                round=["\n", im_start, "user", "\n", "{user}", im_end,
+                       "\n", im_start, "assistant", "\n", "{assistant}", im_end],
+                query=["\n", im_start, "user", "\n", "{content}", im_end],
+                generation=["\n", im_start, "assistant", "\n"],
+                encode_kwargs={"add_special_tokens": True,
+                               "allowed_special": set()},
+                window=self._window,
+            ))
 
     def _build_input(self, messages: List[ChatMessage]) -> Tuple[str, List[Tuple[str, str]], str]:
-        query = ""
-        history: List[Tuple[str, str]] = []
-        system = ""
-        wait_user = True
-        user, assistant = "", ""
-        for message in messages:
-            if message.role == "system":
-                if system == "" or self._overwrite_system:
-                    system = message.content
-                else:
-                    system += "\n" + message.content
-                continue
+        conversation = build_conversation(
+            messages, overwrite_system=self._overwrite_system)
+        # messages ending with the assistant are answered as an empty user turn
+        query = conversation.query if conversation.query is not None else ""
+        system = conversation.system
+        if system == "":
+            system = "You are a helpful assistant."
+        return query, conversation.history, system
 
-            if wait_user:
-                # appending user
-                if message.role == "user":
-                    if user == "":
-                        user = message.content
-                    else:
-                        user += "\n" + message.content
-                else:
-                    wait_user = False
-                    assistant = message.content
-            else:
-                # appending assistant
-                if message.role == "user":
-                    history.append((user, assistant))
-                    wait_user = True
-                    user, assistant = message.content, ""
-                else:
-                    if assistant == "":
-                        assistant = message.content
-                    else:
-                        assistant += "\n" + message.content
+    def _window(self, system_tokens: int, round_tokens: List[int], query_tokens: Optional[int]) -> int:
+        # like make_context in the remote code: the newest rounds while they fit max_window_size with
+        # the system prompt, the query does not count
+        max_window_size = self._model.generation_config.max_window_size
+        context_tokens = 0
+        first = len(round_tokens)
+        for i in range(len(round_tokens) - 1, -1, -1):
+            if system_tokens + round_tokens[i] + context_tokens >= max_window_size:
+                break
+            context_tokens += round_tokens[i]
+            first = i
+        return first
 
-        if wait_user:
-            query = user
-        else:
-            history.append((user, assistant))
+    def _build_input_ids_remote(self, query: str, history: List[Tuple[str, str]], system: str) -> List[int]:
+        # make_context lives in the remote code next to the model class
+        make_context = sys.modules[type(self._model).__module__].make_context
+        generation_config = self._model.generation_config
+        _, context_tokens = make_context(
+            self._tokenizer,
+            query,
+            history=history,
+            system=system,
+            max_window_size=generation_config.max_window_size,
+            chat_format=generation_config.chat_format,
+        )
+        return context_tokens
 
-        if system == "":
-            system = "You are a helpful assistant."
+    def build_input_ids(self, messages: List[ChatMessage]) -> List[int]:
+        query, history, system = self._build_input(messages)
+        if self._prompt_builder is None:
+            return self._build_input_ids_remote(query, history, system)
+        return self._prompt_builder.build(Conversation(system, history, query),
+                                          lambda: self._build_input_ids_remote(query, history, system))
 
-        # print(f"<query>\n{query}\n<history>\n{history}\n<system>\n{system}")
-        return query, history, system
+    @property
+    def eos_token_ids(self) -> List[int]:
+        # chat turns end with <|im_end|>, see get_stop_words_ids in the remote code
+        return [self._tokenizer.im_end_id, self._tokenizer.im_start_id, *super().eos_token_ids]
 
     def chat(self, messages: List[ChatMessage]) -> str:
+        if self._native_generation:
+            return self._chat_native(messages)
         query, history, system = self._build_input(messages)
         completion, _ = self._model.chat(
             self._tokenizer,
@@ -85,6 +114,9 @@ class QwenChatCompletion(ChatCompletion):
         return completion
 
     def chat_stream(self, messages: List[ChatMessage]) -> Iterator[str]:
+        if self._native_generation:
+            yield from self._chat_stream_native(messages)
+            return
         query, history, system = self._build_input(messages)
         completion_gen = self._model.chat_stream(
             self._tokenizer,
@@ -0,0 +1,215 @@
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+from pydantic import BaseModel
+from adapter.chat_completion import ChatMessage
+
+
+class SessionBusyError(Exception):
+    pass
+
+
+class Session(BaseModel):
+    id: str
+    created: int
+    updated_at: float  # time.time() of the last turn, sessions expire ttl seconds after it
+    messages: List[ChatMessage]
+
+
+class SessionStore:
+    """
+    Conversations kept on the server, so that clients only send the messages of a new turn. Sessions
+    live in memory, at most max_sessions of them in LRU order. With path the sessions idle for
+    spill_after seconds, and those beyond max_sessions, spill to a sqlite database and come back on
+    their next turn; without path those are dropped. Sessions expire ttl seconds after their last turn
+    (never with ttl 0). A session runs one turn at a time: acquire() raises SessionBusyError while the
+    previous turn runs, release() ends the turn and records its messages.
+
+    Only the messages are kept. With a prefix cache the service also keeps the attention cache of the
+    previous turn, so its tokens are not computed again.
+    """
+    _max_sessions: int
+    _ttl: float
+    _spill_after: float
+    _sessions: "OrderedDict[str, Session]"  # LRU order
+    _busy: Set[str]
+    _db: Optional[sqlite3.Connection]
+    _lock: threading.Lock
+    _next_sweep: float
+    _created: int
+    _spills: int
+    _loads: int
+    _evictions: int
+    _expirations: int
+
+    def __init__(self, max_sessions: int = 1024, ttl: float = 86400, spill_after: float = 300,
+                 path: Optional[str] = None) -> None:
+        assert max_sessions > 0, f"invalid max_sessions: {max_sessions}"
+        assert ttl >= 0, f"invalid ttl: {ttl}"
+        assert spill_after > 0, f"invalid spill_after: {spill_after}"
+        self._max_sessions = max_sessions
+        self._ttl = ttl
+        self._spill_after = spill_after
+        self._sessions = OrderedDict()
+        self._busy = set()
+        self._db = None
+        self._lock = threading.Lock()
+        self._next_sweep = 0
+        self._created = 0
+        self._spills = 0
+        self._loads = 0
+        self._evictions = 0
+        self._expirations = 0
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, session TEXT NOT NULL, updated_at REAL NOT NULL)")
+            self._db.commit()
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            spilled = self._db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0] \
+                if self._db is not None else 0
+        return {
+            "sessions": len(self._sessions),
+            "max_sessions": self._max_sessions,
+            "spilled": spilled,
+            "busy": len(self._busy),
+            "created": self._created,
+            "spills": self._spills,
+            "loads": self._loads,
+            "evictions": self._evictions,
+            "expirations": self._expirations,
+        }
+
+    def _expired(self, session: Session, now: float) -> bool:
+        return self._ttl > 0 and session.updated_at + self._ttl <= now
+
+    def _spill(self, session: Session) -> None:
+        del self._sessions[session.id]
+        if self._db is None:
+            self._evictions += 1
+            return
+        self._db.execute("INSERT OR REPLACE INTO sessions (id, session, updated_at) VALUES (?, ?, ?)",
+                         (session.id, session.model_dump_json(), session.updated_at))
+        self._spills += 1
+
+    def _sweep(self, now: float) -> None:
+        """spills idle and surplus sessions, and drops expired ones, oldest first"""
+        changed = False
+        for session in list(self._sessions.values()):
+            surplus = len(self._sessions) > self._max_sessions
+            if not surplus and session.updated_at + self._spill_after > now:
+                break
+            if session.id in self._busy:
+                continue
+            if self._expired(session, now):
+                del self._sessions[session.id]
+                self._expirations += 1
+            else:
+                self._spill(session)
+            changed = True
+        if self._db is not None and now >= self._next_sweep:
+            # expired sessions on disk are deleted at most once per spill_after
+            self._next_sweep = now + self._spill_after
+            if self._ttl > 0:
+                self._expirations += self._db.execute(
+                    "DELETE FROM sessions WHERE updated_at <= ?", (now - self._ttl,)).rowcount
+                changed = True
+        if changed and self._db is not None:
+            self._db.commit()
+
+    def _load(self, id: str, now: float) -> Optional[Session]:
+        session = self._sessions.get(id)
+        if session is not None:
+            if not self._expired(session, now):
+                self._sessions.move_to_end(id)
+                return session
+            if id in self._busy:
+                return session
+            del self._sessions[id]
+            self._expirations += 1
+            return None
+        if self._db is None:
+            return None
+        row = self._db.execute(
+            "SELECT session FROM sessions WHERE id = ?", (id,)).fetchone()
+        if row is None:
+            return None
+        self._db.execute("DELETE FROM sessions WHERE id = ?", (id,))
+        self._db.commit()
+        session = Session.model_validate_json(row[0])
+        if self._expired(session, now):
+            self._expirations += 1
+            return None
+        self._sessions[id] = session
+        self._loads += 1
+        return session
+
+    def create(self, messages: Optional[List[ChatMessage]] = None) -> Session:
+        now = time.time()
+        session = Session(
+            id=f"sess-{secrets.token_hex(16)}",
+            created=int(now),
+            updated_at=now,
+            messages=list(messages) if messages else [],
+        )
+        with self._lock:
+            self._sessions[session.id] = session
+            self._created += 1
+            self._sweep(now)
+        return session
+
+    def get(self, id: str) -> Optional[Session]:
+        now = time.time()
+        with self._lock:
+            session = self._load(id, now)
+            self._sweep(now)
+            return session
+
+    def acquire(self, id: str) -> Optional[Session]:
+        """starts a turn of session id, None when there is no such session"""
+        now = time.time()
+        with self._lock:
+            session = self._load(id, now)
+            if session is not None:
+                if id in self._busy:
+                    raise SessionBusyError(
+                        f"session {id} is still running a turn")
+                self._busy.add(id)
+            self._sweep(now)
+            return session
+
+    def release(self, session: Session, messages: Optional[List[ChatMessage]] = None) -> None:
+        """ends the turn of session, which now holds messages, or stays as it was without"""
+        with self._lock:
+            self._busy.discard(session.id)
+            if messages is not None:
+                session.messages = messages
+                session.updated_at = time.time()
+            if session.id in self._sessions:
+                self._sessions.move_to_end(session.id)
+
+    def delete(self, id: str) -> bool:
+        with self._lock:
+            found = self._sessions.pop(id, None) is not None
+            if self._db is not None:
+                found = self._db.execute(
+                    "DELETE FROM sessions WHERE id = ?", (id,)).rowcount > 0 or found
+                self._db.commit()
+            return found
+
+    def close(self) -> None:
+        """spills every session, so that they outlive a restart with path"""
+        with self._lock:
+            if self._db is not None:
+                for session in list(self._sessions.values()):
+                    self._spill(session)
+                self._db.commit()
+                self._db.close()
+                self._db = None
@@ -0,0 +1,295 @@
+import threading
+from typing import Any, Dict, List, Optional, Tuple, TYPE_CHECKING
+import torch
+from adapter.chat_completion import GenerationParams
+from adapter.generation import GenerationRequest, KVCache, ModelRunner, kv_length, kv_slice
+
+if TYPE_CHECKING:
+    from adapter.prefix_cache import PrefixCache
+
+
+class PromptLookupDrafter:
+    """
+    Drafts the tokens that followed the latest earlier occurrence of the last ngram_size tokens, or of
+    fewer down to one, which finds the text an answer copies from its prompt. The token ids of a
+    sequence only grow, so its n-grams are indexed once.
+    """
+    _ngram_size: int
+    _index: Dict[Tuple[int, ...], int]  # n-gram -> the end of its latest occurrence
+    _indexed: int  # n-grams ending before this are in the index
+
+    def __init__(self, ngram_size: int = 3) -> None:
+        assert ngram_size > 0, f"invalid ngram_size: {ngram_size}"
+        self._ngram_size = ngram_size
+        self._index = {}
+        self._indexed = 1
+
+    def propose(self, token_ids: List[int], count: int) -> List[int]:
+        # the n-grams ending at the last token are left out, they would only find themselves
+        for end in range(self._indexed, len(token_ids)):
+            for n in range(1, min(self._ngram_size, end) + 1):
+                self._index[tuple(token_ids[end - n:end])] = end
+        self._indexed = max(self._indexed, len(token_ids))
+        for n in range(min(self._ngram_size, len(token_ids)), 0, -1):
+            end = self._index.get(tuple(token_ids[-n:]))
+            if end is not None:
+                return token_ids[end:end + count]
+        return []
+
+
+class DraftModelDrafter:
+    """
+    Drafts greedily with a small model of the same tokenizer. Its cache follows the sequence across
+    steps, only the tokens it did not draft itself are fed again.
+    """
+    _runner: ModelRunner
+    _ids: List[int]  # the tokens in _past
+    _past: Optional[KVCache]
+    _confirmed: int  # leading tokens of _ids that are in the sequence
+
+    def __init__(self, runner: ModelRunner) -> None:
+        self._runner = runner
+        self._ids = []
+        self._past = None
+        self._confirmed = 0
+
+    def propose(self, token_ids: List[int], count: int) -> List[int]:
+        if count <= 0:
+            return []
+        device = self._runner.device
+        # the cache keeps what it shares with the sequence, the last token is fed again for its logits
+        keep = min(self._confirmed, len(token_ids) - 1)
+        limit = min(len(self._ids), len(token_ids) - 1)
+        while keep < limit and self._ids[keep] == token_ids[keep]:
+            keep += 1
+        past = kv_slice(self._past, self._runner.kv_layout, 0, keep) if keep > 0 else None
+        ids = list(token_ids)
+        logits, past = self._runner.forward(
+            torch.tensor([ids[keep:]], dtype=torch.long, device=device),
+            torch.ones((1, len(ids)), dtype=torch.long, device=device),
+            torch.arange(keep, len(ids), dtype=torch.long, device=device).unsqueeze(0),
+            past)
+        drafted: List[int] = []
+        while True:
+            token_id = int(logits[0].argmax())
+            drafted.append(token_id)
+            if len(drafted) == count:
+                break
+            ids.append(token_id)
+            logits, past = self._runner.forward(
+                torch.tensor([[token_id]], dtype=torch.long, device=device),
+                torch.ones((1, len(ids)), dtype=torch.long, device=device),
+                torch.tensor([[len(ids) - 1]], dtype=torch.long, device=device),
+                past)
+        self._ids = ids
+        self._past = past
+        self._confirmed = len(token_ids)
+        return drafted
+
+
+class SpeculativeDecoding:
+    """
+    Greedy decoding of a single sequence that feeds the model up to num_draft_tokens drafted tokens
+    with its own last token in one forward pass, and keeps the leading drafts the model picks itself
+    plus the model's next token, so that each pass yields one token or more and the output is that
+    of greedy decoding. Tokens are drafted by prompt lookup (see PromptLookupDrafter), and by
+    draft_runner, a small model of the same tokenizer, where the lookup finds nothing. Requests that
+    sample, or of more than one sequence, do not use it.
+    """
+    _num_draft_tokens: int
+    _ngram_size: int
+    _draft_runner: Optional[ModelRunner]
+    _lock: threading.Lock
+    _requests: int
+    _steps: int
+    _tokens: int
+    _drafted: Dict[str, int]  # by drafter, lookup or model
+    _accepted: Dict[str, int]
+
+    def __init__(self, num_draft_tokens: int = 5, ngram_size: int = 3,
+                 draft_runner: Optional[ModelRunner] = None) -> None:
+        assert num_draft_tokens > 0, f"invalid num_draft_tokens: {num_draft_tokens}"
+        assert ngram_size > 0, f"invalid ngram_size: {ngram_size}"
+        self._num_draft_tokens = num_draft_tokens
+        self._ngram_size = ngram_size
+        self._draft_runner = draft_runner
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._steps = 0
+        self._tokens = 0
+        self._drafted = {"lookup": 0, "model": 0}
+        self._accepted = {"lookup": 0, "model": 0}
+
+    @property
+    def num_draft_tokens(self) -> int:
+        return self._num_draft_tokens
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            drafted = sum(self._drafted.values())
+            accepted = sum(self._accepted.values())
+            stats: Dict[str, float] = {
+                "requests": self._requests,
+                "steps": self._steps,
+                "tokens": self._tokens,
+                # tokens per forward pass of the model, 1 without drafts
+                "tokens_per_step": self._tokens / self._steps if self._steps else 0.0,
+                "drafted_tokens": drafted,
+                "accepted_tokens": accepted,
+                "acceptance_rate": accepted / drafted if drafted else 0.0,
+            }
+            for source in ("lookup", "model"):
+                stats[f"{source}_drafted_tokens"] = self._drafted[source]
+                stats[f"{source}_accepted_tokens"] = self._accepted[source]
+            return stats
+
+    def accepts(self, params: GenerationParams) -> bool:
+        return params.n == 1 and (not params.do_sample or params.temperature <= 0)
+
+    def generate(self, runner: ModelRunner, eos_token_ids: List[int], input_ids: List[int],
+                 params: GenerationParams, prefix_cache: Optional["PrefixCache"] = None) -> GenerationRequest:
+        """generates the sequence on the thread iterating the returned request, params have to be accepted"""
+        assert self.accepts(params), "speculative decoding is greedy and of a single sequence"
+        with self._lock:
+            self._requests += 1
+        return _SpeculativeGenerationRequest(self, runner, eos_token_ids, input_ids, params, prefix_cache)
+
+    def _record(self, source: Optional[str], drafted: int, accepted: int, tokens: int) -> None:
+        with self._lock:
+            self._steps += 1
+            self._tokens += tokens
+            if source is not None:
+                self._drafted[source] += drafted
+                self._accepted[source] += accepted
+
+
+class _SpeculativeGenerationRequest(GenerationRequest):
+    """a greedy request that runs its speculative steps on the thread iterating it"""
+    _speculative: SpeculativeDecoding
+    _runner: ModelRunner
+    _eos_token_ids: frozenset
+    _prefix_cache: Optional["PrefixCache"]
+    _lookup: PromptLookupDrafter
+    _draft_model: Optional[DraftModelDrafter]
+    _token_ids: List[int]  # the prompt and the tokens generated so far
+    _past: Optional[KVCache]  # all of _token_ids but the last
+    _seen: Optional[torch.Tensor]  # [vocab] tokens for the repetition penalty
+    _started: bool
+
+    def __init__(self, speculative: SpeculativeDecoding, runner: ModelRunner, eos_token_ids: List[int],
+                 input_ids: List[int], params: GenerationParams, prefix_cache: Optional["PrefixCache"]) -> None:
+        super().__init__(input_ids, params)
+        self._speculative = speculative
+        self._runner = runner
+        self._eos_token_ids = frozenset(eos_token_ids)
+        self._prefix_cache = prefix_cache
+        self._lookup = PromptLookupDrafter(speculative._ngram_size)
+        self._draft_model = DraftModelDrafter(speculative._draft_runner) \
+            if speculative._draft_runner is not None else None
+        self._token_ids = list(input_ids)
+        self._past = None
+        self._seen = None
+        self._started = False
+
+    def _get(self) -> Any:
+        while self._queue.empty():
+            with torch.inference_mode():
+                if not self._started:
+                    self._started = True
+                    self._prefill()
+                else:
+                    self._step()
+        return self._queue.get()
+
+    def _greedy(self, logits: torch.Tensor, drafted: List[int]) -> List[int]:
+        """
+        the greedy tokens of logits [1 + drafts, vocab], as the Sampler picks them: each position
+        penalizes the drafts before it as seen
+        """
+        logits = logits.float()
+        penalty = self.params.repetition_penalty
+        if penalty != 1.0:
+            seen = self._seen.unsqueeze(0).repeat(logits.shape[0], 1)
+            for i, token_id in enumerate(drafted):
+                seen[i + 1:, token_id] = True
+            penalized = torch.where(logits > 0, logits / penalty, logits * penalty)
+            logits = torch.where(seen, penalized, logits)
+        return logits.argmax(dim=-1).tolist()
+
+    def _prefill(self) -> None:
+        if self.cancelled:
+            self._finish(0, "cancelled")
+            return
+        cached: Optional[KVCache] = None
+        if self._prefix_cache is not None:
+            _, cached = self._prefix_cache.lookup(self.input_ids)
+        logits, self._past = self._runner.prefill(self.input_ids, cached)
+        if self._prefix_cache is not None:
+            self._prefix_cache.insert(self.input_ids, self._past)
+        if self.params.repetition_penalty != 1.0:
+            self._seen = torch.zeros(
+                logits.shape[-1], dtype=torch.bool, device=logits.device)
+            self._seen[torch.tensor(self.input_ids, dtype=torch.long, device=logits.device)] = True
+        self._speculative._record(None, 0, 0, 1)
+        self._emit(self._greedy(logits, [])[0])
+
+    def _step(self) -> None:
+        if self._aborted[0] is not None:
+            self._finish(0, self._aborted[0])
+            return
+        # the last token always comes from the model, the drafts stay within max_new_tokens
+        count = min(self._speculative.num_draft_tokens,
+                    self.params.max_new_tokens - len(self.output_ids[0]) - 1)
+        source: Optional[str] = None
+        drafted: List[int] = []
+        if count > 0:
+            drafted = self._lookup.propose(self._token_ids, count)
+            source = "lookup"
+            if not drafted and self._draft_model is not None:
+                drafted = self._draft_model.propose(self._token_ids, count)
+                source = "model"
+        layout = self._runner.kv_layout
+        device = self._runner.device
+        start = kv_length(self._past, layout)
+        ids = [self._token_ids[-1]] + drafted
+        logits, past = self._runner.forward(
+            torch.tensor([ids], dtype=torch.long, device=device),
+            torch.ones((1, start + len(ids)), dtype=torch.long, device=device),
+            torch.arange(start, start + len(ids), dtype=torch.long, device=device).unsqueeze(0),
+            self._past, all_positions=True)
+        targets = self._greedy(logits[0], drafted)
+        accepted = 0
+        while accepted < len(drafted) and drafted[accepted] == targets[accepted]:
+            accepted += 1
+        # the rejected drafts leave the cache, the accepted ones stay as if decoded one by one
+        self._past = past if accepted == len(drafted) else kv_slice(past, layout, 0, start + 1 + accepted)
+        self._speculative._record(source if drafted else None, len(drafted), accepted, accepted + 1)
+        for token_id in drafted[:accepted] + [targets[accepted]]:
+            if not self._emit(token_id):
+                return
+
+    def _emit(self, token_id: int) -> bool:
+        """hands a token to the sequence, returns False when the sequence is finished"""
+        if token_id in self._eos_token_ids:
+            self._finish(0, "stop")
+            self._cache()
+            return False
+        self._put(0, token_id)
+        self._token_ids.append(token_id)
+        if self._seen is not None:
+            self._seen[token_id] = True
+        if len(self.output_ids[0]) >= self.params.max_new_tokens:
+            self._finish(0, "length")
+            self._cache()
+            return False
+        return True
+
+    def _cache(self) -> None:
+        """caches the prompt and the completion for the next turn of the chat"""
+        if self._prefix_cache is None:
+            return
+        layout = self._runner.kv_layout
+        # an eos among the accepted drafts leaves drafts after it in the cache
+        length = min(kv_length(self._past, layout), len(self._token_ids))
+        self._prefix_cache.insert(self._token_ids[:length], kv_slice(self._past, layout, 0, length))
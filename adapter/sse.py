@@ -0,0 +1,137 @@
+import asyncio
+import json
+import logging
+from typing import Any, AsyncIterator, Callable, List, Optional
+from sse_starlette.sse import EventSourceResponse
+from starlette.types import Receive, Scope, Send
+
+
+_logger = logging.getLogger(__name__)
+
+
+class ChunkEncoder:
+    """
+    Serializes the chat.completion.chunk events of one stream. The constant part of the JSON is
+    rendered once per stream, each chunk only splices in its index and the escaped delta, which
+    keeps model construction and validation out of the per-token path.
+    """
+    _prefix: str
+    _usage_prefix: str
+
+    def __init__(self, id: str, model: str, created: int, object: str = "chat.completion.chunk") -> None:
+        head = json.dumps({
+            "id": id,
+            "object": object,
+            "created": created,
+            "model": model,
+        }, ensure_ascii=False, separators=(",", ":"))[:-1]
+        self._prefix = head + ',"choices":[{"index":'
+        self._usage_prefix = head + ',"choices":[],"usage":'
+
+    def role(self, index: int, role: str = "assistant") -> str:
+        return f'{self._prefix}{index},"delta":{{"role":"{role}"}},"finish_reason":null}}]}}'
+
+    def content(self, index: int, text: str) -> str:
+        return f'{self._prefix}{index},"delta":{{"content":{json.dumps(text, ensure_ascii=False)}}},"finish_reason":null}}]}}'
+
+    def empty(self, index: int) -> str:
+        return f'{self._prefix}{index},"delta":{{}},"finish_reason":null}}]}}'
+
+    def finish(self, index: int, finish_reason: str) -> str:
+        return f'{self._prefix}{index},"delta":{{}},"finish_reason":{json.dumps(finish_reason)}}}]}}'
+
+    def usage(self, prompt_tokens: int, completion_tokens: int) -> str:
+        return (f'{self._usage_prefix}{{"prompt_tokens":{prompt_tokens},"completion_tokens":{completion_tokens},'
+                f'"total_tokens":{prompt_tokens + completion_tokens}}}}}')
+
+
+class TextChunkEncoder(ChunkEncoder):
+    """serializes the text_completion events of a /v1/completions stream"""
+
+    def __init__(self, id: str, model: str, created: int) -> None:
+        super().__init__(id, model, created, object="text_completion")
+
+    def content(self, index: int, text: str) -> str:
+        return f'{self._prefix}{index},"text":{json.dumps(text, ensure_ascii=False)},"logprobs":null,"finish_reason":null}}]}}'
+
+    def empty(self, index: int) -> str:
+        return f'{self._prefix}{index},"text":"","logprobs":null,"finish_reason":null}}]}}'
+
+    def finish(self, index: int, finish_reason: str) -> str:
+        return f'{self._prefix}{index},"text":"","logprobs":null,"finish_reason":{json.dumps(finish_reason)}}}]}}'
+
+
+class ClosingEventSourceResponse(EventSourceResponse):
+    """
+    An event stream that closes its body once the response ends and then runs its close callbacks.
+    They run even when the body never started, e.g. when the client left before the first event, so
+    that what a stream holds is released without relying on the finally of its body. A callback that
+    raises is logged, the ones after it still run.
+    """
+    _on_close: List[Callable[[], None]]
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._on_close = []
+
+    def call_on_close(self, callback: Callable[[], None]) -> None:
+        self._on_close.append(callback)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.close()
+
+    async def close(self) -> None:
+        """closes the body and runs the close callbacks, only the first call does anything"""
+        try:
+            aclose = getattr(self.body_iterator, "aclose", None)
+            if aclose is not None:
+                await aclose()
+        finally:
+            callbacks, self._on_close = self._on_close, []
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception:
+                    _logger.exception("close callback %r of a stream failed", callback)
+
+
+async def coalesce(items: AsyncIterator[Any], max_items: int, max_delay_ms: float) -> AsyncIterator[List[Any]]:
+    """
+    groups items into lists, a list is flushed once it holds max_items or its first item is
+    max_delay_ms old (no time limit when max_delay_ms is 0)
+    """
+    loop = asyncio.get_running_loop()
+    iterator = items.__aiter__()
+    buffer: List[Any] = []
+    deadline: Optional[float] = None
+    pending: Optional[asyncio.Future] = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            timeout = None if deadline is None else max(
+                deadline - loop.time(), 0)
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if not done:
+                yield buffer
+                buffer, deadline = [], None
+                continue
+            future, pending = pending, None
+            try:
+                item = future.result()
+            except StopAsyncIteration:
+                break
+            buffer.append(item)
+            if deadline is None and max_delay_ms > 0:
+                deadline = loop.time() + max_delay_ms / 1000
+            if len(buffer) >= max_items:
+                yield buffer
+                buffer, deadline = [], None
+        if buffer:
+            yield buffer
+    finally:
+        if pending is not None:
+            pending.cancel()
@@ -0,0 +1,79 @@
+from typing import Dict, List, Tuple
+
+
+class StopMatcher:
+    """
+    Finds the first occurrence of any stop string in a text that arrives in pieces, with an
+    Aho-Corasick automaton over characters, so a stop string split across pieces is still found.
+    Text that could be the beginning of a stop string is held back until it is decided.
+    """
+    _goto: List[Dict[str, int]]
+    _fail: List[int]
+    _depth: List[int]  # length of the prefix a state stands for
+    _match: List[int]  # length of the longest stop string ending in a state, 0 if none
+    _state: int
+    _pending: str
+
+    def __init__(self, stops: List[str]) -> None:
+        self._goto = [{}]
+        self._fail = [0]
+        self._depth = [0]
+        self._match = [0]
+        for stop in stops:
+            if stop == "":
+                continue
+            state = 0
+            for ch in stop:
+                next_state = self._goto[state].get(ch)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][ch] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._depth.append(self._depth[state] + 1)
+                    self._match.append(0)
+                state = next_state
+            self._match[state] = len(stop)
+
+        # breadth first, so the fail state of a state is complete before its children
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for ch, child in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(ch, 0)
+                self._match[child] = max(
+                    self._match[child], self._match[self._fail[child]])
+                queue.append(child)
+        self._state = 0
+        self._pending = ""
+
+    def feed(self, text: str) -> Tuple[str, bool]:
+        """
+        returns the text that can be emitted and whether a stop string was found. On a match the
+        text ends right before the stop string and nothing after it should be fed.
+        """
+        goto, fail, match = self._goto, self._fail, self._match
+        buffer = self._pending + text
+        state = self._state
+        for i in range(len(self._pending), len(buffer)):
+            ch = buffer[i]
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if match[state]:
+                self._state = 0
+                self._pending = ""
+                return buffer[:i + 1 - match[state]], True
+        self._state = state
+        held = self._depth[state]
+        self._pending = buffer[len(buffer) - held:] if held else ""
+        return buffer[:len(buffer) - held], False
+
+    def flush(self) -> str:
+        """returns the text held back, once no more text will come"""
+        pending = self._pending
+        self._state = 0
+        self._pending = ""
+        return pending
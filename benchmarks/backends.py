@@ -0,0 +1,117 @@
+"""
+services for benchmarking the adapter without the real models: a fake service that streams a fixed
+text at a fixed token rate, and a tiny randomly initialized llama model that generates on the CPU
+"""
+import time
+from typing import ClassVar, Iterator, List, Tuple
+from adapter.chat_completion import ChatCompletion, ChatMessage
+
+
+class FakeChatCompletion(ChatCompletion):
+    """
+    Streams completion_tokens words, one per 1 / tokens_per_second seconds, after a prefill of the
+    prompt at prefill_tokens_per_second. A token is a word, so prompts of n words have n tokens.
+    The output is the same for every request, and its timing only depends on the prompt length.
+    """
+    # the output is the same whatever the params
+    _remote_chat_params: ClassVar[Tuple[str, ...]] = ()
+    _tokens_per_second: float
+    _prefill_tokens_per_second: float
+    _completion_tokens: int
+
+    def __init__(self, tokens_per_second: float = 100, prefill_tokens_per_second: float = 10000,
+                 completion_tokens: int = 64) -> None:
+        assert tokens_per_second > 0, f"invalid tokens_per_second: {tokens_per_second}"
+        assert prefill_tokens_per_second > 0, f"invalid prefill_tokens_per_second: {prefill_tokens_per_second}"
+        assert completion_tokens > 0, f"invalid completion_tokens: {completion_tokens}"
+        super().__init__(None, None)
+        self._tokens_per_second = tokens_per_second
+        self._prefill_tokens_per_second = prefill_tokens_per_second
+        self._completion_tokens = completion_tokens
+
+    def service_seconds(self, prompt_tokens: int) -> float:
+        """the time a request takes inside the service, what a client sees beyond it is overhead"""
+        return prompt_tokens / self._prefill_tokens_per_second + self._completion_tokens / self._tokens_per_second
+
+    def chat(self, messages: List[ChatMessage]) -> str:
+        return "".join(self.chat_stream(messages))
+
+    def chat_stream(self, messages: List[ChatMessage]) -> Iterator[str]:
+        # sleeps until each token is due, so that the time spent between tokens does not add up
+        start = time.perf_counter() + self.num_tokens_from_messages(messages) / \
+            self._prefill_tokens_per_second
+        interval = 1 / self._tokens_per_second
+        for i in range(self._completion_tokens):
+            delay = start + (i + 1) * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            yield f"w{i % 10} "
+
+    def num_tokens(self, text: str) -> int:
+        return len(text.split())
+
+    def num_tokens_from_messages(self, messages: List[ChatMessage]) -> int:
+        return sum(self.num_tokens(message.content) for message in messages)
+
+    @property
+    def memory_bytes(self) -> int:
+        return 0
+
+
+_TINY_CORPUS: List[str] = [
+    "the quick brown fox jumps over the lazy dog",
+    "hello world this is a tiny model for benchmarks",
+    "user assistant system word tokens merge into pieces",
+]
+
+
+class TinyChatCompletion(ChatCompletion):
+    """
+    A llama model of 2 small layers with random weights and a byte level BPE tokenizer, built in
+    memory from seed. It generates through the adapter's own direct generation, like the real
+    services with native_generation, so its benchmarks include tokenizing, the decode loop and
+    detokenizing.
+    """
+
+    def __init__(self, seed: int = 0, hidden_size: int = 64, num_hidden_layers: int = 2) -> None:
+        import torch
+        from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+        from transformers import GenerationConfig, LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+        bpe = Tokenizer(models.BPE())
+        bpe.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+        bpe.decoder = decoders.ByteLevel()
+        bpe.train_from_iterator(_TINY_CORPUS * 20, trainers.BpeTrainer(
+            vocab_size=320, special_tokens=["<s>", "</s>"],
+            initial_alphabet=pre_tokenizers.ByteLevel.alphabet()))
+        tokenizer = PreTrainedTokenizerFast(
+            tokenizer_object=bpe, bos_token="<s>", eos_token="</s>")
+        torch.manual_seed(seed)
+        config = LlamaConfig(
+            vocab_size=len(tokenizer),
+            hidden_size=hidden_size,
+            intermediate_size=hidden_size * 2,
+            num_hidden_layers=num_hidden_layers,
+            num_attention_heads=4,
+            num_key_value_heads=2,
+            max_position_embeddings=4096,
+            bos_token_id=tokenizer.bos_token_id,
+            eos_token_id=tokenizer.eos_token_id,
+        )
+        model = LlamaForCausalLM(config).eval()
+        model.generation_config = GenerationConfig(
+            eos_token_id=tokenizer.eos_token_id, max_new_tokens=64, do_sample=False)
+        super().__init__(model, tokenizer, native_generation=True)
+
+    def build_input_ids(self, messages: List[ChatMessage]) -> List[int]:
+        input_ids: List[int] = [self._tokenizer.bos_token_id]
+        for message in messages:
+            input_ids += self._tokenizer.encode(
+                f"{message.role}: {message.content}\n", add_special_tokens=False)
+        return input_ids + self._tokenizer.encode("assistant:", add_special_tokens=False)
+
+    def chat(self, messages: List[ChatMessage]) -> str:
+        return self._chat_native(messages)
+
+    def chat_stream(self, messages: List[ChatMessage]) -> Iterator[str]:
+        return self._chat_stream_native(messages)
@@ -0,0 +1,76 @@
+"""
+measures how long importing parts of the adapter takes in a fresh interpreter, and fails when a
+lightweight import pulls in torch or transformers, or takes longer than --max-ms
+
+run on the shell:
+PYTHONPATH=/this/repo/path python benchmarks/import_time.py
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from typing import Dict, List
+
+
+# statements that must stay light: none of them may import a heavy module
+LIGHT_IMPORTS: List[str] = [
+    "import adapter",
+    "from adapter import ChatBot, ChatMessage",
+    "import adapter.protocol",
+    "from adapter import app",
+]
+HEAVY_MODULES: List[str] = ["torch", "transformers"]
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+exec(sys.argv[1])
+elapsed = time.perf_counter() - start
+print(json.dumps({"ms": elapsed * 1000, "heavy": [m for m in sys.argv[2:] if m in sys.modules]}))
+"""
+
+
+def measure(statement: str, repeat: int) -> Dict[str, object]:
+    runs: List[float] = []
+    heavy: List[str] = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", _PROBE, statement, *HEAVY_MODULES],
+                             check=True, capture_output=True, text=True).stdout
+        result = json.loads(out.strip().splitlines()[-1])
+        runs.append(result["ms"])
+        heavy = result["heavy"]
+    return {
+        "statement": statement,
+        "median_ms": statistics.median(runs),
+        "min_ms": min(runs),
+        "heavy_modules": heavy,
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-ms", type=float, default=1500,
+                        help="fail when the median of a light import exceeds this")
+    parser.add_argument("--json", action="store_true",
+                        help="print the results as json")
+    args = parser.parse_args()
+
+    results = [measure(statement, args.repeat) for statement in LIGHT_IMPORTS]
+    failed = False
+    for result in results:
+        result["ok"] = not result["heavy_modules"] and result["median_ms"] <= args.max_ms
+        failed = failed or not result["ok"]
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            status = "ok" if result["ok"] else "FAIL"
+            heavy = ", ".join(result["heavy_modules"]) or "-"
+            print(f"{status:4}  {result['median_ms']:8.1f} ms  heavy: {heavy:20}  {result['statement']}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
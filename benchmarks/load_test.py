@@ -0,0 +1,443 @@
+"""
+load tests the API with a stand-in model: sweeps concurrency, prompt length and streaming, and reports
+throughput, time to first token, inter-token latency and the time the adapter adds per token as json,
+optionally compared against a baseline from an earlier run
+
+run on the shell, from any directory as long as the repo is on PYTHONPATH:
+PYTHONPATH=/this/repo/path python benchmarks/load_test.py --output results.json
+PYTHONPATH=/this/repo/path python benchmarks/load_test.py --baseline results.json
+or from the repo
+python -m benchmarks.load_test --output results.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import platform
+import socket
+import sys
+import threading
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+import adapter
+from adapter.chat_completion import ChatCompletion, ChatMessage, CompletionUsage, GenerationParams
+from benchmarks.backends import FakeChatCompletion, TinyChatCompletion
+
+
+# a result worse than the baseline by both margins is a regression; for rates, higher is better
+HIGHER_IS_BETTER: List[str] = ["requests_per_s", "tokens_per_s"]
+LOWER_IS_BETTER: List[str] = ["ttft_p50_ms", "itl_p50_ms",
+                              "latency_p50_ms", "overhead_ms_per_token"]
+POINT_KEY: List[str] = ["backend", "driver",
+                        "concurrency", "prompt_tokens", "stream"]
+
+
+class RequestResult(NamedTuple):
+    latency: float
+    ttft: Optional[float]
+    itls: List[float]
+    completion_tokens: int
+    error: Optional[str]
+
+
+Driver = Callable[[Dict[str, Any]], AsyncIterator[Tuple[int, bytes]]]
+# the status of a GET of a path
+StatusGetter = Callable[[str], Awaitable[int]]
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """nearest rank percentile, q in [0, 100]"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(math.ceil(q / 100 * len(ordered)) - 1, 0)]
+
+
+def to_ms(value: Optional[float]) -> Optional[float]:
+    return round(value * 1000, 4) if value is not None else None
+
+
+def build_messages(prompt_tokens: int) -> List[Dict[str, str]]:
+    # a word is about a token for both backends
+    return [{"role": "user", "content": " ".join(f"word{i % 50}" for i in range(prompt_tokens))}]
+
+
+def build_scope(method: str, path: str, headers: List[Tuple[bytes, bytes]]) -> Dict[str, Any]:
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": headers,
+        "client": ("127.0.0.1", 0),
+        "server": ("127.0.0.1", 80),
+    }
+
+
+async def asgi_status(path: str) -> int:
+    status = 0
+
+    async def receive() -> Dict[str, Any]:
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message: Dict[str, Any]) -> None:
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await adapter.app(build_scope("GET", path, []), receive, send)
+    return status
+
+
+async def wait_ready(get_status: StatusGetter, timeout: float = 600) -> None:
+    """waits until the service, which loads in the background, is ready, so that no request gets a 503"""
+    deadline = time.perf_counter() + timeout
+    while await get_status("/health/ready") != 200:
+        if await get_status("/health/live") != 200:
+            raise RuntimeError("the service failed to load")
+        if time.perf_counter() > deadline:
+            raise RuntimeError(f"the service was not ready within {timeout}s")
+        await asyncio.sleep(0.05)
+
+
+async def asgi_driver(payload: Dict[str, Any]) -> AsyncIterator[Tuple[int, bytes]]:
+    """calls the app in process, yields the status and each body part as the app sends it"""
+    body = json.dumps(payload).encode()
+    parts: "asyncio.Queue[Optional[Tuple[int, bytes]]]" = asyncio.Queue()
+    done = asyncio.Event()
+    status = 0
+    sent = False
+
+    async def receive() -> Dict[str, Any]:
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message: Dict[str, Any]) -> None:
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            await parts.put((status, message.get("body", b"")))
+            if not message.get("more_body", False):
+                await parts.put(None)
+
+    scope = build_scope("POST", "/v1/chat/completions", [
+        (b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())])
+    task = asyncio.create_task(adapter.app(scope, receive, send))
+    try:
+        while True:
+            part = await parts.get()
+            if part is None:
+                break
+            yield part
+    finally:
+        done.set()
+        await task
+
+
+def http_driver(base_url: str) -> Driver:
+    import httpx
+    client = httpx.AsyncClient(base_url=base_url, timeout=None, limits=httpx.Limits(
+        max_connections=None, max_keepalive_connections=None))
+
+    async def post(payload: Dict[str, Any]) -> AsyncIterator[Tuple[int, bytes]]:
+        async with client.stream("POST", "/v1/chat/completions", json=payload) as rsp:
+            async for part in rsp.aiter_raw():
+                yield rsp.status_code, part
+    async def get_status(path: str) -> int:
+        return (await client.get(path)).status_code
+    post.client = client
+    post.get_status = get_status
+    return post
+
+
+async def run_request(driver: Driver, payload: Dict[str, Any]) -> RequestResult:
+    start = time.perf_counter()
+    status = 0
+    times: List[float] = []
+    completion_tokens = 0
+    buffer = b""
+    body = b""
+    async for status, part in driver(payload):
+        now = time.perf_counter()
+        if not payload["stream"]:
+            body += part
+            continue
+        buffer += part
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            line = line.strip()
+            if not line.startswith(b"data:") or line == b"data: [DONE]":
+                continue
+            chunk = json.loads(line[5:])
+            if chunk.get("usage"):
+                completion_tokens = chunk["usage"]["completion_tokens"]
+            for choice in chunk.get("choices", []):
+                if choice["delta"].get("content"):
+                    times.append(now)
+    latency = time.perf_counter() - start
+    if status != 200:
+        return RequestResult(latency, None, [], 0, f"status {status}")
+    if not payload["stream"]:
+        completion_tokens = json.loads(body)["usage"]["completion_tokens"]
+    return RequestResult(
+        latency=latency,
+        ttft=times[0] - start if times else None,
+        itls=[b - a for a, b in zip(times, times[1:])],
+        completion_tokens=completion_tokens,
+        error=None,
+    )
+
+
+async def run_point(driver: Driver, concurrency: int, num_requests: int, payload: Dict[str, Any]) -> Tuple[float, List[RequestResult]]:
+    """num_requests requests from concurrency clients, each sending its next request when the last one ends"""
+    results: List[RequestResult] = []
+    remaining = num_requests
+
+    async def client() -> None:
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            try:
+                results.append(await run_request(driver, payload))
+            except Exception as e:
+                results.append(RequestResult(
+                    0, None, [], 0, f"{type(e).__name__}: {e}"))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return time.perf_counter() - start, results
+
+
+def direct_seconds(service: ChatCompletion, prompt_tokens: int, max_tokens: int, repeat: int = 3) -> Tuple[float, float]:
+    """mean seconds and completion tokens of a request to the service itself, without the API"""
+    messages = [ChatMessage(**message)
+                for message in build_messages(prompt_tokens)]
+    params = GenerationParams(max_new_tokens=max_tokens)
+    durations: List[float] = []
+    tokens: List[int] = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in service.complete_stream(messages, params):
+            if isinstance(item, CompletionUsage):
+                tokens.append(item.completion_tokens)
+        durations.append(time.perf_counter() - start)
+    return sum(durations) / repeat, sum(tokens) / repeat
+
+
+def summarize(backend: str, driver: str, concurrency: int, prompt_tokens: int, stream: bool, elapsed: float,
+              results: List[RequestResult], direct: Tuple[float, float]) -> Dict[str, Any]:
+    ok = [result for result in results if result.error is None]
+    tokens = sum(result.completion_tokens for result in ok)
+    latencies = [result.latency for result in ok]
+    ttfts = [result.ttft for result in ok if result.ttft is not None]
+    itls = [itl for result in ok for itl in result.itls]
+    overhead: Optional[float] = None
+    if ok and tokens > 0:
+        # beyond what the service takes for a request on its own; on a backend bound by compute this
+        # includes contention between concurrent requests
+        overhead = (sum(latencies) / len(ok) -
+                    direct[0]) / (tokens / len(ok))
+    return {
+        "backend": backend,
+        "driver": driver,
+        "concurrency": concurrency,
+        "prompt_tokens": prompt_tokens,
+        "stream": stream,
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "error_samples": sorted({result.error for result in results if result.error is not None})[:3],
+        "elapsed_s": round(elapsed, 4),
+        "requests_per_s": round(len(ok) / elapsed, 4) if elapsed > 0 else None,
+        "tokens_per_s": round(tokens / elapsed, 4) if elapsed > 0 else None,
+        "latency_p50_ms": to_ms(percentile(latencies, 50)),
+        "latency_p99_ms": to_ms(percentile(latencies, 99)),
+        "ttft_p50_ms": to_ms(percentile(ttfts, 50)),
+        "ttft_p99_ms": to_ms(percentile(ttfts, 99)),
+        "itl_p50_ms": to_ms(percentile(itls, 50)),
+        "itl_p99_ms": to_ms(percentile(itls, 99)),
+        "direct_ms": to_ms(direct[0]),
+        "overhead_ms_per_token": to_ms(overhead),
+    }
+
+
+def build_backend(name: str, args: argparse.Namespace) -> ChatCompletion:
+    if name == "fake":
+        return FakeChatCompletion(tokens_per_second=args.fake_tokens_per_second,
+                                  completion_tokens=args.max_tokens)
+    if name == "tiny":
+        return TinyChatCompletion()
+    raise ValueError(f"unknown backend: {name}")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def sweep(backend: str, service: ChatCompletion, driver_name: str, driver: Driver,
+                args: argparse.Namespace) -> List[Dict[str, Any]]:
+    points: List[Dict[str, Any]] = []
+    for prompt_tokens in args.prompt_tokens:
+        direct = direct_seconds(service, prompt_tokens, args.max_tokens)
+        for stream in args.stream:
+            for concurrency in args.concurrency:
+                payload = {
+                    "model": backend,
+                    "messages": build_messages(prompt_tokens),
+                    "max_tokens": args.max_tokens,
+                    "temperature": 0,
+                    "stream": stream,
+                }
+                if stream:
+                    payload["stream_options"] = {"include_usage": True}
+                # warms up the path of this point
+                await run_point(driver, concurrency, concurrency, payload)
+                elapsed, results = await run_point(
+                    driver, concurrency, args.requests_per_client * concurrency, payload)
+                point = summarize(backend, driver_name, concurrency,
+                                  prompt_tokens, stream, elapsed, results, direct)
+                print(f"{backend:5} {driver_name:5} c={concurrency:<4} prompt={prompt_tokens:<5} stream={str(stream):5} "
+                      f"{point['tokens_per_s']} tok/s  ttft p50 {point['ttft_p50_ms']} ms  "
+                      f"itl p50 {point['itl_p50_ms']} ms  overhead {point['overhead_ms_per_token']} ms/tok",
+                      file=sys.stderr)
+                points.append(point)
+    return points
+
+
+def run_driver(backend: str, service: ChatCompletion, driver_name: str, args: argparse.Namespace) -> List[Dict[str, Any]]:
+    adapter.set_service_loader(lambda: service)
+    # every client holds a worker while its request runs
+    adapter.set_inference_executor(adapter.InferenceExecutor(
+        max_workers=max(args.concurrency), max_queue_size=max(args.concurrency)))
+
+    if driver_name == "asgi":
+        async def run_asgi() -> List[Dict[str, Any]]:
+            async with adapter.app.router.lifespan_context(adapter.app):
+                await wait_ready(asgi_status)
+                return await sweep(backend, service, "asgi", asgi_driver, args)
+        return asyncio.run(run_asgi())
+
+    import uvicorn
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(
+        adapter.app, host="127.0.0.1", port=port, log_level="warning", access_log=False))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError("the server did not start")
+        time.sleep(0.05)
+    try:
+        async def run_http() -> List[Dict[str, Any]]:
+            driver = http_driver(f"http://127.0.0.1:{port}")
+            try:
+                await wait_ready(driver.get_status)
+                return await sweep(backend, service, "http", driver, args)
+            finally:
+                await driver.client.aclose()
+        return asyncio.run(run_http())
+    finally:
+        server.should_exit = True
+        thread.join()
+
+
+def compare(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float,
+            min_delta_ms: float) -> List[str]:
+    """the regressions of results against the baseline, for the points both have"""
+    baseline_points = {tuple(point[key] for key in POINT_KEY): point
+                       for point in baseline}
+    regressions: List[str] = []
+    for point in results:
+        base = baseline_points.get(tuple(point[key] for key in POINT_KEY))
+        if base is None:
+            continue
+        name = ", ".join(f"{key}={point[key]}" for key in POINT_KEY)
+        for metric in HIGHER_IS_BETTER:
+            if point[metric] is not None and base[metric] and point[metric] < base[metric] * (1 - tolerance):
+                regressions.append(
+                    f"{name}: {metric} {point[metric]} < baseline {base[metric]}")
+        for metric in LOWER_IS_BETTER:
+            if point[metric] is None or base[metric] is None:
+                continue
+            # small latencies are noisy, a regression also has to exceed min_delta_ms
+            if point[metric] > base[metric] * (1 + tolerance) and point[metric] - base[metric] > min_delta_ms:
+                regressions.append(
+                    f"{name}: {metric} {point[metric]} > baseline {base[metric]}")
+    return regressions
+
+
+def parse_list(cast: Callable[[str], Any]) -> Callable[[str], List[Any]]:
+    return lambda value: [cast(item) for item in value.split(",") if item]
+
+
+def parse_bool(value: str) -> bool:
+    return value.lower() in ("1", "true", "yes", "stream")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", type=parse_list(str), default=["fake"],
+                        help="comma separated: fake, a service streaming at a fixed rate, and tiny, a small model on the CPU")
+    parser.add_argument("--drivers", type=parse_list(str), default=["asgi", "http"],
+                        help="comma separated: asgi calls the app in process, http goes through uvicorn")
+    parser.add_argument("--concurrency", type=parse_list(int), default=[1, 8, 32])
+    parser.add_argument("--prompt-tokens", type=parse_list(int), default=[16, 512])
+    parser.add_argument("--stream", type=parse_list(parse_bool), default=[True, False],
+                        help="comma separated: true, false or both")
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--requests-per-client", type=int, default=4)
+    parser.add_argument("--fake-tokens-per-second", type=float, default=200)
+    parser.add_argument("--output", help="writes the results as json to this file, instead of stdout")
+    parser.add_argument("--baseline", help="compares against the results in this file")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="relative change against the baseline that counts as a regression")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0,
+                        help="latencies also have to rise by this much to count as a regression")
+    args = parser.parse_args()
+
+    points: List[Dict[str, Any]] = []
+    for backend in args.backends:
+        service = build_backend(backend, args)
+        for driver_name in args.drivers:
+            points.extend(run_driver(backend, service, driver_name, args))
+    report = {
+        "meta": {
+            "time": int(time.time()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "max_tokens": args.max_tokens,
+            "fake_tokens_per_second": args.fake_tokens_per_second,
+        },
+        "results": points,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(points, baseline,
+                              args.tolerance, args.min_delta_ms)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 1 if any(point["errors"] for point in points) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
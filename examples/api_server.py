@@ -1,26 +1,140 @@
+import logging
 import os
+from functools import partial
 import adapter
 from adapter import ChatCompletion, create_chat_completion_service
 import uvicorn
 
 
-use_service = os.environ.get("USE_SERVICE")
+# the adapter logs loading the service and replica restarts
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"),
+                    format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+_logger = logging.getLogger("api_server")
+# a comma separated list serves several models, each loads on its first request
+use_services = os.environ.get("USE_SERVICE", "").split(",")
+use_service = use_services[0]
 service_args = {
     "baichuan2": ["../Baichuan2/baichuan-inc/Baichuan2-13B-Chat-4bits", True],
     "chatglm2": ["../ChatGLM2-6B/THUDM/chatglm2-6b-int4"],
     "qwen": ["../Qwen/Qwen/Qwen-14B-Chat-Int4", True],
 }
+native_generation = os.environ.get("NATIVE_GENERATION", "0") == "1"
+max_batch_size = int(os.environ.get("MAX_BATCH_SIZE", "0"))
+prefix_cache_mb = int(os.environ.get("PREFIX_CACHE_MB", "0"))
+# least recently used models are unloaded beyond this, 0 keeps every loaded model
+model_memory_mb = int(os.environ.get("MODEL_MEMORY_MB", "0"))
+# serves from this many worker processes, each with its own copy of the model
+num_replicas = int(os.environ.get("NUM_REPLICAS", "0"))
+# /v1/embeddings batches the inputs of concurrent requests, waiting this long for more of them
+embedding_max_batch_size = int(os.environ.get("EMBEDDING_MAX_BATCH_SIZE", "32"))
+embedding_max_wait_ms = float(os.environ.get("EMBEDDING_MAX_WAIT_MS", "5"))
+embedding_cache_size = int(os.environ.get("EMBEDDING_CACHE_SIZE", "4096"))
+embedding_pooling = os.environ.get("EMBEDDING_POOLING", "mean")
+# greedy requests feed the model this many tokens drafted by prompt lookup per step, 0 decodes one by one
+speculative_draft_tokens = int(os.environ.get("SPECULATIVE_DRAFT_TOKENS", "0"))
+speculative_ngram_size = int(os.environ.get("SPECULATIVE_NGRAM_SIZE", "3"))
 
 
-def service_loader() -> ChatCompletion:
-    print("init service ...")
+def build_service(use_service: str = use_service) -> ChatCompletion:
+    _logger.info("init service %s ...", use_service)
     service = create_chat_completion_service(
-        use_service, *service_args[use_service])
-    print("init service done")
+        use_service, *service_args[use_service], native_generation=native_generation)
+    if prefix_cache_mb > 0:
+        service.enable_prefix_cache(prefix_cache_mb << 20)
+    if max_batch_size > 0:
+        service = adapter.BatchingChatCompletion(
+            service, max_batch_size=max_batch_size)
+    elif speculative_draft_tokens > 0:
+        service.enable_speculative_decoding(
+            speculative_draft_tokens, speculative_ngram_size)
+    service.enable_embeddings(max_batch_size=embedding_max_batch_size, max_wait_ms=embedding_max_wait_ms,
+                              cache_size=embedding_cache_size, pooling=embedding_pooling)
+    _logger.info("init service %s done", use_service)
     return service
 
 
-adapter.set_service_loader(service_loader)
+def service_loader(use_service: str = use_service) -> ChatCompletion:
+    if num_replicas > 0:
+        return adapter.ReplicaPool(partial(build_service, use_service), num_replicas=num_replicas,
+                                   max_concurrency=max(max_batch_size, 1))
+    return build_service(use_service)
+
+
+if len(use_services) > 1:
+    registry = adapter.ModelRegistry(max_memory_bytes=model_memory_mb << 20)
+    for name in use_services:
+        registry.register(name, partial(service_loader, name))
+    adapter.set_model_registry(registry)
+else:
+    adapter.set_service_loader(service_loader)
+adapter.set_inference_executor(adapter.InferenceExecutor(
+    # with batching or replicas every running sequence holds a worker while it streams
+    max_workers=int(os.environ.get(
+        "INFERENCE_WORKERS", str(max(max_batch_size, 1) * max(num_replicas, 1)))),
+    max_queue_size=int(os.environ.get("INFERENCE_QUEUE_SIZE", "64")),
+))
+response_cache_size = int(os.environ.get("RESPONSE_CACHE_SIZE", "0"))
+if response_cache_size > 0:
+    adapter.set_response_cache(adapter.ResponseCache(
+        max_entries=response_cache_size,
+        ttl=float(os.environ.get("RESPONSE_CACHE_TTL", "3600")),
+        # a sqlite file keeps the cache across restarts
+        path=os.environ.get("RESPONSE_CACHE_PATH") or None,
+    ))
+# a request log file, "-" logs to stdout and "" turns the log off
+request_log = os.environ.get("REQUEST_LOG", "-")
+if request_log:
+    adapter.set_request_log(adapter.RequestLog(
+        path=request_log if request_log != "-" else None,
+        sample_rate=float(os.environ.get("REQUEST_LOG_SAMPLE_RATE", "1")),
+        # messages and completions may hold private data, they are only logged on request
+        log_content=os.environ.get("REQUEST_LOG_CONTENT", "0") == "1",
+        max_content_chars=int(os.environ.get(
+            "REQUEST_LOG_MAX_CONTENT_CHARS", "1000")),
+    ))
+# trims long conversations to this many prompt tokens, 0 forwards the messages as they are
+context_max_tokens = int(os.environ.get("CONTEXT_MAX_TOKENS", "0"))
+if context_max_tokens > 0:
+    adapter.set_context_window(adapter.ContextWindow(
+        context_max_tokens,
+        # sliding, first_last or summary
+        strategy=os.environ.get("CONTEXT_STRATEGY", "sliding"),
+        summary_tokens=int(os.environ.get("CONTEXT_SUMMARY_TOKENS", "256")),
+        # the tokenizers live in the replicas, the API process estimates
+        count_tokens=adapter.estimate_tokens if num_replicas > 0 else None,
+    ))
+# conversations kept on the server under /v1/sessions, at most this many in memory
+session_memory_size = int(os.environ.get("SESSION_MEMORY_SIZE", "0"))
+if session_memory_size > 0:
+    adapter.set_session_store(adapter.SessionStore(
+        max_sessions=session_memory_size,
+        ttl=float(os.environ.get("SESSION_TTL", "86400")),
+        spill_after=float(os.environ.get("SESSION_SPILL_AFTER", "300")),
+        # a sqlite file for idle sessions, without it they are dropped
+        path=os.environ.get("SESSION_PATH") or None,
+    ))
+# the service loads in the background, these prompt lengths warm it up before /health/ready reports ready
+adapter.set_warm_up(
+    prompt_tokens=[int(tokens) for tokens in os.environ.get(
+        "WARM_UP_PROMPT_TOKENS", "32,512").split(",") if tokens],
+    max_new_tokens=int(os.environ.get("WARM_UP_MAX_TOKENS", "8")),
+    # one warm-up per replica
+    concurrency=max(num_replicas, 1),
+)
+# estimated tokens (prompt plus max_tokens) of the requests generating at once, 0 lets all requests in
+admission_max_tokens = int(os.environ.get("ADMISSION_MAX_TOKENS", "0"))
+if admission_max_tokens > 0:
+    adapter.set_admission_controller(adapter.AdmissionController(
+        admission_max_tokens,
+        # beyond this many tokens waiting, requests get 429 at once
+        max_queue_tokens=int(os.environ.get(
+            "ADMISSION_QUEUE_TOKENS", str(admission_max_tokens * 4))),
+        deadline=float(os.environ.get("ADMISSION_DEADLINE", "30")),
+    ))
+adapter.set_stream_coalescing(
+    max_tokens=int(os.environ.get("STREAM_COALESCE_TOKENS", "1")),
+    max_delay_ms=float(os.environ.get("STREAM_COALESCE_MS", "0")),
+)
 app = adapter.app
 
 if __name__ == "__main__":
@@ -29,5 +143,7 @@ if __name__ == "__main__":
     PYTHONPATH=/this/repo/path USE_SERVICE=<baichuan2|chatglm2|qwen> python api_server.py
     or
     PYTHONPATH=/this/repo/path USE_SERVICE=<baichuan2|chatglm2|qwen> uvicorn api_server:app --host 0.0.0.0 --reload
+    or, serving several models by the model field of requests
+    PYTHONPATH=/this/repo/path USE_SERVICE=baichuan2,chatglm2,qwen MODEL_MEMORY_MB=24000 python api_server.py
     """
     uvicorn.run(app, host="0.0.0.0")
@@ -0,0 +1,68 @@
+"""
+runs an OpenAI batch input file of chat completion requests offline, writing the results in the OpenAI
+batch output format as they finish; a run that was killed resumes from its checkpoint when started again
+
+run on the shell:
+PYTHONPATH=/this/repo/path USE_SERVICE=<baichuan2|chatglm2|qwen> python batch_infer.py requests.jsonl results.jsonl
+"""
+import argparse
+import os
+import sys
+from adapter import BatchingChatCompletion, BatchRunner, BatchStats, ChatCompletion, create_chat_completion_service
+
+
+use_service = os.environ.get("USE_SERVICE")
+service_args = {
+    "baichuan2": ["../Baichuan2/baichuan-inc/Baichuan2-13B-Chat-4bits", True],
+    "chatglm2": ["../ChatGLM2-6B/THUDM/chatglm2-6b-int4"],
+    "qwen": ["../Qwen/Qwen/Qwen-14B-Chat-Int4", True],
+}
+
+
+def service_loader(max_batch_size: int, prefix_cache_mb: int) -> ChatCompletion:
+    print(f"init service {use_service} ...", file=sys.stderr)
+    service = create_chat_completion_service(
+        use_service, *service_args[use_service], native_generation=True)
+    if prefix_cache_mb > 0:
+        # requests of a batch file often share their system prompt
+        service.enable_prefix_cache(prefix_cache_mb << 20)
+    service = BatchingChatCompletion(service, max_batch_size=max_batch_size)
+    print("init service done", file=sys.stderr)
+    return service
+
+
+def print_progress(stats: BatchStats) -> None:
+    done = stats.completed + stats.failed
+    if done % 100 == 0:
+        print(f"{done + stats.skipped}/{stats.lines}+ requests, {stats.failed} failed, "
+              f"{stats.completion_tokens / max(stats.seconds, 1e-6):.1f} tokens/s", file=sys.stderr)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="the requests, one {custom_id, method, url, body} per line")
+    parser.add_argument("output", help="the results, appended to when resuming")
+    parser.add_argument("--checkpoint", help="defaults to the output path with .ckpt appended")
+    parser.add_argument("--max-batch-size", type=int, default=32,
+                        help="sequences decoded together")
+    parser.add_argument("--sort-window", type=int, default=8192,
+                        help="requests sorted by length at a time")
+    parser.add_argument("--prefix-cache-mb", type=int, default=0)
+    args = parser.parse_args()
+
+    service = service_loader(args.max_batch_size, args.prefix_cache_mb)
+    # twice the batch keeps the next requests waiting for the free slots
+    runner = BatchRunner(service, concurrency=args.max_batch_size * 2, sort_window=args.sort_window)
+    try:
+        stats = runner.run(args.input, args.output,
+                           args.checkpoint, progress=print_progress)
+    finally:
+        service.close()
+    print(f"{stats.completed} completed, {stats.failed} failed, {stats.skipped} done before, "
+          f"{stats.prompt_tokens} prompt and {stats.completion_tokens} completion tokens in {stats.seconds:.1f}s",
+          file=sys.stderr)
+    return 1 if stats.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,10 +3,12 @@ import platform
 import subprocess
 from colorama import Fore, Style
 from tempfile import NamedTemporaryFile
-from adapter import ChatBot, ChatCompletion, create_chat_completion_service
+from adapter import ChatBot, ChatCompletion, ContextWindow, create_chat_completion_service
 
 
 use_service = os.environ.get("USE_SERVICE")
+# trims the history to this many prompt tokens, 0 keeps all of it
+context_max_tokens = int(os.environ.get("CONTEXT_MAX_TOKENS", "0"))
 service_args = {
     "baichuan2": ["../Baichuan2/baichuan-inc/Baichuan2-13B-Chat-4bits", True],
     "chatglm2": ["../ChatGLM2-6B/THUDM/chatglm2-6b-int4"],
@@ -42,7 +44,9 @@ def vim_input() -> str:
 def main(system="") -> None:
     stream = True
     service = service_loader()
-    bot = ChatBot(service, system=system)
+    context_window = ContextWindow(context_max_tokens, strategy=os.environ.get(
+        "CONTEXT_STRATEGY", "sliding")) if context_max_tokens > 0 else None
+    bot = ChatBot(service, system=system, context_window=context_window)
     clear_screen()
 
     while True:
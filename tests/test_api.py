@@ -0,0 +1,124 @@
+import asyncio
+import io
+import json
+from typing import Any, Awaitable, Callable, Dict, Iterator
+import pytest
+from fastapi import HTTPException
+import adapter.api as api
+from adapter.admission import AdmissionController
+from adapter.executor import InferenceExecutor
+from adapter.protocol import ChatCompletionMessage, ChatCompletionRequest, SessionCreateRequest, TextCompletionRequest
+from adapter.registry import ModelRegistry
+from adapter.request_log import RequestLog
+from adapter.sessions import SessionStore
+from benchmarks.backends import FakeChatCompletion
+
+
+SCOPE = {"type": "http", "method": "POST", "path": "/", "headers": []}
+
+
+async def leave_before_start(rsp: Any) -> None:
+    """runs rsp for a client that leaves while the response starts, before the body does"""
+    started = asyncio.Event()
+
+    async def receive() -> Dict:
+        await started.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message: Dict) -> None:
+        if message["type"] == "http.response.start":
+            started.set()
+            await asyncio.Event().wait()
+    await rsp(SCOPE, receive, send)
+
+
+def serve(test: Callable[[], Awaitable[None]]) -> None:
+    """runs test while the app is up with a ready service"""
+    async def run() -> None:
+        async with api.lifespan(api.app):
+            while True:
+                try:
+                    await api.get_service("m")
+                    break
+                except HTTPException:
+                    await asyncio.sleep(0.01)
+            await test()
+    asyncio.run(run())
+
+
+@pytest.fixture(autouse=True)
+def app_state() -> Iterator[None]:
+    api.set_service_loader(FakeChatCompletion)
+    api.set_inference_executor(InferenceExecutor(max_workers=2))
+    yield
+    api.set_admission_controller(None)
+    api.set_session_store(None)
+    api.set_request_log(None)
+
+
+def test_service_before_the_lifespan(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(api, "_service_load", None)
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(api.get_service("m"))
+    assert e.value.status_code == 503
+    # the probe agrees, only a registry is ready without a loaded service
+    assert asyncio.run(api.health_ready()).status_code == 503
+    monkeypatch.setattr(api, "_registry", ModelRegistry())
+    assert asyncio.run(api.health_ready()).status == "ready"
+
+
+def stream_request(content: str = "hello there") -> ChatCompletionRequest:
+    return ChatCompletionRequest(model="m", stream=True, max_tokens=10,
+                                 messages=[ChatCompletionMessage(role="user", content=content)])
+
+
+def test_stream_that_never_starts_releases_its_admission() -> None:
+    controller = AdmissionController(1000)
+    api.set_admission_controller(controller)
+    in_flight = api._requests_in_flight.labels()
+
+    async def test() -> None:
+        before = in_flight.value
+        rsp = await api.chat_completions(stream_request())
+        # the prompt is counted by the tokenizer of the service
+        assert controller.stats["in_flight_tokens"] == 2 + 10
+        assert in_flight.value == before + 1
+        await leave_before_start(rsp)
+        assert controller.stats["in_flight_requests"] == 0
+        assert in_flight.value == before
+    serve(test)
+
+
+def test_session_turn_that_never_starts_ends() -> None:
+    store = SessionStore(max_sessions=4)
+    api.set_session_store(store)
+
+    async def test() -> None:
+        session = await api.create_session(SessionCreateRequest())
+        rsp = await api.session_chat_completions(session.id, stream_request())
+        await leave_before_start(rsp)
+        # the session is free for the next turn, and unchanged
+        rsp = await api.session_chat_completions(session.id, stream_request().model_copy(update={"stream": False}))
+        assert rsp.choices[0].message.content
+        assert [message.role for message in store.get(session.id).messages] == ["user", "assistant"]
+    serve(test)
+
+
+def test_failed_completions_are_logged() -> None:
+    stream = io.StringIO()
+    log = RequestLog(stream, sample_rate=0)
+    api.set_request_log(log)
+    in_flight = api._requests_in_flight.labels()
+
+    async def test() -> None:
+        before = in_flight.value
+        for prompt in ["", "hello"]:
+            with pytest.raises(HTTPException):
+                # the fake service has no model to complete prompts with
+                await api.completions(TextCompletionRequest(model="m", prompt=prompt))
+        assert in_flight.value == before
+    serve(test)
+    log.close()
+    records = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [(record["status"], record["prompts"]) for record in records] == [(400, 1), (400, 1)]
+    assert records[1]["error"] == "FakeChatCompletion does not support prompt completion"
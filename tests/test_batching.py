@@ -0,0 +1,91 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Tuple
+import pytest
+from adapter.batching import BatchingChatCompletion
+from adapter.chat_completion import ChatMessage, GenerationParams
+from benchmarks.backends import TinyChatCompletion
+
+
+# prompts of 13 to 99 tokens, which fall into different prefill buckets
+CONTENTS = [
+    "hi",
+    "hello world",
+    "the quick brown fox jumps over the lazy dog",
+    "system user assistant word tokens merge into pieces " * 2,
+    "hello world this is a tiny model for benchmarks " * 4,
+]
+
+
+@pytest.fixture(scope="module")
+def service() -> Iterator[TinyChatCompletion]:
+    service = TinyChatCompletion()
+    yield service
+    service.close()
+
+
+def messages(content: str) -> List[ChatMessage]:
+    return [ChatMessage(role="user", content=content)]
+
+
+def params(max_new_tokens: int, repetition_penalty: float = 1.2) -> GenerationParams:
+    return GenerationParams(max_new_tokens=max_new_tokens, do_sample=False, repetition_penalty=repetition_penalty)
+
+
+def expected(service: TinyChatCompletion, requests: List[Tuple[str, GenerationParams]]) -> List[Tuple[str, str]]:
+    choices = [service.complete(messages(content), params).choices[0] for content, params in requests]
+    return [(choice.text, choice.finish_reason) for choice in choices]
+
+
+@pytest.mark.parametrize("max_batch_size, max_prefills_per_step", [(8, 4), (2, 1), (3, 2)])
+def test_same_tokens_as_sequential(service: TinyChatCompletion, max_batch_size: int,
+                                   max_prefills_per_step: int) -> None:
+    # sequences of other lengths finish in the middle of the batch, the waiting ones join between steps
+    requests = [(content, params(max_new_tokens)) for content in CONTENTS for max_new_tokens in (1, 7, 32)]
+    sequential = expected(service, requests)
+    batching = BatchingChatCompletion(TinyChatCompletion(), max_batch_size, max_prefills_per_step)
+    try:
+        with ThreadPoolExecutor(len(requests)) as pool:
+            choices = list(pool.map(lambda request: batching.complete(
+                messages(request[0]), request[1]).choices[0], requests))
+    finally:
+        batching.close()
+    assert [(choice.text, choice.finish_reason) for choice in choices] == sequential
+
+
+def test_same_tokens_as_sequential_per_token(service: TinyChatCompletion) -> None:
+    requests = [(content, params(24, 1.0)) for content in CONTENTS]
+    sequential = [service._generate(service.build_input_ids(messages(content)), params) for content, params in requests]
+    for request in sequential:
+        for _ in request:
+            pass
+    batching = BatchingChatCompletion(TinyChatCompletion(), max_batch_size=4)
+    try:
+        # submitted at once, the prompts are prefilled together and share every decode step
+        batched = [batching.engine.submit(batching.build_input_ids(messages(content)), params)
+                   for content, params in requests]
+        for request in batched:
+            for _ in request:
+                pass
+    finally:
+        batching.close()
+    for request, expected_request in zip(batched, sequential):
+        assert request.output_ids == expected_request.output_ids
+        assert request.finish_reasons == expected_request.finish_reasons
+
+
+def test_stop_string_leaves_the_batch(service: TinyChatCompletion) -> None:
+    text = service.complete(messages(CONTENTS[2]), params(32)).choices[0].text
+    stop = params(32)
+    stop.stop = [text[len(text) // 2:len(text) // 2 + 2]]
+    requests = [(CONTENTS[2], stop), (CONTENTS[3], params(32)), (CONTENTS[4], params(16))]
+    sequential = expected(service, requests)
+    assert sequential[0][1] == "stop"
+    batching = BatchingChatCompletion(TinyChatCompletion(), max_batch_size=3)
+    try:
+        with ThreadPoolExecutor(len(requests)) as pool:
+            choices = list(pool.map(lambda request: batching.complete(
+                messages(request[0]), request[1]).choices[0], requests))
+    finally:
+        batching.close()
+    assert [(choice.text, choice.finish_reason) for choice in choices] == sequential
+    assert len(batching.engine.batch) == 0
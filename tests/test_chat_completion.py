@@ -0,0 +1,67 @@
+from types import SimpleNamespace
+from typing import Iterator, List
+import pytest
+from adapter.chat_completion import ChatCompletion, ChatMessage, CompletionDelta, CompletionUsage, GenerationParams, GenerationParamsError
+
+
+class _WordTokenizer:
+    eos_token_id = None
+
+    def encode(self, text: str) -> List[int]:
+        return [len(word) for word in text.split()]
+
+
+class RemoteChatCompletion(ChatCompletion):
+    """a service with only the remote chat(), which answers with words words"""
+
+    def __init__(self, words: int, max_new_tokens: int = 4) -> None:
+        model = SimpleNamespace(generation_config=SimpleNamespace(
+            max_new_tokens=max_new_tokens, temperature=0.7, top_p=0.9))
+        super().__init__(model, _WordTokenizer())
+        self.words = words
+
+    def chat(self, messages: List[ChatMessage]) -> str:
+        return " ".join(["word"] * self.words)
+
+    def chat_stream(self, messages: List[ChatMessage]) -> Iterator[str]:
+        for _ in range(self.words):
+            yield "word "
+
+
+MESSAGES = [ChatMessage(role="user", content="hello")]
+
+
+@pytest.mark.parametrize("words, finish_reason", [(2, "stop"), (4, "length")])
+def test_remote_chat_finish_reason(words: int, finish_reason: str) -> None:
+    service = RemoteChatCompletion(words)
+    result = service.complete(MESSAGES)
+    assert result.choices[0].finish_reason == finish_reason
+    assert result.usage.completion_tokens == words
+
+    items = list(service.complete_stream(MESSAGES))
+    assert isinstance(items[-1], CompletionUsage)
+    finish_reasons = [item.finish_reason for item in items
+                      if isinstance(item, CompletionDelta) and item.finish_reason is not None]
+    assert finish_reasons == [finish_reason]
+
+
+def test_remote_chat_takes_model_defaults() -> None:
+    service = RemoteChatCompletion(2)
+    service.check_generation_params(GenerationParams(temperature=0.7))
+    assert service.complete(MESSAGES, GenerationParams(max_new_tokens=4)).choices[0].text == "word word"
+
+
+@pytest.mark.parametrize("params", [
+    GenerationParams(temperature=0.2),
+    GenerationParams(top_p=0.5),
+    GenerationParams(max_new_tokens=16),
+    GenerationParams(do_sample=False),
+])
+def test_remote_chat_rejects_other_params(params: GenerationParams) -> None:
+    service = RemoteChatCompletion(2)
+    with pytest.raises(GenerationParamsError):
+        service.check_generation_params(params)
+    with pytest.raises(GenerationParamsError):
+        service.complete(MESSAGES, params)
+    with pytest.raises(GenerationParamsError):
+        list(service.complete_stream(MESSAGES, params))
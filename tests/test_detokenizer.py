@@ -0,0 +1,54 @@
+import random
+from typing import Any, Iterator, List
+import pytest
+from adapter.detokenizer import IncrementalDetokenizer
+from benchmarks.backends import TinyChatCompletion
+
+
+TEXTS = [
+    "the quick brown fox jumps over the lazy dog",
+    "你好，世界！这是一个很小的模型。",
+    "hello 世界 🦊🐶 the lazy 狗 jumps",
+    "emoji 👩‍👩‍👧 with joiners, 한국어 and العربية",
+]
+
+
+@pytest.fixture(scope="module")
+def tokenizer() -> Iterator[Any]:
+    service = TinyChatCompletion()
+    yield service._tokenizer
+    service.close()
+
+
+def deltas(tokenizer: Any, ids: List[int]) -> List[str]:
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    deltas = [detokenizer.add(token_id) for token_id in ids]
+    deltas.append(detokenizer.flush())
+    assert detokenizer.token_ids == ids
+    return deltas
+
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_deltas_add_up_to_the_text(tokenizer: Any, text: str) -> None:
+    ids = tokenizer.encode(text, add_special_tokens=False)
+    texts = deltas(tokenizer, ids)
+    assert "".join(texts) == tokenizer.decode(ids) == text
+    # the tiny tokenizer splits characters beyond its corpus into byte tokens, which decode to U+FFFD alone
+    if not text.isascii():
+        assert any(tokenizer.decode([token_id]) == "\ufffd" for token_id in ids)
+    # they are held back until their character is complete
+    assert not any("\ufffd" in delta for delta in texts)
+
+
+def test_special_tokens_are_skipped(tokenizer: Any) -> None:
+    ids = tokenizer.encode(TEXTS[2], add_special_tokens=False)
+    ids = [tokenizer.bos_token_id] + ids[:5] + [tokenizer.eos_token_id] + ids[5:]
+    assert "".join(deltas(tokenizer, ids)) == tokenizer.decode(ids, skip_special_tokens=True)
+
+
+def test_random_ids(tokenizer: Any) -> None:
+    # like the output of a random model: byte tokens that do not always form characters
+    rng = random.Random(0)
+    for _ in range(50):
+        ids = [rng.randrange(len(tokenizer)) for _ in range(rng.randrange(1, 40))]
+        assert "".join(deltas(tokenizer, ids)) == tokenizer.decode(ids, skip_special_tokens=True)
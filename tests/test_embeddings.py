@@ -0,0 +1,61 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+import pytest
+from adapter.batching import BatchingChatCompletion
+from adapter.chat_completion import ChatMessage, GenerationParams
+from benchmarks.backends import TinyChatCompletion
+
+
+MESSAGES = [ChatMessage(role="user", content="the quick brown fox")]
+PARAMS = GenerationParams(max_new_tokens=8, do_sample=False)
+
+
+@pytest.fixture(scope="module")
+def service() -> Iterator[TinyChatCompletion]:
+    service = TinyChatCompletion()
+    service.enable_embeddings(max_wait_ms=0)
+    yield service
+    service.close()
+
+
+def test_embedding_waits_for_the_model(service: TinyChatCompletion) -> None:
+    # an input the cache does not hold yet
+    with service._model_lock:
+        future = service.submit_embeddings(["the lazy dog"])
+        with pytest.raises(TimeoutError):
+            future.result(timeout=0.2)
+    assert len(future.result(timeout=10).embeddings) == 1
+
+
+def test_generation_waits_for_the_model(service: TinyChatCompletion) -> None:
+    expected = service.complete(MESSAGES, PARAMS).choices[0].text
+    with ThreadPoolExecutor(1) as pool:
+        with service._model_lock:
+            future = pool.submit(service.complete, MESSAGES, PARAMS)
+            with pytest.raises(TimeoutError):
+                future.result(timeout=0.2)
+        assert future.result(timeout=10).choices[0].text == expected
+
+
+def test_generation_and_embeddings_together(service: TinyChatCompletion) -> None:
+    expected_text = service.complete(MESSAGES, PARAMS).choices[0].text
+    # the same weights without anything running beside
+    alone = TinyChatCompletion()
+    expected = alone.embed(["hello world", "a tiny model"]).embeddings
+    alone.close()
+    with ThreadPoolExecutor(8) as pool:
+        texts = [pool.submit(service.complete, MESSAGES, PARAMS) for _ in range(4)]
+        embeddings = [pool.submit(service.embed, ["hello world", "a tiny model"]) for _ in range(4)]
+        assert all(future.result().choices[0].text == expected_text for future in texts)
+        for future in embeddings:
+            for embedding, expected_embedding in zip(future.result().embeddings, expected):
+                assert embedding == pytest.approx(expected_embedding, abs=1e-5)
+
+
+def test_batching_shares_the_lock_of_its_service() -> None:
+    service = TinyChatCompletion()
+    batching = BatchingChatCompletion(service, max_batch_size=2)
+    try:
+        assert batching._model_lock is service._model_lock
+    finally:
+        batching.close()
@@ -0,0 +1,66 @@
+import logging
+import threading
+from typing import Callable, List
+import pytest
+from adapter.loading import ServiceLoad, load_stage
+from benchmarks.backends import FakeChatCompletion
+
+
+class ClosingService(FakeChatCompletion):
+    """a stand-in that records when it is closed"""
+
+    def __init__(self, closed: List[str]) -> None:
+        super().__init__()
+        self._closed = closed
+
+    def close(self) -> None:
+        self._closed.append("closed")
+        super().close()
+
+
+def blocking_loader(release: threading.Event, closed: List[str]) -> Callable[[], ClosingService]:
+    def load() -> ClosingService:
+        with load_stage("weights"):
+            release.wait()
+        return ClosingService(closed)
+    return load
+
+
+def test_ready(caplog: pytest.LogCaptureFixture) -> None:
+    closed: List[str] = []
+    release = threading.Event()
+    load = ServiceLoad(blocking_loader(release, closed), warm_up_prompt_tokens=[4])
+    with caplog.at_level(logging.INFO, logger="adapter.loading"):
+        load.start()
+        assert load.state == "loading" and not load.wait(0.05)
+        release.set()
+        assert load.wait(10)
+    assert load.service is not None and load.error is None
+    assert set(load.stages) == {"load", "weights", "warm_up"}
+    assert "service ready" in caplog.text
+    load.close()
+    assert closed == ["closed"] and load.service is None
+
+
+def test_failure_is_logged(caplog: pytest.LogCaptureFixture) -> None:
+    def load() -> FakeChatCompletion:
+        raise RuntimeError("no weights")
+    service_load = ServiceLoad(load)
+    with caplog.at_level(logging.ERROR, logger="adapter.loading"):
+        service_load.start()
+        assert not service_load.wait(10)
+    assert service_load.state == "failed" and service_load.error == "RuntimeError: no weights"
+    assert "service failed to load: RuntimeError: no weights" in caplog.text
+
+
+def test_close_while_loading() -> None:
+    closed: List[str] = []
+    release = threading.Event()
+    load = ServiceLoad(blocking_loader(release, closed))
+    load.start()
+    load.close()
+    # the service loads after the shutdown, and is closed right away
+    release.set()
+    assert not load.wait(10)
+    assert closed == ["closed"]
+    assert load.service is None and load.state == "failed"
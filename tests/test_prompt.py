@@ -0,0 +1,153 @@
+from typing import Any, Iterator, List, Optional, Tuple
+import pytest
+from adapter.chat_completion import ChatMessage
+from adapter.prompt import Conversation, PromptBuilder, PromptTemplate, build_conversation
+from benchmarks.backends import TinyChatCompletion
+
+
+@pytest.fixture(scope="module")
+def tokenizer() -> Iterator[Any]:
+    service = TinyChatCompletion()
+    yield service._tokenizer
+    service.close()
+
+
+def encode(tokenizer: Any, text: str) -> List[int]:
+    return tokenizer.encode(text, add_special_tokens=False)
+
+
+def make_context(tokenizer: Any, conversation: Conversation) -> List[int]:
+    """a chatml rendering like qwen's make_context, with <s> and </s> for <|im_start|> and <|im_end|>"""
+    im_start, im_end = tokenizer.bos_token_id, tokenizer.eos_token_id
+    nl = encode(tokenizer, "\n")
+
+    def turn(role: str, content: str) -> List[int]:
+        return [im_start] + encode(tokenizer, role) + nl + encode(tokenizer, content) + [im_end]
+    ids = turn("system", conversation.system)
+    for user, assistant in conversation.history:
+        ids += nl + turn("user", user) + nl + turn("assistant", assistant)
+    if conversation.query is not None:
+        ids += nl + turn("user", conversation.query) + nl + [im_start] + encode(tokenizer, "assistant") + nl
+    return ids
+
+
+def chatml(tokenizer: Any, assistant: str = "assistant") -> PromptTemplate:
+    im_start, im_end = tokenizer.bos_token_id, tokenizer.eos_token_id
+    return PromptTemplate(
+        system=[im_start, "system", "\n", "{content}", im_end],
+        round=["\n", im_start, "user", "\n", "{user}", im_end,
+               "\n", im_start, assistant, "\n", "{assistant}", im_end],
+        query=["\n", im_start, "user", "\n", "{content}", im_end],
+        generation=["\n", im_start, assistant, "\n"],
+    )
+
+
+def conversations() -> List[Conversation]:
+    """the turns of one conversation, each adds a round to the one before"""
+    rounds = [("hello world", "the quick brown fox"), ("jumps over", "the lazy dog"), ("你好", "世界 🦊")]
+    return [Conversation("You are a helpful assistant.", rounds[:i], query)
+            for i, query in enumerate(["hello world", "jumps over", "你好", "tiny model"])]
+
+
+class Reference:
+    """make_context, counting its calls"""
+    _tokenizer: Any
+    calls: int
+
+    def __init__(self, tokenizer: Any) -> None:
+        self._tokenizer = tokenizer
+        self.calls = 0
+
+    def __call__(self, conversation: Conversation) -> List[int]:
+        self.calls += 1
+        return make_context(self._tokenizer, conversation)
+
+
+def test_same_ids_as_the_reference(tokenizer: Any) -> None:
+    builder = PromptBuilder(tokenizer, chatml(tokenizer), verify_count=2)
+    reference = Reference(tokenizer)
+    for conversation in conversations():
+        assert builder.build(conversation, lambda: reference(conversation)) == make_context(tokenizer, conversation)
+    # only the first prompts are verified
+    assert builder.enabled and reference.calls == 2
+
+
+def test_new_turns_encode_only_their_new_messages(tokenizer: Any) -> None:
+    builder = PromptBuilder(tokenizer, chatml(tokenizer))
+    turns = conversations()
+    builder.build(turns[0])
+    misses = builder.stats["misses"]
+    builder.build(turns[1])
+    # the round repeats the query of the turn before, only the answer and the new query are new
+    assert builder.stats["misses"] - misses == 2
+    assert builder.stats["hits"] > 0
+
+
+def test_lru_keeps_max_entries(tokenizer: Any) -> None:
+    builder = PromptBuilder(tokenizer, chatml(tokenizer), max_entries=3)
+    for conversation in conversations():
+        assert builder.build(conversation) == make_context(tokenizer, conversation)
+    assert builder.stats["entries"] == 3
+
+
+def test_wrong_template_falls_back_to_the_reference(tokenizer: Any) -> None:
+    # a template that renders the generation prompt differently from the model
+    builder = PromptBuilder(tokenizer, chatml(tokenizer, assistant="assistant:"))
+    reference = Reference(tokenizer)
+    turns = conversations()
+    assert builder.build(turns[0], lambda: reference(turns[0])) == make_context(tokenizer, turns[0])
+    assert not builder.enabled and not builder.stats["enabled"]
+    # the builder stays off, every prompt is the reference
+    misses = builder.stats["misses"]
+    for conversation in turns[1:]:
+        assert builder.build(conversation, lambda: reference(conversation)) == make_context(tokenizer, conversation)
+    assert reference.calls == len(turns)
+    assert builder.stats["misses"] == misses
+
+
+def test_continuation_encodes_like_one_text(tokenizer: Any) -> None:
+    # a model that tokenizes its whole prompt as one text
+    template = PromptTemplate(
+        round=["user: {user}\n", "assistant: {assistant}\n"],
+        query=["user: {content}\n"], generation=["assistant:"],
+        prefix=[tokenizer.bos_token_id], continuation=True)
+    builder = PromptBuilder(tokenizer, template)
+    for conversation in conversations():
+        text = "".join(f"user: {user}\nassistant: {assistant}\n" for user, assistant in conversation.history)
+        expected = [tokenizer.bos_token_id] + encode(tokenizer, text + f"user: {conversation.query}\nassistant:")
+        assert builder.build(conversation, lambda: expected) == expected
+    assert builder.enabled
+
+
+def test_window_drops_the_oldest_rounds(tokenizer: Any) -> None:
+    seen: List[Tuple[int, List[int], Optional[int]]] = []
+
+    def window(system_tokens: int, round_tokens: List[int], query_tokens: Optional[int]) -> int:
+        seen.append((system_tokens, round_tokens, query_tokens))
+        return len(round_tokens) - 1
+    template = chatml(tokenizer)
+    template.window = window
+    conversation = conversations()[-1]
+    ids = PromptBuilder(tokenizer, template).build(conversation)
+    assert ids == make_context(tokenizer, conversation._replace(history=conversation.history[-1:]))
+    system_tokens, round_tokens, query_tokens = seen[0]
+    assert system_tokens == len(make_context(tokenizer, Conversation(conversation.system, [], None)))
+    assert len(round_tokens) == len(conversation.history) and query_tokens is not None
+
+
+def test_build_conversation() -> None:
+    messages = [
+        ChatMessage(role="system", content="be brief"),
+        ChatMessage(role="user", content="hello"),
+        ChatMessage(role="user", content="world"),
+        ChatMessage(role="assistant", content="hi"),
+        ChatMessage(role="system", content="be kind"),
+        ChatMessage(role="user", content="how are you"),
+    ]
+    assert build_conversation(messages) == Conversation(
+        "be brief\nbe kind", [("hello\nworld", "hi")], "how are you")
+    assert build_conversation(messages, overwrite_system=True).system == "be kind"
+    assert build_conversation(messages[:4]).query is None
+    # without a separate system prompt, system messages count as the user's
+    assert build_conversation(messages, separate_system=False) == Conversation(
+        "", [("be brief\nhello\nworld", "hi")], "be kind\nhow are you")
@@ -0,0 +1,114 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+import pytest
+from adapter.registry import ModelRegistry
+from benchmarks.backends import FakeChatCompletion
+
+
+class SizedService(FakeChatCompletion):
+    """a stand-in of nbytes that records when it is closed"""
+
+    def __init__(self, name: str, nbytes: int, closed: List[str]) -> None:
+        super().__init__()
+        self.name = name
+        self._nbytes = nbytes
+        self._closed = closed
+
+    @property
+    def memory_bytes(self) -> int:
+        return self._nbytes
+
+    def close(self) -> None:
+        self._closed.append(self.name)
+        super().close()
+
+
+class Loaders:
+    """loaders of sized services that count their calls"""
+    calls: Dict[str, int]
+    closed: List[str]
+
+    def __init__(self) -> None:
+        self.calls = {}
+        self.closed = []
+
+    def loader(self, name: str, nbytes: int, delay: float = 0) -> Callable[[], SizedService]:
+        def load() -> SizedService:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            time.sleep(delay)
+            return SizedService(name, nbytes, self.closed)
+        return load
+
+
+def test_loads_on_first_get() -> None:
+    loaders = Loaders()
+    registry = ModelRegistry()
+    registry.register("a", loaders.loader("a", 10))
+    registry.register("b", loaders.loader("b", 10), owned_by="tests")
+    assert loaders.calls == {}
+    assert [(model.name, model.owned_by, model.loaded, model.memory_bytes)
+            for model in registry.models()] == [("a", "adapter", False, None), ("b", "tests", False, None)]
+    assert registry.get_loaded("a") is None
+
+    service = registry.get("a")
+    assert registry.get("a") is service
+    assert registry.get_loaded("a") is service
+    assert loaders.calls == {"a": 1}
+    assert registry.is_loaded("a") and not registry.is_loaded("b")
+    assert registry.memory_bytes == 10
+    with pytest.raises(KeyError):
+        registry.get("c")
+
+
+def test_evicts_least_recently_used() -> None:
+    loaders = Loaders()
+    registry = ModelRegistry(max_memory_bytes=25)
+    for name in "abc":
+        registry.register(name, loaders.loader(name, 10))
+    a = registry.get("a")
+    registry.get("b")
+    # a is used again, so b is the least recently used
+    assert registry.get("a") is a
+    registry.get("c")
+    assert loaders.closed == ["b"]
+    assert [model.name for model in registry.models() if model.loaded] == ["a", "c"]
+    assert registry.memory_bytes == 20
+
+    # b is known to take 10 bytes, a goes before b loads again
+    registry.get("b")
+    assert loaders.closed == ["b", "a"]
+    assert loaders.calls == {"a": 1, "b": 2, "c": 1}
+
+    assert registry.unload("c")
+    assert not registry.unload("c")
+    registry.close()
+    assert sorted(loaders.closed) == ["a", "b", "b", "c"]
+    assert registry.memory_bytes == 0
+
+
+def test_keeps_a_model_larger_than_the_budget() -> None:
+    loaders = Loaders()
+    registry = ModelRegistry(max_memory_bytes=10)
+    registry.register("a", loaders.loader("a", 5))
+    registry.register("big", loaders.loader("big", 50))
+    registry.get("a")
+    registry.get("big")
+    assert loaders.closed == ["a"]
+    assert registry.is_loaded("big")
+
+
+def test_concurrent_gets_load_once() -> None:
+    loaders = Loaders()
+    registry = ModelRegistry()
+    registry.register("a", loaders.loader("a", 10, delay=0.2))
+    start = threading.Barrier(8)
+
+    def get() -> SizedService:
+        start.wait()
+        return registry.get("a")
+    with ThreadPoolExecutor(8) as pool:
+        services = list(pool.map(lambda _: get(), range(8)))
+    assert loaders.calls == {"a": 1}
+    assert all(service is services[0] for service in services)
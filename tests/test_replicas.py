@@ -0,0 +1,101 @@
+import os
+import signal
+import time
+from functools import partial
+from typing import Callable, Iterator
+import pytest
+from adapter.chat_completion import ChatMessage, CompletionDelta, CompletionUsage
+from adapter.replicas import ReplicaError, ReplicaPool
+from benchmarks.backends import FakeChatCompletion
+
+
+MESSAGES = [ChatMessage(role="user", content="hello there")]
+
+
+def wait_until(condition: Callable[[], bool], timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.05)
+
+
+@pytest.fixture(scope="module")
+def pool() -> Iterator[ReplicaPool]:
+    # streams of 20 tokens take 0.2s, long enough to hold them outstanding
+    pool = ReplicaPool(partial(FakeChatCompletion, tokens_per_second=100, completion_tokens=20),
+                       num_replicas=2, max_concurrency=4, restart_delay=0.1, start_timeout=60)
+    try:
+        assert pool.wait_ready(60)
+        yield pool
+    finally:
+        pool.close()
+
+
+def test_complete(pool: ReplicaPool) -> None:
+    result = pool.complete(MESSAGES)
+    assert result.choices[0].text == "w0 w1 w2 w3 w4 w5 w6 w7 w8 w9 " * 2
+    assert result.usage.prompt_tokens == 2
+    assert result.usage.completion_tokens == 20
+    items = list(pool.complete_stream(MESSAGES))
+    assert isinstance(items[-1], CompletionUsage)
+    assert "".join(item.text for item in items if isinstance(item, CompletionDelta)) == result.choices[0].text
+
+
+def test_counts_tokens_beside_generation(pool: ReplicaPool) -> None:
+    # both replicas are busy, counting does not wait for them
+    streams = [pool.complete_stream(MESSAGES) for _ in range(2 * 4)]
+    assert pool.num_prompt_tokens(MESSAGES) == 2
+    assert pool.num_tokens("one two three") == 3
+    assert [replica["outstanding"] for replica in pool.stats] == [4, 4]
+    for stream in streams:
+        list(stream)
+
+
+def test_least_outstanding_dispatch(pool: ReplicaPool) -> None:
+    # streams are submitted when they are created, and stay outstanding until they end
+    first = pool.complete_stream(MESSAGES)
+    assert [replica["outstanding"] for replica in pool.stats] == [1, 0]
+    second = pool.complete_stream(MESSAGES)
+    assert [replica["outstanding"] for replica in pool.stats] == [1, 1]
+    third = pool.complete_stream(MESSAGES)
+    assert [replica["outstanding"] for replica in pool.stats] == [2, 1]
+    list(second)
+    assert [replica["outstanding"] for replica in pool.stats] == [2, 0]
+    fourth = pool.complete_stream(MESSAGES)
+    assert [replica["outstanding"] for replica in pool.stats] == [2, 1]
+    for stream in (first, third, fourth):
+        list(stream)
+    assert [replica["outstanding"] for replica in pool.stats] == [0, 0]
+
+
+def test_restart_after_kill(pool: ReplicaPool) -> None:
+    before = pool.stats[0]
+    stream = pool.complete_stream(MESSAGES)
+    assert pool.stats[0]["outstanding"] == 1
+    os.kill(before["pid"], signal.SIGKILL)
+    with pytest.raises(ReplicaError):
+        list(stream)
+    wait_until(lambda: pool.stats[0]["ready"] and pool.stats[0]["restarts"] == before["restarts"] + 1)
+    assert pool.stats[0]["pid"] != before["pid"]
+    assert pool.stats[0]["outstanding"] == 0
+    # both replicas serve again
+    streams = [pool.complete_stream(MESSAGES) for _ in range(2)]
+    assert [replica["outstanding"] for replica in pool.stats] == [1, 1]
+    for stream in streams:
+        assert isinstance(list(stream)[-1], CompletionUsage)
+
+
+def test_load_failure_is_reported() -> None:
+    # an invalid rate fails the loader in the replica
+    pool = ReplicaPool(partial(FakeChatCompletion, tokens_per_second=0), num_replicas=1,
+                       restart_delay=0.1, start_timeout=1)
+    try:
+        wait_until(lambda: pool.stats[0]["error"] is not None)
+        assert "invalid tokens_per_second" in pool.stats[0]["error"]
+        with pytest.raises(ReplicaError, match="invalid tokens_per_second"):
+            pool.complete(MESSAGES)
+        with pytest.raises(TypeError):
+            pool.enable_prefix_cache(1 << 20)
+        assert pool.prefix_cache is None
+    finally:
+        pool.close()
@@ -0,0 +1,30 @@
+import io
+import json
+from typing import List
+from adapter.request_log import RequestLog
+
+
+def written(stream: io.StringIO) -> List[dict]:
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+def test_unsampled_records_are_written_on_failure() -> None:
+    stream = io.StringIO()
+    log = RequestLog(stream, sample_rate=0)
+    assert not log.sample()
+    log.record({"id": "ok", "status": 200}, sampled=False)
+    log.record({"id": "failed", "status": 500}, sampled=False)
+    log.record({"id": "gone", "status": 499}, sampled=False)
+    log.record({"id": "sampled", "status": 200})
+    # a client that went away is not a failure, it is only logged if sampled
+    log.record({"id": "sampled and gone", "status": 499})
+    log.close()
+    assert [record["id"] for record in written(stream)] == ["failed", "sampled", "sampled and gone"]
+
+
+def test_content_is_cut() -> None:
+    stream = io.StringIO()
+    log = RequestLog(stream, log_content=True, max_content_chars=4)
+    log.record({"id": "a", "status": 200}, {"completions": ["abcdefgh"]})
+    log.close()
+    assert written(stream)[0]["content"] == {"completions": ["abcd...[4 more chars]"]}
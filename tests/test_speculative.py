@@ -0,0 +1,151 @@
+from typing import Dict, Iterator, List, Optional, Tuple
+import pytest
+from adapter.batching import BatchingChatCompletion
+from adapter.cancel import CancelToken
+from adapter.chat_completion import ChatMessage, CompletionDelta, CompletionUsage, GenerationParams
+from adapter.generation import GenerationRequest
+from adapter.speculative import SpeculativeDecoding
+from benchmarks.backends import TinyChatCompletion
+
+
+CONTENTS = [
+    "the quick brown fox jumps over the lazy dog the quick brown",
+    "hello world",
+    "system user assistant",
+]
+
+
+@pytest.fixture(scope="module")
+def target() -> Iterator[TinyChatCompletion]:
+    service = TinyChatCompletion()
+    yield service
+    service.close()
+
+
+@pytest.fixture(scope="module")
+def speculatives(target: TinyChatCompletion) -> Dict[str, SpeculativeDecoding]:
+    """by drafter: prompt lookup only, a draft of the same weights (drafts are accepted) and another one"""
+    speculatives = {
+        "lookup": target.enable_speculative_decoding(4, 3),
+        "same": target.enable_speculative_decoding(4, 3, TinyChatCompletion()),
+        "other": target.enable_speculative_decoding(4, 3, TinyChatCompletion(seed=1, num_hidden_layers=1)),
+    }
+    target._speculative = None
+    return speculatives
+
+
+def messages(content: str) -> List[ChatMessage]:
+    return [ChatMessage(role="user", content=content)]
+
+
+def generate(service: TinyChatCompletion, speculative: Optional[SpeculativeDecoding],
+             params: GenerationParams, content: str) -> GenerationRequest:
+    service._speculative = speculative
+    try:
+        request = service._generate(service.build_input_ids(messages(content)), params)
+    finally:
+        service._speculative = None
+    for _ in request:
+        pass
+    return request
+
+
+@pytest.mark.parametrize("drafter", ["lookup", "same", "other"])
+@pytest.mark.parametrize("content", CONTENTS)
+@pytest.mark.parametrize("max_new_tokens, repetition_penalty", [(1, 1.0), (5, 1.0), (64, 1.0), (5, 1.2), (64, 1.2)])
+def test_same_tokens_as_greedy(target: TinyChatCompletion, speculatives: Dict[str, SpeculativeDecoding],
+                               drafter: str, content: str, max_new_tokens: int, repetition_penalty: float) -> None:
+    params = GenerationParams(max_new_tokens=max_new_tokens, do_sample=False,
+                              repetition_penalty=repetition_penalty)
+    expected = generate(target, None, params, content)
+    request = generate(target, speculatives[drafter], params, content)
+    assert request.output_ids == expected.output_ids
+    assert request.finish_reasons == expected.finish_reasons
+
+
+def test_drafts_are_accepted_and_rejected(target: TinyChatCompletion,
+                                          speculatives: Dict[str, SpeculativeDecoding]) -> None:
+    params = GenerationParams(max_new_tokens=64, do_sample=False, repetition_penalty=1.2)
+    for speculative in speculatives.values():
+        for content in CONTENTS:
+            generate(target, speculative, params, content)
+    # the same weights accept what they draft, several tokens per forward pass
+    same = speculatives["same"].stats
+    assert same["model_accepted_tokens"] > 0 and same["tokens_per_step"] > 2
+    other = speculatives["other"].stats
+    assert other["model_drafted_tokens"] > other["model_accepted_tokens"]
+    assert speculatives["lookup"].stats["lookup_accepted_tokens"] > 0
+
+
+def complete(service: TinyChatCompletion, speculative: Optional[SpeculativeDecoding],
+             params: GenerationParams) -> Tuple[str, str]:
+    service._speculative = speculative
+    try:
+        choice = service.complete(messages(CONTENTS[0]), params).choices[0]
+    finally:
+        service._speculative = None
+    return choice.text, choice.finish_reason
+
+
+@pytest.mark.parametrize("drafter", ["lookup", "same", "other"])
+def test_stop_string(target: TinyChatCompletion, speculatives: Dict[str, SpeculativeDecoding], drafter: str) -> None:
+    params = GenerationParams(max_new_tokens=64, do_sample=False, repetition_penalty=1.2)
+    text, _ = complete(target, None, params)
+    # a stop string in the middle of the answer
+    params.stop = [text[len(text) // 2:len(text) // 2 + 2]]
+    expected = complete(target, None, params)
+    assert expected[1] == "stop" and len(expected[0]) < len(text)
+    assert complete(target, speculatives[drafter], params) == expected
+
+
+@pytest.mark.parametrize("drafter", ["lookup", "same"])
+def test_cancel(target: TinyChatCompletion, speculatives: Dict[str, SpeculativeDecoding], drafter: str) -> None:
+    params = GenerationParams(max_new_tokens=64, do_sample=False, repetition_penalty=1.2)
+    expected = generate(target, None, params, CONTENTS[0]).output_ids[0]
+    target._speculative = speculatives[drafter]
+    try:
+        request = target._generate(target.build_input_ids(messages(CONTENTS[0])), params)
+    finally:
+        target._speculative = None
+    for i, _ in enumerate(request):
+        if i == 2:
+            request.cancel()
+    assert request.finish_reasons == ["cancelled"]
+    output = request.output_ids[0]
+    assert 3 <= len(output) < len(expected) and output == expected[:len(output)]
+
+    # a cancelled stream ends without usage
+    target._speculative = speculatives[drafter]
+    try:
+        cancel_token = CancelToken()
+        items = []
+        for item in target.complete_stream(messages(CONTENTS[0]), params, cancel_token):
+            items.append(item)
+            if len(items) == 2:
+                cancel_token.cancel()
+    finally:
+        target._speculative = None
+    assert all(isinstance(item, CompletionDelta) for item in items)
+    assert not any(isinstance(item, CompletionUsage) for item in items)
+    assert len(items) < len(expected)
+
+
+def test_draft_of_another_tokenizer(target: TinyChatCompletion) -> None:
+    draft = TinyChatCompletion()
+    draft._tokenizer.add_tokens(["<extra>"])
+    with pytest.raises(AssertionError, match="vocab"):
+        target.enable_speculative_decoding(draft=draft)
+    draft = TinyChatCompletion()
+    draft._model.generation_config.eos_token_id = 5
+    with pytest.raises(AssertionError, match="special tokens"):
+        target.enable_speculative_decoding(draft=draft)
+    assert target.speculative is None
+
+
+def test_batching_rejects_speculative_decoding() -> None:
+    batching = BatchingChatCompletion(TinyChatCompletion(), max_batch_size=2)
+    try:
+        with pytest.raises(TypeError):
+            batching.enable_speculative_decoding()
+    finally:
+        batching.close()
@@ -0,0 +1,67 @@
+import asyncio
+import logging
+from typing import AsyncIterator, Dict, List
+import pytest
+from adapter.sse import ClosingEventSourceResponse
+
+
+SCOPE = {"type": "http", "method": "GET", "path": "/", "headers": []}
+
+
+def serve(events: List[str], started: asyncio.Event, disconnect: bool) -> List[str]:
+    """runs a response whose body records into events, with a client that leaves or stays"""
+    async def body() -> AsyncIterator[str]:
+        events.append("body started")
+        try:
+            yield "a"
+            yield "b"
+        finally:
+            events.append("body closed")
+
+    async def receive() -> Dict:
+        if disconnect:
+            # the client leaves while the response starts
+            await started.wait()
+            return {"type": "http.disconnect"}
+        await asyncio.Event().wait()
+
+    async def send(message: Dict) -> None:
+        if message["type"] == "http.response.start":
+            started.set()
+            if disconnect:
+                await asyncio.Event().wait()
+
+    async def run() -> None:
+        rsp = ClosingEventSourceResponse(body(), ping=0)
+        rsp.call_on_close(lambda: events.append("closed"))
+        await rsp(SCOPE, receive, send)
+        await rsp.close()
+    asyncio.run(run())
+    return events
+
+
+def test_callbacks_run_when_the_body_never_starts() -> None:
+    assert serve([], asyncio.Event(), disconnect=True) == ["closed"]
+
+
+def test_body_closes_before_callbacks() -> None:
+    assert serve([], asyncio.Event(), disconnect=False) == ["body started", "body closed", "closed"]
+
+
+def test_failing_callback_does_not_skip_the_others(caplog: pytest.LogCaptureFixture) -> None:
+    events: List[str] = []
+
+    def fail() -> None:
+        raise RuntimeError("cancel failed")
+
+    async def run() -> None:
+        rsp = ClosingEventSourceResponse(iter(["a"]), ping=0)
+        rsp.call_on_close(lambda: events.append("first"))
+        rsp.call_on_close(fail)
+        rsp.call_on_close(lambda: events.append("last"))
+        await rsp.close()
+        await rsp.close()
+    with caplog.at_level(logging.ERROR, logger="adapter.sse"):
+        asyncio.run(run())
+    assert events == ["first", "last"]
+    assert "cancel failed" in caplog.text
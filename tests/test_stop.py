@@ -0,0 +1,103 @@
+from typing import List, Tuple
+import pytest
+from adapter.chat_completion import ChatCompletion, ChatMessage, CompletionDelta, GenerationParams
+from adapter.stop import StopMatcher
+from benchmarks.backends import FakeChatCompletion, TinyChatCompletion
+
+
+def feed(stops: List[str], pieces: List[str]) -> Tuple[List[str], bool]:
+    """the texts emitted for pieces, and whether a stop string was found"""
+    matcher = StopMatcher(stops)
+    texts: List[str] = []
+    for piece in pieces:
+        text, stopped = matcher.feed(piece)
+        texts.append(text)
+        if stopped:
+            return texts, True
+    texts.append(matcher.flush())
+    return texts, False
+
+
+def test_no_stop() -> None:
+    assert feed(["xyz"], ["hello ", "world"]) == (["hello ", "world", ""], False)
+
+
+def test_stop_split_across_pieces() -> None:
+    texts, stopped = feed(["<end>"], ["hello <e", "n", "d> world"])
+    # the beginning of the stop string is held back until it is decided
+    assert stopped and texts == ["hello ", "", ""]
+    assert "".join(feed(["<end>"], list("hello <end> world"))[0]) == "hello "
+
+
+def test_held_text_that_is_no_stop() -> None:
+    texts, stopped = feed(["<end>"], ["a <e", "nx", "> b"])
+    assert not stopped and "".join(texts) == "a <enx> b"
+    assert texts[0] == "a "
+    # held text comes out with flush() once nothing more comes
+    assert feed(["<end>"], ["a <en"]) == (["a ", "<en"], False)
+
+
+@pytest.mark.parametrize("stops", [["ab", "b"], ["b", "ab"]])
+def test_overlapping_stops(stops: List[str]) -> None:
+    # the longer stop string ends at the same character, and starts earlier
+    assert feed(stops, ["xab"]) == (["x"], True)
+    assert feed(stops, ["xa", "b"]) == (["x", ""], True)
+    assert feed(stops, ["xcb"]) == (["xc"], True)
+
+
+def test_first_stop_to_end_wins() -> None:
+    # "bc" ends before "abcd" would, inside it
+    assert feed(["abcd", "bc"], ["xabcd"]) == (["xa"], True)
+    # the fail links reach a stop through a prefix of another one
+    assert feed(["abcx", "bcd"], ["abcd"]) == (["a"], True)
+
+
+def test_stop_at_the_very_beginning() -> None:
+    assert feed(["he"], ["h", "ello"]) == (["", ""], True)
+    assert feed(["hello"], ["hello world"]) == ([""], True)
+
+
+def test_empty_stops_are_ignored() -> None:
+    assert feed(["", "x"], ["abc"]) == (["abc", ""], False)
+
+
+def messages() -> List[ChatMessage]:
+    return [ChatMessage(role="user", content="the quick brown fox jumps over the lazy dog")]
+
+
+def stream(service: ChatCompletion, params: GenerationParams) -> List[CompletionDelta]:
+    return [item for item in service.complete_stream(messages(), params) if isinstance(item, CompletionDelta)]
+
+
+def check_stops(service: ChatCompletion, params: GenerationParams) -> None:
+    """streams with stop strings around every delta boundary, none of the text after a stop may come"""
+    deltas = stream(service, params)
+    text = "".join(delta.text for delta in deltas)
+    boundaries = []
+    length = 0
+    for delta in deltas[:-1]:
+        length += len(delta.text)
+        boundaries.append(length)
+    # the first character, and strings across each boundary between deltas
+    stops = [text[:1]] + [text[max(boundary - 2, 0):boundary + 2] for boundary in boundaries[:8]]
+    for stop in stops:
+        params.stop = [stop]
+        stopped = stream(service, params)
+        expected = text[:text.index(stop)]
+        assert "".join(delta.text for delta in stopped) == expected
+        # the stop ends the stream, nothing comes after it
+        assert stopped[-1].finish_reason == "stop"
+        assert all(delta.finish_reason is None for delta in stopped[:-1])
+
+
+def test_streams_stop_on_the_remote_path() -> None:
+    service = FakeChatCompletion(tokens_per_second=1e6, completion_tokens=16)
+    check_stops(service, GenerationParams(max_new_tokens=16))
+
+
+def test_streams_stop_on_direct_generation() -> None:
+    service = TinyChatCompletion()
+    try:
+        check_stops(service, GenerationParams(max_new_tokens=32, do_sample=False, repetition_penalty=1.2))
+    finally:
+        service.close()